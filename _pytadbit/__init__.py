@@ -99,7 +99,7 @@ def get_dependencies_version(dico=False):
                           sorted(versions.keys())])
 
 
-from pytadbit.hic_data                   import HiC_data
+from pytadbit.hic_data                   import HiC_data, SparseHiC_data
 from pytadbit.tadbit                     import tadbit, batch_tadbit
 from pytadbit.chromosome                 import Chromosome
 from pytadbit.experiment                 import Experiment, load_experiment_from_reads
@@ -108,6 +108,7 @@ from pytadbit.modelling.structuralmodels import StructuralModels
 from pytadbit.modelling.structuralmodels import load_structuralmodels
 from pytadbit.parsers.hic_parser         import load_hic_data_from_reads
 from pytadbit.parsers.hic_parser         import load_hic_data_from_bam
+from pytadbit.parsers.hic_parser         import load_hic_data_from_bam_multires
 from pytadbit.modelling.impmodel         import load_impmodel_from_cmm
 from pytadbit.modelling.impmodel         import load_impmodel_from_xyz
 from pytadbit.modelling.impmodel         import IMPmodel
@@ -802,7 +802,8 @@ class Experiment(object):
     def model_region(self, start=1, end=None, n_models=5000, n_keep=1000,
                      n_cpus=1, verbose=0, keep_all=False, close_bins=1,
                      outfile=None, config=CONFIG, container=None,
-                     single_particle_restraints=None, use_HiC=True):
+                     single_particle_restraints=None, use_HiC=True,
+                     keep_logs=False):
         """
         Generates of three-dimensional models using IMP, for a given segment of
         chromosome.
@@ -816,6 +817,8 @@ class Experiment(object):
            according to their objective function value (the lower the better)
         :param False keep_all: whether or not to keep the discarded models (if
            True, models will be stored under tructuralModels.bad_models)
+        :param False keep_logs: keep the log of the objective function of each
+           model (needed to plot it)
         :param 1 close_bins: number of particles away (i.e. the bin number
            difference) a particle pair must be in order to be considered as
            neighbors (e.g. 1 means consecutive particles)
@@ -924,7 +927,7 @@ class Experiment(object):
                                   close_bins=close_bins, config=config, container=container,
                                   experiment=self, coords=coords, zeros=zeros,
                                   single_particle_restraints=single_particle_restraints,
-                                  use_HiC=use_HiC)
+                                  use_HiC=use_HiC, keep_logs=keep_logs)
 
     def optimal_imp_parameters(self, start=1, end=None, n_models=500, n_keep=100,
                                n_cpus=1, upfreq_range=(0, 1, 0.1), close_bins=1,
@@ -935,7 +938,7 @@ class Experiment(object):
                                dcutoff_range=[2][:],
                                outfile=None, verbose=True, corr='spearman',
                                off_diag=1, savedata=None,
-                               container=None):
+                               container=None, pilot_models=None):
         """
         Find the optimal set of parameters to be used for the 3D modeling in
         IMP.
@@ -978,6 +981,10 @@ class Experiment(object):
            used: ['cylinder', 250, 1500, 50], and for a typical mammalian nuclei
            (6 micrometers diameter): ['cylinder', 3000, 0, 50]
         :param True verbose: print the results to the standard output
+        :param None pilot_models: number of models used to first evaluate all
+           sets of parameters, only the best ones being then evaluated with
+           more models (see
+           :func:`pytadbit.modelling.impoptimizer.IMPoptimizer.run_grid_search`)
 
         .. note::
 
@@ -1008,7 +1015,8 @@ class Experiment(object):
                                   scale_range=scale_range,
                                   dcutoff_range=dcutoff_range, corr=corr,
                                   n_cpus=n_cpus, verbose=verbose,
-                                  off_diag=off_diag, savedata=savedata)
+                                  off_diag=off_diag, savedata=savedata,
+                                  pilot_models=pilot_models)
 
         if outfile:
             optimizer.write_result(outfile)
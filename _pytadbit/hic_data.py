@@ -9,20 +9,25 @@ standard_library.install_aliases()
 import os
 from sys                            import stderr, modules
 from collections                    import OrderedDict
-from warnings                       import warn
+from warnings                       import warn, catch_warnings, simplefilter
 from bisect                         import bisect_right as bisect
 from pickle                         import HIGHEST_PROTOCOL, dump, load
+from copyreg                        import __newobj__
 
 from numpy.linalg                   import LinAlgError
 from numpy                          import corrcoef, nansum, array, isnan, mean
 from numpy                          import meshgrid, asarray, exp, linspace, std
 from numpy                          import nanpercentile as npperc, log as nplog
 from numpy                          import nanmax, ma, zeros_like
+from numpy                          import fromiter, full, nan, ones
+from numpy                          import searchsorted, int64
+from numpy                          import arange, diff, repeat
 from scipy.stats                    import ttest_ind, spearmanr
 from scipy.special                  import gammaincc
 from scipy.cluster.hierarchy        import linkage, fcluster, dendrogram
 from scipy.sparse.linalg            import eigsh
-from scipy.sparse                   import csr_matrix
+from scipy.sparse                   import csr_matrix, diags
+from scipy.sparse                   import SparseEfficiencyWarning
 from scipy.ndimage                  import median_filter
 
 from pytadbit.utils.extraviews      import plot_compartments
@@ -169,16 +174,36 @@ class HiC_data(dict):
 
         :returns: scipy sparse matrix in Compressed Sparse Row format
         """
-        values = []
-        cols = []
-        rows = []
-        for key, value in self.items():
-            row, col = round(key // self.__size), key % self.__size
-            values.append(float(value))
-            cols.append(col)
-            rows.append(row)
+        N = self.__size
+        keys = fromiter(dict.keys(self), dtype=int64, count=dict.__len__(self))
+        values = fromiter(dict.values(self), dtype=float,
+                          count=dict.__len__(self))
+        return csr_matrix((values, (keys // N, keys % N)), shape=(N, N))
+
+    def to_sparse(self, dtype=None):
+        """
+        Converts this object into a :class:`SparseHiC_data`, storing the
+        interactions in a sparse matrix instead of a dictionary (around 10
+        times less memory).
+
+        :param None dtype: type of the values in the sparse matrix (e.g.
+           numpy.int32 for raw counts, or numpy.float32)
 
-        return csr_matrix((values, (rows, cols)), shape=(self.__size,self.__size))
+        :returns: a SparseHiC_data object with the same interactions, biases,
+           bad columns and expected values.
+        """
+        matrix = self.get_hic_data_as_csr()
+        if dtype is not None:
+            matrix = matrix.astype(dtype)
+        hic = SparseHiC_data(matrix, self.__size,
+                             chromosomes=self.chromosomes,
+                             dict_sec=self.sections,
+                             resolution=self.resolution, masked=self.bads,
+                             symmetricized=self.symmetricized)
+        hic.bias         = self.bias
+        hic.expected     = self.expected
+        hic.compartments = self.compartments
+        return hic
 
     def add_sections_from_fasta(self, fasta):
         """
@@ -1581,6 +1606,323 @@ class HiC_data(dict):
                            [self[i, j] for j in range(i + 1, end1)])
 
 
+class SparseHiC_data(HiC_data):
+    """
+    Hi-C data stored in a sparse matrix (Compressed Sparse Row format) instead
+    of a dictionary. Same interface as :class:`HiC_data` (keys are still the
+    linearized positions row * size + col), but row and column indexes are
+    stored as int32, and whole matrix operations (sums, cis/trans ratio,
+    sub-matrices, normalization) are computed on arrays.
+
+    :param matrix: a scipy sparse matrix, or anything accepted by
+       scipy.sparse.csr_matrix (e.g. a (data, (rows, cols)) tuple), of shape
+       size x size
+    :param None size: number of bins of the matrix (by default, number of rows
+       of the matrix)
+    """
+    def __init__(self, matrix, size=None, chromosomes=None, dict_sec=None,
+                 resolution=1, masked=None, symmetricized=False):
+        if size is None:
+            matrix = csr_matrix(matrix)
+            size = matrix.shape[0]
+        # indexes are stored as int32 by scipy unless too large
+        matrix = csr_matrix(matrix, shape=(size, size))
+        matrix.sum_duplicates()  # also sorts indices, needed for lookups
+        self._csr = matrix
+        super(SparseHiC_data, self).__init__(
+            (), size, chromosomes=chromosomes, dict_sec=dict_sec,
+            resolution=resolution, masked=masked, symmetricized=symmetricized)
+
+    def __reduce_ex__(self, protocol):
+        # values are not in the dictionary, the default pickling of dict
+        # subclasses would try to set them before the sparse matrix exists
+        return (__newobj__, (self.__class__, ), self.__dict__.copy())
+
+    @classmethod
+    def from_coo(cls, rows, cols, data, size, **kwargs):
+        """
+        Creates a SparseHiC_data object from three arrays of coordinates and
+        values (duplicated coordinates are summed).
+
+        :param rows: array of row indexes
+        :param cols: array of column indexes
+        :param data: array of values
+        :param size: number of bins of the matrix
+        :param kwargs: any other parameter of :class:`SparseHiC_data`
+        """
+        return cls(csr_matrix((data, (rows, cols)), shape=(size, size)),
+                   size, **kwargs)
+
+    def _symmetricize(self):
+        """
+        If matrix is not symmetric, make it symmetric (values on one side are
+        added to the other side, diagonal is left untouched)
+        """
+        matrix = self._csr
+        if (matrix != matrix.T).nnz:
+            matrix = matrix + matrix.T - diags(matrix.diagonal(),
+                                                   dtype=matrix.dtype)
+            matrix.eliminate_zeros()
+            matrix.sort_indices()
+            self._csr = matrix
+
+    def _lookup(self, row, col):
+        """
+        :returns: value stored at row, col or None if nothing is stored
+        """
+        if not 0 <= row < len(self) or not 0 <= col < len(self):
+            raise IndexError('ERROR: row or column larger than %s' % len(self))
+        matrix = self._csr
+        beg, end = matrix.indptr[row], matrix.indptr[row + 1]
+        pos = beg + searchsorted(matrix.indices[beg:end], col)
+        if pos < end and matrix.indices[pos] == col:
+            return matrix.data[pos].item()
+        return None
+
+    def __getitem__(self, row_col):
+        try:
+            row, col = row_col
+        except TypeError:
+            row, col = divmod(row_col, len(self))
+        val = self._lookup(row, col)
+        return 0 if val is None else val
+
+    def __setitem__(self, row_col, val):
+        try:
+            row, col = row_col
+        except TypeError:
+            row, col = divmod(row_col, len(self))
+        if not 0 <= row < len(self) or not 0 <= col < len(self):
+            raise IndexError('ERROR: row or column larger than %s' % len(self))
+        with catch_warnings():  # inserting new values in a CSR is slow
+            simplefilter('ignore', SparseEfficiencyWarning)
+            self._csr[row, col] = val
+        if not self._csr.has_sorted_indices:
+            self._csr.sort_indices()
+
+    def get(self, pos, default=None):
+        try:
+            val = self._lookup(*divmod(pos, len(self)))
+        except IndexError:
+            return default
+        return default if val is None else val
+
+    def __contains__(self, pos):
+        return self.get(pos) is not None
+
+    def _linear_keys(self):
+        matrix = self._csr
+        rows = repeat(arange(len(self), dtype=int64), diff(matrix.indptr))
+        return rows * len(self) + matrix.indices
+
+    def __iter__(self):
+        return iter(self._linear_keys().tolist())
+
+    def keys(self):
+        return self._linear_keys().tolist()
+
+    def values(self):
+        return self._csr.data.tolist()
+
+    def items(self):
+        return list(zip(self._linear_keys().tolist(), self._csr.data.tolist()))
+
+    def copy(self):
+        hic = SparseHiC_data(self._csr.copy(), len(self),
+                             chromosomes=self.chromosomes,
+                             dict_sec=self.sections,
+                             resolution=self.resolution, masked=self.bads,
+                             symmetricized=self.symmetricized)
+        hic.bias     = self.bias
+        hic.expected = self.expected
+        return hic
+
+    def get_hic_data_as_csr(self):
+        """
+        :returns: the scipy sparse matrix, in Compressed Sparse Row format,
+           holding the Hi-C data (not a copy)
+        """
+        return self._csr
+
+    def to_dict(self):
+        """
+        Converts this object into a classic :class:`HiC_data` object (values
+        stored in a dictionary).
+        """
+        hic = HiC_data(zip(self._linear_keys().tolist(),
+                           self._csr.data.tolist()), len(self),
+                       chromosomes=self.chromosomes, dict_sec=self.sections,
+                       resolution=self.resolution, masked=self.bads,
+                       symmetricized=self.symmetricized)
+        hic.bias         = self.bias
+        hic.expected     = self.expected
+        hic.compartments = self.compartments
+        return hic
+
+    def _bias_array(self, bias):
+        arr = full(len(self), nan)
+        for k, v in bias.items():
+            arr[k] = v
+        return arr
+
+    def _good_bins(self, bads):
+        good = ones(len(self), dtype=bool)
+        if bads:
+            good[fromiter(bads, dtype=int64)] = False
+        return good
+
+    def sum(self, bias=None, bads=None):
+        """
+        Sum Hi-C data matrix
+        WARNING: parameters are not meant to be used by external users
+
+        :params None bias: expects a dictionary of biases to use normalized matrix
+        :params None bads: extends computed bad columns
+
+        :returns: the sum of the Hi-C matrix skipping bad columns
+        """
+        coo = self._csr.tocoo()
+        good = self._good_bins(bads or self.bads)
+        keep = good[coo.row] & good[coo.col]
+        if bias:
+            bias = self._bias_array(bias)
+            return float((coo.data[keep] / (bias[coo.row[keep]] *
+                                             bias[coo.col[keep]])).sum())
+        return coo.data[keep].sum().item()
+
+    def cis_trans_ratio(self, normalized=False, exclude=None, diagonal=True,
+                        equals=None):
+        """
+        Counts the number of interactions occurring within chromosomes (cis) with
+        respect to the total number of interactions
+
+        :param False normalized: used normalized data
+        :param None exclude: exclude a given list of chromosome from the
+           ratio (may want to exclude translocated chromosomes)
+        :param False diagonal: replace values in the diagonal by 0 or 1
+        :param None equals: can pass a function that would decide if 2 chromosomes
+           have to be considered as the same. e.g. lambda x, y: x[:4]==y[:4] will
+           consider chr2L and chr2R as being the same chromosome. WARNING: only
+           working on consecutive chromosomes.
+
+        :returns: the ratio of cis interactions over the total number of
+           interactions.
+        """
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        if exclude == None:
+            exclude = []
+        if equals == None:
+            equals = lambda x, y: x == y
+        if not self.chromosomes:
+            return float('nan')
+        # define chromosomes to be merged
+        to_skip = set()
+        c_prev = ''
+        for c in self.chromosomes:
+            if equals(c, c_prev):
+                to_skip.add(c_prev)
+            c_prev = c
+        sections = sorted([-1] + [self.section_pos[c][1]
+                                  for c in self.section_pos
+                                  if not c in to_skip])
+        # defines columns to be skipped
+        bads = set(self.bads.keys())
+        for c in exclude:
+            bads.update(i for i in range(*self.section_pos[c]))
+        coo = self._csr.tocoo()
+        good = self._good_bins(bads)
+        keep = (good[coo.row] & good[coo.col] &
+                (searchsorted(sections, coo.row, side='right') ==
+                 searchsorted(sections, coo.col, side='right')))
+        if not diagonal:
+            keep &= coo.row != coo.col
+        vals = coo.data[keep]
+        if normalized:
+            bias = self._bias_array(self.bias)
+            vals = vals / bias[coo.row[keep]] / bias[coo.col[keep]]
+        intra = vals.sum().item()
+        try:
+            return float(intra) / self.sum(bias=self.bias if normalized else None, bads=bads)
+        except ZeroDivisionError:
+            return 0.
+
+    def get_matrix(self, focus=None, diagonal=True, normalized=False,
+                   masked=False):
+        """
+        returns a matrix.
+
+        :param None focus: a tuple with the (start, end) position of the desired
+           window of data (start, starting at 1, and both start and end are
+           inclusive). Alternatively a chromosome name can be input or a tuple
+           of chromosome name, in order to retrieve a specific inter-chromosomal
+           region
+        :param True diagonal: if False, diagonal is replaced by ones, or zeroes
+           if normalized
+        :param False normalized: get normalized data
+        :param False masked: return masked arrays using the definition of bad
+           columns
+
+        :returns: matrix (a list of lists of values)
+        """
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        start1, start2, end1, end2 = self._focus_coords(focus)
+        matrix = self._csr[start2:end2, start1:end1].T.toarray()
+        if normalized:
+            bias = self._bias_array(self.bias)
+            matrix = matrix / bias[start1:end1, None] / bias[None, start2:end2]
+        if not diagonal and start1 == start2:
+            for i in range(len(matrix)):
+                matrix[i, i] = 0 if normalized else 1 if matrix[i, i] else 0
+        matrix = matrix.tolist()
+
+        if masked:
+            bads1 = [b - start1 for b in self.bads if start1 <= b < end1]
+            bads2 = [b - start2 for b in self.bads if start2 <= b < end2]
+            m = zeros_like(matrix)
+            for bad1 in bads1:
+                m[:,bad1] = 1
+                for bad2 in bads2:
+                    m[bad2,:] = 1
+            matrix = ma.masked_array(matrix, m)
+
+        return matrix
+
+    def yield_matrix(self, focus=None, diagonal=True, normalized=False):
+        """
+        Yields a matrix line by line.
+        Bad row/columns are returned as null row/columns.
+
+        :param None focus: a tuple with the (start, end) position of the desired
+           window of data (start, starting at 1, and both start and end are
+           inclusive). Alternatively a chromosome name can be input or a tuple
+           of chromosome name, in order to retrieve a specific inter-chromosomal
+           region
+        :param True diagonal: if False, diagonal is replaced by zeroes
+        :param False normalized: get normalized data
+
+        :yields: matrix line by line (a line being a list of values)
+        """
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        start1, start2, end1, end2 = self._focus_coords(focus)
+        if normalized:
+            bias = self._bias_array(self.bias)
+        for i in range(start2, end2):
+            # if bad column:
+            if i in self.bads:
+                yield [0.0 if normalized else 0 for j in range(start1, end1)]
+                continue
+            line = self._csr[i, start1:end1].toarray()[0]
+            if normalized:
+                line = line / bias[i] / bias[start1:end1]
+            # diagonal replaced by zeroes
+            if not diagonal and start1 == start2:
+                line[i - start1] = 0
+            yield line.tolist()
+
+
 def _hmm_refine_compartments(xsec, models, bads, verbose):
     prevll = float('-inf')
     prevdf = 0
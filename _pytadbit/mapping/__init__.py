@@ -1,13 +1,15 @@
 from __future__ import print_function
 from itertools                    import combinations
-from os                           import path, system
+from os                           import path, system, remove
 from sys                          import stdout
 from collections                  import OrderedDict
-from multiprocessing              import cpu_count
+from multiprocessing              import cpu_count, Pool
+from heapq                        import merge
 from distutils.version            import LooseVersion
 from subprocess                   import Popen, PIPE
 
 from pytadbit.utils.file_handling import mkdir, magic_open, which
+from pytadbit.parsers.pairs_parser import PairsWriter
 
 
 def eq_reads(rd1, rd2):
@@ -127,7 +129,8 @@ def merge_bams(bam1, bam2, output_bam, cpus = cpu_count(), samtools = 'samtools'
         system(samtools  + ' index %s' % (output_bam))
 
 
-def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
+def get_intersection(fname1, fname2, out_path, verbose=False, compress=False,
+                     pairs=False, ncpus=cpu_count(), max_mem=1000):
     """
     Merges the two files corresponding to each reads sides. Reads found in both
        files are merged and written in an output file.
@@ -150,6 +153,13 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
        the inputs
     :param False compress: compress (gzip) input files. This is done in the
        background while next input files are parsed.
+    :param False pairs: write the output as a block-compressed file of pairs,
+       indexed by genomic position, that can be read by region (see
+       :func:`pytadbit.parsers.pairs_parser.iter_pairs`)
+    :param cpu_count() ncpus: number of temporary files sorted in parallel
+    :param 1000 max_mem: approximate memory (in Mb) used by each of the
+       processes sorting temporary files. Larger files are sorted by parts
+       that are then merged.
 
     :returns: final number of pair of interacting fragments, and a dictionary with
        the number of multiple contacts (keys of the dictionary being the number of
@@ -254,17 +264,23 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
     if verbose:
         print('Sorting each temporary file by genomic coordinate')
 
-    out = open(out_path, 'w')
+    out = PairsWriter(out_path) if pairs else open(out_path, 'w')
     out.write(header1)
-    for b in buf:
+    pool = Pool(ncpus)
+    sorted_files = pool.imap(_sort_tmp_file, [
+        (path.join(tmp_dir, 'rep_%03d' % (b // int(nchunks**0.5)),
+                   'tmp_%05d.tsv' % b), max_mem * 1024**2) for b in buf])
+    # sorted files are concatenated as soon as ready (and in order)
+    for b, fname in enumerate(sorted_files):
         if verbose:
             stdout.write('\r    %4d/%d sorted files' % (b + 1, len(buf)))
             stdout.flush()
-        with open(path.join(tmp_dir, 'rep_%03d' % (b // int(nchunks**0.5)),
-                            'tmp_%05d.tsv' % b)) as f_tmp:
-            out.write(''.join(['\t'.join(l[1:]) for l in sorted(
-                [l.split('\t') for l in f_tmp],
-                key=lambda x: (x[0], x[8], x[9], x[6]))]))
+        with open(fname) as f_tmp:
+            for block in iter(lambda: f_tmp.read(1048576), ''):
+                out.write(block)
+        remove(fname)
+    pool.close()
+    pool.join()
     out.close()
 
     if compress:
@@ -278,6 +294,60 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
     return count, multiples
 
 
+def _sort_key(line):
+    x = line.split('\t', 10)
+    return int(x[0]), x[8], x[9], x[6]
+
+
+def _sorted_lines(fname, part):
+    # part number keeps the sort stable when merging
+    with open(fname) as fhandler:
+        for line in fhandler:
+            yield _sort_key(line), part, line
+
+
+def _sort_tmp_file(args):
+    """
+    Sorts a temporary file of get_intersection by genomic coordinate and
+    removes the first column (index). If the file does not fit in the given
+    memory, it is sorted by parts that are merged afterwards.
+
+    :returns: path to the sorted file
+    """
+    fname, max_mem = args
+    # memory taken by python to store a line is about ten times its length
+    max_size = max_mem // 10
+    parts = []
+    with open(fname) as fhandler:
+        while True:
+            lines = []
+            size = 0
+            for line in fhandler:
+                lines.append(line)
+                size += len(line)
+                if size > max_size:
+                    break
+            if not lines:
+                break
+            lines.sort(key=_sort_key)
+            parts.append('%s_%d' % (fname, len(parts)))
+            with open(parts[-1], 'w') as out:
+                out.writelines(lines)
+            del lines
+    remove(fname)
+    out_name = fname[:-4] + '_sorted.tsv'
+    with open(out_name, 'w') as out:
+        if len(parts) == 1:
+            with open(parts[0]) as fhandler:
+                out.writelines(l.split('\t', 1)[1] for l in fhandler)
+        else:
+            out.writelines(l.split('\t', 1)[1] for _, _, l in merge(
+                *[_sorted_lines(p, i) for i, p in enumerate(parts)]))
+    for part in parts:
+        remove(part)
+    return out_name
+
+
 def _loc_reads(r1, r2):
     """
     Put upstream read before, get position in buf
@@ -5,6 +5,7 @@ from __future__ import print_function
 
 from warnings                     import warn, catch_warnings, simplefilter
 from collections                  import OrderedDict
+from itertools                    import chain
 
 from pysam                        import AlignmentFile
 from scipy.stats                  import norm as sc_norm, skew, kurtosis
@@ -28,7 +29,7 @@ from pytadbit.utils.tadmaths      import nozero_log_matrix as nozero_log
 from pytadbit.utils.tadmaths      import right_double_mad as mad
 from pytadbit.parsers.hic_parser  import load_hic_data_from_reads
 from pytadbit.utils.extraviews    import nicer
-from pytadbit.utils.file_handling import mkdir
+from pytadbit.utils.file_handling import mkdir, magic_open
 
 try:
     basestring
@@ -713,19 +714,15 @@ def fragment_size(fnam, savefig=None, nreads=None, max_size=99.9, axe=None,
     """
     distr = {}
     genome_seq = OrderedDict()
-    pos = 0
-    fhandler = open(fnam)
-    for line in fhandler:
-        if line.startswith('#'):
-            if line.startswith('# CRM '):
-                crm, clen = line[6:].split('\t')
-                genome_seq[crm] = int(clen)
-        else:
-            break
-        pos += len(line)
-    fhandler.seek(pos)
+    fhandler = magic_open(fnam)
+    line = next(fhandler)
+    while line.startswith('#'):
+        if line.startswith('# CRM '):
+            crm, clen = line[6:].split('\t')
+            genome_seq[crm] = int(clen)
+        line = next(fhandler)
     des = []
-    for line in fhandler:
+    for line in chain([line], fhandler):
         (crm1, pos1, dir1, _, re1, _,
          crm2, pos2, dir2, _, re2) = line.strip().split('\t')[1:12]
         if re1 == re2 and crm1 == crm2 and dir1 == '1' and dir2 == '0':
@@ -5,9 +5,17 @@
 """
 from __future__ import print_function
 from builtins   import next
+from itertools  import chain
+from array      import array
+from shutil     import copyfileobj
+import os
 import multiprocessing as mu
 
+import numpy as np
+
 from pytadbit.mapping.restriction_enzymes import count_re_fragments
+from pytadbit.utils.file_handling         import magic_open
+from pytadbit.parsers.pairs_parser        import PairsWriter
 
 
 MASKED = {1 : {'name': 'self-circle'       , 'reads': 0},
@@ -24,7 +32,7 @@ MASKED = {1 : {'name': 'self-circle'       , 'reads': 0},
 
 
 def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
-                 verbose=True):
+                 verbose=True, pairs=False):
     """
     Create a new file with reads filtered
 
@@ -37,6 +45,8 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
     :param False reverse: if set, the resulting outfile will only contain the
        reads filtered, not the valid pairs.
     :param False verbose:
+    :param False pairs: write the output as a compressed and indexed file of
+       pairs (see :class:`pytadbit.parsers.pairs_parser.PairsWriter`)
 
     :returns: number of reads kept
     """
@@ -50,22 +60,19 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
         except StopIteration:
             pass
 
-    out = open(outfile, 'w')
-    fhandler = open(fnam)
+    out = PairsWriter(outfile) if pairs else open(outfile, 'w')
+    fhandler = magic_open(fnam)
     # get the header
-    pos = 0
-    while True:
-        line = next(fhandler)
-        if not line.startswith('#'):
-            break
-        pos += len(line)
+    line = next(fhandler)
+    while line.startswith('#'):
         out.write(line)
-    fhandler.seek(pos)
+        line = next(fhandler)
+    lines = chain([line], fhandler)
 
     current = set([v for v, _ in list(filter_handlers.values())])
     count = 0
     if reverse:
-        for line in fhandler:
+        for line in lines:
             read = line.split('\t', 1)[0]
             if read in current:
                 count += 1
@@ -83,7 +90,7 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
                     del filter_handlers[k]
             current = set([v for v, _ in list(filter_handlers.values())])
     else:
-        for line in fhandler:
+        for line in lines:
             read = line.split('\t', 1)[0]
             if read not in current:
                 count += 1
@@ -111,7 +118,7 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
                  over_represented=0.005, max_frag_size=100000,
                  min_frag_size=100, re_proximity=5, verbose=True,
                  savedata=None, min_dist_to_re=750, strict_duplicates=False,
-                 fast=True):
+                 fast=True, ncpus=None, mask=None):
     """
     Filter mapped pair of reads in order to remove experimental artifacts (e.g.
     dangling-ends, self-circle, PCR artifacts...)
@@ -144,7 +151,8 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
           enzyme activity or random physical breakage of the chromatin.
 
     :param fnam: path to file containing the pair of reads in tsv format, file
-       generated by :func:`pytadbit.mapping.mapper.get_intersection`
+       generated by :func:`pytadbit.mapping.mapper.get_intersection` (can be
+       a compressed file of pairs)
     :param None output: PATH where to write files containing IDs of filtered
        reads. Uses fnam by default.
     :param 500 max_molecule_length: facing reads that are within
@@ -161,7 +169,14 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
        from a RE site (usually 1.5 times the insert size). Applied in filter 10
     :param None savedata: PATH where to write the number of reads retained by
        each filter
-    :param True fast: parallel version, requires 4 CPUs and more RAM memory
+    :param True fast: parallel version, all filters are evaluated in a single
+       pass over the reads, the file being split in chunks processed by
+       ncpus workers (only uncompressed files can be split)
+    :param None ncpus: number of workers used in the fast version (all CPUs
+       by default)
+    :param None mask: PATH where to save, as a NumPy array, the filters
+       catching each read (bit k-1 is set if the read is caught by filter k).
+       Only used in the fast version.
     :param False strict_duplicates: by default reads are considered duplicates if
        they coincide in genomic coordinates and strand; with strict_duplicates
        enabled, we also ask to consider read length (WARNING: this option is
@@ -197,23 +212,11 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
             print('filtering over represented')
         MASKED.update(_filter_over_represented(fnam, over_represented, output))
     else:
-        pool = mu.Pool(4)
-        a = pool.apply_async(_filter_same_frag,
-                             args=(fnam, max_molecule_length, output))
-        b = pool.apply_async(_filter_from_res,
-                             args=(fnam, max_frag_size, min_dist_to_re,
-                                   re_proximity, min_frag_size, output))
-        c = pool.apply_async(_filter_over_represented,
-                             args=(fnam, over_represented, output))
-        d = pool.apply_async(_filter_duplicates,
-                             args=(fnam, output))
-        pool.close()
-        pool.join()
-        sub_mask, total = d.get()
+        sub_mask, total = _filter_single_pass(
+            fnam, output, max_molecule_length, over_represented,
+            max_frag_size, min_frag_size, re_proximity, min_dist_to_re,
+            strict_duplicates, ncpus or mu.cpu_count(), mask)
         MASKED.update(sub_mask)
-        MASKED.update(b.get())
-        MASKED.update(c.get())
-        MASKED.update(a.get())
 
     # if savedata or verbose:
     #     bads = len(frozenset().union(*[masked[k]['reads'] for k in masked]))
@@ -235,6 +238,294 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
     return MASKED
 
 
+def _is_plain_text(fnam):
+    """
+    :returns: True if the file is uncompressed, and can thus be split by byte
+       offsets
+    """
+    with open(fnam, 'rb') as fhandler:
+        start = fhandler.read(4)
+    return not (start.startswith(b'\x1f\x8b\x08') or  # gzip
+                start.startswith(b'\x42\x5a\x68') or  # bz2
+                start.startswith(b'\x50\x4b\x03\x04') or  # zip
+                fnam.endswith('.dsrc'))
+
+
+def _open_bytes(fnam, plain):
+    """
+    :returns: file handler returning lines as bytes
+    """
+    if plain:
+        return open(fnam, 'rb')
+    return (line.encode() for line in magic_open(fnam))
+
+
+def _split_reads_file(fnam, nchunks):
+    """
+    :returns: list of (start, end) byte offsets of chunks of the file, each
+       starting at the beginning of a line (the header is skipped)
+    """
+    fhandler = open(fnam, 'rb')
+    beg = 0
+    for line in iter(fhandler.readline, b''):
+        if not line.startswith(b'#'):
+            break
+        beg += len(line)
+    fhandler.seek(0, 2)
+    size = fhandler.tell()
+    limits = [beg]
+    for i in range(1, nchunks):
+        pos = beg + (size - beg) * i // nchunks
+        if pos <= limits[-1]:
+            continue
+        fhandler.seek(pos - 1)
+        fhandler.readline()  # move to the start of the next line
+        pos = fhandler.tell()
+        if limits[-1] < pos < size:
+            limits.append(pos)
+    fhandler.close()
+    limits.append(size)
+    return list(zip(limits[:-1], limits[1:]))
+
+
+def _previous_line(fhandler, pos):
+    """
+    :returns: the line ending right before a given byte offset
+    """
+    size = 1024
+    while True:
+        beg = max(0, pos - size)
+        fhandler.seek(beg)
+        data = fhandler.read(pos - beg)
+        start = data.rfind(b'\n', 0, len(data) - 1)
+        if start >= 0 or not beg:
+            return data[start + 1:]
+        size *= 2
+
+
+def _filter_chunk(fnam, plain, start, end, chunk, output,
+                  max_molecule_length, max_frag_size, min_frag_size,
+                  re_proximity, min_dist_to_re, strict_duplicates):
+    """
+    Evaluates all filters, except over-represented fragments, on a chunk of
+    the reads file, in a single pass.
+
+    Read IDs caught by each filter are written to one file per filter and
+    chunk, and the bitmask of filters catching each read, the position of each
+    read in the file and the index of its restriction fragments are saved in
+    a NumPy file, to evaluate over-represented fragments once all chunks are
+    done.
+
+    :returns: number of lines in the chunk, the number of reads caught by each
+       filter, and the list of restriction fragments of the chunk with their
+       number of read-ends
+    """
+    masked = dict((k, {'reads': 0}) for k in (1, 2, 3, 4, 5, 6, 7, 9, 10))
+    outfil = {}
+    for k in masked:
+        outfil[k] = open('%s_%s.tsv_%d' % (
+            output, MASKED[k]['name'].replace(' ', '_'), chunk), 'wb')
+    ndup = 8 if strict_duplicates else 6
+    flags = array('H')
+    offsets = array('l')
+    frag_idx = array('l')
+    frags = {}
+    fhandler = _open_bytes(fnam, plain)
+    prev_elts = None
+    if chunk:  # duplicates are compared to the last read of previous chunk
+        line = _previous_line(fhandler, start)
+        (_, cr1, pos1, sd1, l1, _, _, cr2, pos2, sd2, l2, _, _
+         ) = line.split(b'\t')
+        prev_elts = (cr1, pos1, cr2, pos2, sd1, sd2, l1, l2)[:ndup]
+    if plain:
+        fhandler.seek(start)
+    offset = start
+    for line in fhandler:
+        if end is not None and offset >= end:
+            break
+        line_offset = offset
+        offset += len(line)
+        if line.startswith(b'#'):
+            continue
+        (read,
+         cr1, pos1, sd1, l1, rs1, re1,
+         cr2, pos2, sd2, l2, rs2, re2) = line.split(b'\t')
+        flag = 0
+        ps1, ps2, sd1i, sd2i, rs1i, re1i, rs2i, re2i = list(map(int, (
+            pos1, pos2, sd1, sd2, rs1, re1, rs2, re2)))
+        # same fragment filters
+        if cr1 == cr2:
+            if re1 == re2.rstrip():
+                if sd1i != sd2i:
+                    if (ps2 > ps1) == sd2i:
+                        # ----<===---===>---                   self-circles
+                        flag |= 1
+                    else:
+                        # ----===>---<===---                   dangling-ends
+                        flag |= 2
+                else:
+                    # --===>--===>-- or --<===--<===-- or same errors
+                    flag |= 4
+            elif (abs(ps1 - ps2) < max_molecule_length
+                  and sd2i != sd1i
+                  and (ps2 > ps1) != sd2i):
+                # different fragments but facing and very close
+                flag |= 8
+        # restriction sites filters
+        diff11 = re1i - ps1
+        diff12 = ps1 - rs1i
+        diff21 = re2i - ps2
+        diff22 = ps2 - rs2i
+        if ((diff11 < re_proximity) or
+            (diff12 < re_proximity) or
+            (diff21 < re_proximity) or
+            (diff22 < re_proximity)):
+            # multicontacts excluded if fragment is internal (not the first)
+            if not b'~' in read:
+                flag |= 16
+        # random breaks
+        if (((diff11 > min_dist_to_re) and
+             (diff12 > min_dist_to_re)) or
+            ((diff21 > min_dist_to_re) and
+             (diff22 > min_dist_to_re))):
+            flag |= 512
+        dif1 = re1i - rs1i
+        dif2 = re2i - rs2i
+        if (dif1 < min_frag_size) or (dif2 < min_frag_size):
+            flag |= 32
+        if (dif1 > max_frag_size) or (dif2 > max_frag_size):
+            flag |= 64
+        # duplicates
+        new_elts = (cr1, pos1, cr2, pos2, sd1, sd2, l1, l2)[:ndup]
+        if prev_elts == new_elts:
+            flag |= 256
+        prev_elts = new_elts
+        # fragments, for the over-represented filter
+        for frag in ((cr1, rs1), (cr2, rs2)):
+            try:
+                frag_idx.append(frags[frag])
+            except KeyError:
+                frag_idx.append(frags.setdefault(frag, len(frags)))
+        flags.append(flag)
+        offsets.append(line_offset)
+        if flag:
+            for k in masked:
+                if flag & (1 << (k - 1)):
+                    masked[k]['reads'] += 1
+                    outfil[k].write(read + b'\n')
+    fhandler.close()
+    for k in masked:
+        outfil[k].close()
+    frag_idx = np.frombuffer(frag_idx, dtype=np.dtype(frag_idx.typecode))
+    np.savez('%s_chunk_%d.npz' % (output, chunk),
+             flags=np.frombuffer(flags, dtype=np.uint16),
+             offsets=np.frombuffer(offsets, dtype=np.dtype(offsets.typecode)),
+             frag1=frag_idx[::2], frag2=frag_idx[1::2])
+    frag_count = [0] * len(frags)
+    for i in frag_idx.tolist():
+        frag_count[i] += 1
+    return len(flags), masked, sorted(frags, key=frags.get), frag_count
+
+
+def _filter_over_represented_chunk(fnam, plain, chunk, output, over):
+    """
+    Evaluates the over-represented fragments filter on a chunk of the reads
+    file, from the arrays saved by :func:`_filter_chunk`.
+
+    :param over: boolean array, with for each restriction fragment of the
+       chunk, whether it is over-represented
+
+    :returns: number of reads caught by the filter
+    """
+    data = np.load('%s_chunk_%d.npz' % (output, chunk))
+    flags = data['flags'].copy()
+    offsets = data['offsets']
+    caught = over[data['frag1']] | over[data['frag2']]
+    flags[caught] |= 128
+    np.save('%s_chunk_%d.npy' % (output, chunk), flags)
+    out = open('%s_%s.tsv_%d' % (
+        output, MASKED[8]['name'].replace(' ', '_'), chunk), 'wb')
+    fhandler = _open_bytes(fnam, plain)
+    if plain:
+        for pos in offsets[caught].tolist():
+            fhandler.seek(pos)
+            out.write(fhandler.readline().split(b'\t', 1)[0] + b'\n')
+    elif caught.any():
+        wanted = set(offsets[caught].tolist())
+        offset = 0
+        for line in fhandler:
+            if offset in wanted:
+                out.write(line.split(b'\t', 1)[0] + b'\n')
+            offset += len(line)
+    fhandler.close()
+    out.close()
+    data.close()
+    os.remove('%s_chunk_%d.npz' % (output, chunk))
+    return int(caught.sum())
+
+
+def _filter_single_pass(fnam, output, max_molecule_length, over_represented,
+                        max_frag_size, min_frag_size, re_proximity,
+                        min_dist_to_re, strict_duplicates, ncpus, mask=None):
+    """
+    Evaluates all filters reading the file of reads only once, splitting it
+    in chunks processed in parallel. Results are identical to the ones of the
+    individual filter functions.
+
+    :returns: the dictionary of masked reads (as filter_reads) and the total
+       number of reads
+    """
+    plain = _is_plain_text(fnam)
+    chunks = _split_reads_file(fnam, ncpus) if plain else [(0, None)]
+    pool = mu.Pool(min(ncpus, len(chunks)))
+    procs = [pool.apply_async(_filter_chunk, args=(
+        fnam, plain, start, end, chunk, output, max_molecule_length,
+        max_frag_size, min_frag_size, re_proximity, min_dist_to_re,
+        strict_duplicates)) for chunk, (start, end) in enumerate(chunks)]
+    results = [proc.get() for proc in procs]
+    # over-represented fragments, from the counts of all chunks
+    frag_count = {}
+    for _, _, frags, counts in results:
+        for frag, count in zip(frags, counts):
+            frag_count[frag] = frag_count.get(frag, 0) + count
+    cut = int((1 - over_represented) * len(frag_count) + 0.5)
+    # use cut-1 because it represents the length of the list
+    cut = sorted(frag_count.values())[cut - 1]
+    procs = [pool.apply_async(_filter_over_represented_chunk, args=(
+        fnam, plain, chunk, output,
+        np.array([frag_count[f] > cut for f in frags], dtype=bool)))
+             for chunk, (_, _, frags, _) in enumerate(results)]
+    over_counts = [proc.get() for proc in procs]
+    pool.close()
+    pool.join()
+    # merge chunks
+    masked = {}
+    for k in (1, 2, 3, 4, 5, 6, 7, 8, 9, 10):
+        masked[k] = {'name': MASKED[k]['name'], 'reads': 0,
+                     'fnam': (output + '_' +
+                              MASKED[k]['name'].replace(' ', '_') + '.tsv')}
+        out = open(masked[k]['fnam'], 'wb')
+        for chunk in range(len(chunks)):
+            fnam_chunk = '%s_%d' % (masked[k]['fnam'], chunk)
+            with open(fnam_chunk, 'rb') as fhandler:
+                copyfileobj(fhandler, out)
+            os.remove(fnam_chunk)
+        out.close()
+    for chunk, (_, sub_mask, _, _) in enumerate(results):
+        for k in sub_mask:
+            masked[k]['reads'] += sub_mask[k]['reads']
+        masked[8]['reads'] += over_counts[chunk]
+    flags = [np.load('%s_chunk_%d.npy' % (output, chunk))
+             for chunk in range(len(chunks))]
+    for chunk in range(len(chunks)):
+        os.remove('%s_chunk_%d.npy' % (output, chunk))
+    if mask:
+        np.save(mask, np.concatenate(flags))
+    # the first read is not counted, as in the duplicates filters
+    total = sum(nlines for nlines, _, _, _ in results) - 1
+    return masked, total
+
+
 def _filter_same_frag(fnam, max_molecule_length, output):
     # t0 = time()
     masked = {1 : {'name': 'self-circle'       , 'reads': 0},
@@ -245,7 +536,7 @@ def _filter_same_frag(fnam, max_molecule_length, output):
     for k in masked:
         masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
+    fhandler = magic_open(fnam)
     line = next(fhandler)
     while line.startswith('#'):
         line = next(fhandler)
@@ -294,7 +585,7 @@ def _filter_duplicates_strict(fnam, output):
     for k in masked:
         masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
+    fhandler = magic_open(fnam)
     line = next(fhandler)
     while line.startswith('#'):
         line = next(fhandler)
@@ -327,7 +618,7 @@ def _filter_duplicates_loose(fnam, output):
     for k in masked:
         masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
+    fhandler = magic_open(fnam)
     line = next(fhandler)
     while line.startswith('#'):
         line = next(fhandler)
@@ -364,7 +655,7 @@ def _filter_from_res(fnam, max_frag_size, min_dist_to_re,
     for k in masked:
         masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
+    fhandler = magic_open(fnam)
     line = next(fhandler)
     while line.startswith('#'):
         line = next(fhandler)
@@ -424,7 +715,7 @@ def _filter_over_represented(fnam, over_represented, output):
     for k in masked:
         masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
+    fhandler = magic_open(fnam)
     line = next(fhandler)
     while line.startswith('#'):
         line = next(fhandler)
@@ -462,7 +753,7 @@ def _filter_yannick(fnam, maxlen, de_left, de_right, output):
     for k in masked:
         masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
+    fhandler = magic_open(fnam)
     line = next(fhandler)
     while line.startswith('#'):
         line = next(fhandler)
@@ -6,8 +6,12 @@ from builtins   import next
 
 import os
 import re
-import copy
 import multiprocessing  as mu
+from multiprocessing.dummy import Pool as ThreadPool
+from stat import S_ISFIFO
+from collections import deque
+from itertools import chain, islice
+from functools import partial
 from warnings import warn
 from tempfile import gettempdir, mkstemp
 from subprocess import CalledProcessError, PIPE, STDOUT, Popen
@@ -18,7 +22,7 @@ from pytadbit.utils.file_handling import magic_open, get_free_space_mb
 from pytadbit.parsers.sam_parser import parse_gem_3c, merge_sort
 from pytadbit.mapping.restriction_enzymes import religateds
 from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import map_re_sites_array
 from pytadbit.mapping.restriction_enzymes import iupac2regex
 
 try:
@@ -28,7 +32,7 @@ except NameError:
 
 def transform_fastq(fastq_path, out_fastq, trim=None, r_enz=None, add_site=True,
                     min_seq_len=15, fastq=True, verbose=True,
-                    light_storage=False, **kwargs):
+                    light_storage=False, pipe=None, **kwargs):
     """
     Given a FASTQ file it can split it into chunks of a given number of reads,
     trim each read according to a start/end positions or split them into
@@ -36,54 +40,169 @@ def transform_fastq(fastq_path, out_fastq, trim=None, r_enz=None, add_site=True,
 
     :param True add_site: when splitting the sequence by ligated sites found,
        removes the ligation site, and put back the original RE site.
+    :param None pipe: file handler (e.g. the standard input of the mapper)
+       where to write the transformed reads, in addition to the output file
+    :param 1 nthreads: number of processes transforming blocks of reads in
+       parallel
 
     """
     skip = kwargs.get('skip', False)
-    ## define local functions to process reads and sequences
-    def _get_fastq_read_heavy(rlines):
-        """
-        returns header and sequence of 1 FASTQ entry
-        Note: header also contains the sequence
-        """
-        rlines = rlines.rstrip('\n').split()[0][1:]
-        seq = next(fhandler)
-        _   = next(fhandler)  # lose qualities header but not needed
-        qal = next(fhandler)  # lose qualities but not needed
-        # header now also contains original read
-        return (rlines.split('/',1)[0].split('~',1)[0] + ' ' + seq.strip() + ' ' + qal.strip(),
-                seq.strip(), qal.strip())
-
-    def _get_fastq_read_light(rlines):
-        """
-        returns header and sequence of 1 FASTQ entry
-        Note: header also contains the sequence
-        """
-        rlines = rlines.rstrip('\n').split()[0][1:]
-        seq = next(fhandler)
-        _   = next(fhandler)  # lose qualities header but not needed
-        qal = next(fhandler)  # lose qualities but not needed
-        return (rlines.split('/',1)[0].split('~',1)[0], seq.strip(), qal.strip())
-
-    def _get_map_read_heavy(line):
-        header = line.split('\t', 1)[0]
-        seq, qal    = header.rsplit(' ', 2)[-2:]
-        return header, seq, qal
+    nthreads = kwargs.get('nthreads') or 1
+    transformer = _ReadTransformer(trim=trim, r_enz=r_enz, add_site=add_site,
+                                   min_seq_len=min_seq_len, fastq=fastq,
+                                   light_storage=light_storage)
+    if transformer.r_enzs:
+        r_enzs = transformer.r_enzs
+        enzymes = dict((r_enz, RESTRICTION_ENZYMES[r_enz].replace('|', ''))
+                       for r_enz in r_enzs)
+        enz_patterns = religateds(r_enzs)
+        print('  - splitting into restriction enzyme (RE) fragments using ligation sites')
+        print('  - ligation sites are replaced by RE sites to match the reference genome')
+        for r_enz1 in r_enzs:
+            for r_enz2 in r_enzs:
+                print('    * enzymes: %s & %s, ligation site: %s, RE site: %s & %s' % (
+                    r_enz1, r_enz2, enz_patterns[(r_enz1, r_enz2)],
+                    enzymes[r_enz1], enzymes[r_enz2]))
 
-    def _get_map_read_light(line):
-        header, seq, qal, _ = line.split('\t', 3)
-        return header, seq, qal
+    ## Start processing the input file
+    if verbose:
+        print('Preparing %s file' % ('FASTQ' if fastq else 'MAP'))
+        if fastq:
+            print('  - conversion to MAP format')
+        if trim:
+            print('  - trimming reads %d-%d' % tuple(trim))
+    counter = 0
+    if skip:
+        if fastq:
+            print('    ... skipping, only counting lines')
+            counter = sum(1 for _ in magic_open(fastq_path,
+                                                cpus=kwargs.get('nthreads')))
+            counter /= 4 if fastq else 1
+            print('            ' + fastq_path, counter, fastq)
+        return out_fastq, counter
+    # open input file (named pipes can not be inspected before reading them)
+    if isinstance(fastq_path, basestring) and S_ISFIFO(os.stat(fastq_path).st_mode):
+        fhandler = open(fastq_path)
+    else:
+        fhandler = magic_open(fastq_path, cpus=kwargs.get('nthreads'))
+    # create output file
+    out_name = out_fastq
+    out = open(out_fastq, 'w')
+    # blocks of reads are transformed in parallel, and written in order
+    nlines = 4 if fastq else 1
+    if nthreads > 1:
+        pool = mu.Pool(nthreads)
+        run = lambda block: pool.apply_async(transformer, (block, ))
+    else:
+        pool = None
+        run = lambda block: _TransformedBlock(transformer(block))
+    pending = deque()
+    while True:
+        block = list(islice(fhandler, 100000 * nlines))
+        if not block:
+            break
+        counter += len(block) // nlines
+        pending.append(run(block))
+        # limit the number of blocks in memory
+        while len(pending) > 2 * nthreads or (pending and pending[0].ready()):
+            reads = pending.popleft().get()
+            out.write(reads)
+            if pipe:
+                # reads need to be in the output file before being mapped
+                out.flush()
+                pipe.write(reads)
+    for result in pending:
+        reads = result.get()
+        out.write(reads)
+        if pipe:
+            out.flush()
+            pipe.write(reads)
+    if pool:
+        pool.close()
+        pool.join()
+    fhandler.close()
+    out.close()
+    return out_name, counter
 
-    def _inverse_find(seq, pat):
-        try:
-            return pat.search(seq).start()
-        except AttributeError:
-            return float('inf')
 
-    def find_patterns(seq, patterns):
-        pos, pat = min((_inverse_find(seq, patterns[p]), p) for p in patterns)
-        return int(pos), pat
+class _TransformedBlock(object):
+    """
+    Block of reads transformed in the current process (same interface as the
+    results of multiprocessing apply_async)
+    """
+    def __init__(self, reads):
+        self.reads = reads
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.reads
+
+
+class _ReadTransformer(object):
+    """
+    Trims reads and splits them into restriction enzyme fragments. Called with
+    a list of lines from a FASTQ (or MAP) file, returns the transformed reads
+    in FASTQ format.
+    """
+    def __init__(self, trim=None, r_enz=None, add_site=True, min_seq_len=15,
+                 fastq=True, light_storage=False):
+        self.min_seq_len = min_seq_len
+        self.fastq = fastq
+        self.light_storage = light_storage
+        # region of the read to keep
+        if isinstance(trim, tuple):
+            self.trim = trim[0] - 1, trim[1]
+        else:
+            self.trim = None
+        if isinstance(r_enz, basestring):
+            self.r_enzs = [r_enz]
+        elif isinstance(r_enz, list):
+            self.r_enzs = r_enz
+        else:
+            self.r_enzs = None
+        if not self.r_enzs:
+            return
+        enzymes = dict((r_enz, RESTRICTION_ENZYMES[r_enz].replace('|', ''))
+                       for r_enz in self.r_enzs)
+        enz_patterns = religateds(self.r_enzs)
+        self.len_relgs = dict((ezp, len(enz_patterns[ezp]))
+                              for ezp in enz_patterns)
+        # all ligation sites are searched at once with a single regexp (IUPAC
+        # annotation supported), the most upstream is used and, if several
+        # start at the same position, the first in order of enzyme names
+        self.ligations = sorted(enz_patterns)
+        self.enz_pattern = re.compile('|'.join(
+            '(%s)' % iupac2regex(enz_patterns[ezp]) for ezp in self.ligations))
+        # half ligation sites are not searched
+        self.sub_enz_pattern = None
+        self.no_site = dict([(r_enz, '') for r_enz in enzymes])
+        self.site = enzymes if add_site else self.no_site
+
+    def _get_read(self, lines):
+        """
+        returns header, sequence and quality of 1 FASTQ (or MAP) entry
+        Note: in heavy storage the header also contains the sequence
+        """
+        if self.fastq:
+            header, seq, _, qal = lines
+            header = header.rstrip('\n').split()[0][1:]
+            header = header.split('/',1)[0].split('~',1)[0]
+            seq = seq.strip()
+            qal = qal.strip()
+            if not self.light_storage:
+                # header now also contains original read
+                header = header + ' ' + seq + ' ' + qal
+            return header, seq, qal
+        if self.light_storage:
+            header, seq, qal, _ = lines[0].split('\t', 3)
+            return header, seq, qal
+        header = lines[0].split('\t', 1)[0]
+        seq, qal = header.rsplit(' ', 2)[-2:]
+        return header, seq, qal
 
-    def _split_read_re(seq, qal, patterns, site, max_seq_len=None, cnt=0):
+    def _split_read(self, seq, qal, pattern, site, max_seq_len, cnt=0):
         """
         Recursive generator that splits reads according to the
         predefined restriction enzyme.
@@ -108,153 +227,74 @@ def transform_fastq(fastq_path, out_fastq, trim=None, r_enz=None, add_site=True,
 
         :param seq: sequence of the read fragment
         :param qal: quality of the sequence of the read fragment
-        :param patterns: list of patterns of the ligated cut sites
-        :param None max_seq_len: to control that all reads are bellow this
+        :param pattern: compiled regexp of the ligated cut sites
+        :param site: non-ligated cut site to replace ligation site
+        :param max_seq_len: to control that all reads are bellow this
            length
-        :param '' site: non-ligated cut site to replace ligation site
         :param 0 cnt: to count number of fragments
 
         :yields: seq fragments, their qualities and their count, or index
            (higher than 0 if ligation sites are found)
         """
         cnt += 1
-        try:
-            pos, (r_enz1, r_enz2) = find_patterns(seq, patterns)
-        except OverflowError:
+        match = pattern.search(seq) if pattern else None
+        if not match:
             if len(seq) == max_seq_len:
                 raise ValueError
-            if len(seq) > min_seq_len:
+            if len(seq) > self.min_seq_len:
                 yield seq, qal, cnt
             return
+        pos = match.start()
+        r_enz1, r_enz2 = self.ligations[match.lastindex - 1]
         # add quality before corresponding to the space occupied by the cut-site
-        xqal1 = ('H' * len(site[r_enz1]))
-        xqal2 = ('H' * len(site[r_enz2]))
-        if pos < min_seq_len:
-            split_read(site[r_enz2] + seq[pos + len_relgs[(r_enz1, r_enz2)]:],
-                       xqal2        + qal[pos + len_relgs[(r_enz1, r_enz2)]:],
-                       patterns, no_site, max_seq_len, cnt=cnt)
-        else:
-            yield seq[:pos] + site[r_enz1], qal[:pos] + xqal1, cnt
-        new_pos = pos + len_relgs[(r_enz1, r_enz2)]
-        for sseq, sqal, cnt in split_read(site[r_enz2] + seq[new_pos:],
-                                          xqal2 + qal[new_pos:], patterns,
-                                          site, max_seq_len, cnt=cnt):
+        if pos >= self.min_seq_len:
+            yield (seq[:pos] + site[r_enz1],
+                   qal[:pos] + 'H' * len(site[r_enz1]), cnt)
+        new_pos = pos + self.len_relgs[(r_enz1, r_enz2)]
+        for sseq, sqal, cnt in self._split_read(
+                site[r_enz2] + seq[new_pos:],
+                'H' * len(site[r_enz2]) + qal[new_pos:], pattern, site,
+                max_seq_len, cnt=cnt):
             yield sseq, sqal, cnt
 
-    # Define function for stripping lines according to focus
-    if isinstance(trim, tuple):
-        beg, end = trim
-        beg -= 1
-        strip_line = lambda x: x[beg:end]
-    else:
-        strip_line = lambda x: x
-
-    # define function to split reads according to restriction enzyme sites
-    if isinstance(r_enz, basestring):
-        r_enzs = [r_enz]
-    elif isinstance(r_enz, list):
-        r_enzs = r_enz
-    else:
-        r_enzs = None
-
-    if r_enzs:
-        enzymes = {}
-        enz_patterns = {}
-        for r_enz in r_enzs:
-            enzymes[r_enz] = RESTRICTION_ENZYMES[r_enz].replace('|', '')
-        enz_patterns = religateds(r_enzs)
-        sub_enz_patterns = {}
-        len_relgs = {}
-        for r_enz1, r_enz2 in enz_patterns:
-            sub_enz_patterns[(r_enz1, r_enz2)] = (
-                enz_patterns[(r_enz1, r_enz2)][:len(enz_patterns[(r_enz1, r_enz2)])
-                                               // 2])
-            len_relgs[(r_enz1, r_enz2)] = len(enz_patterns[(r_enz1, r_enz2)])
-        print('  - splitting into restriction enzyme (RE) fragments using ligation sites')
-        print('  - ligation sites are replaced by RE sites to match the reference genome')
-        for r_enz1 in r_enzs:
-            for r_enz2 in r_enzs:
-                print('    * enzymes: %s & %s, ligation site: %s, RE site: %s & %s' % (
-                    r_enz1, r_enz2, enz_patterns[(r_enz1, r_enz2)],
-                    enzymes[r_enz1], enzymes[r_enz2]))
-        # replace pattern with regex to support IUPAC annotation
-        for ezp in enz_patterns:
-            enz_patterns[ezp] = re.compile(iupac2regex(enz_patterns[ezp]))
-        for ezp in sub_enz_patterns:
-            sub_enz_patterns[ezp] = iupac2regex(sub_enz_patterns[ezp])
-        split_read = _split_read_re
-    else:
-        enzymes = ''
-        enz_patterns = ''
-        sub_enz_patterns = ''
-        split_read = lambda x, y, z, after_z, after_after_z: (yield x, y , 1)
-
-    # function to yield reads from input file
-    if light_storage:
-        get_seq = _get_fastq_read_light if fastq else _get_map_read_light
-        insert_mark = insert_mark_light
-    else:
-        get_seq = _get_fastq_read_heavy if fastq else _get_map_read_heavy
-        insert_mark = insert_mark_heavy
-
-    ## Start processing the input file
-    if verbose:
-        print('Preparing %s file' % ('FASTQ' if fastq else 'MAP'))
-        if fastq:
-            print('  - conversion to MAP format')
-        if trim:
-            print('  - trimming reads %d-%d' % tuple(trim))
-    counter = 0
-    if skip:
-        if fastq:
-            print('    ... skipping, only counting lines')
-            counter = sum(1 for _ in magic_open(fastq_path,
-                                                cpus=kwargs.get('nthreads')))
-            counter /= 4 if fastq else 1
-            print('            ' + fastq_path, counter, fastq)
-        return out_fastq, counter
-    # open input file
-    fhandler = magic_open(fastq_path, cpus=kwargs.get('nthreads'))
-    # create output file
-    out_name = out_fastq
-    out = open(out_fastq, 'w')
-    # iterate over reads and strip them
-    no_site = dict([(r_enz, '') for r_enz in enzymes])
-    site = enzymes if add_site else no_site
-    for header in fhandler:
-        header, seq, qal = get_seq(header)
-        counter += 1
-        # trim on wanted region of the read
-        seq = strip_line(seq)
-        qal = strip_line(qal)
-        # get the generator of restriction enzyme fragments
-        iter_frags = split_read(seq, qal, enz_patterns, site, len(seq))
-        # the first fragment should not be preceded by the RE site
-        try:
-            seq, qal, cnt = next(iter_frags)
-        except StopIteration:
-            # read full of ligation events, fragments not reaching minimum
-            continue
-        except ValueError:
-            # or not ligation site found, in which case we try with half
-            # ligation site in case there was a sequencing error (half ligation
-            # site is a RE site or nearly, and thus should not be found anyway)
-            iter_frags = split_read(seq, qal, sub_enz_patterns, no_site, len(seq))
-            try:
-                seq, qal, cnt = next(iter_frags)
-            except ValueError:
+    def __call__(self, lines):
+        insert_mark = insert_mark_light if self.light_storage else insert_mark_heavy
+        nlines = 4 if self.fastq else 1
+        out = []
+        for i in range(0, len(lines), nlines):
+            header, seq, qal = self._get_read(lines[i:i + nlines])
+            # trim on wanted region of the read
+            if self.trim:
+                seq = seq[self.trim[0]:self.trim[1]]
+                qal = qal[self.trim[0]:self.trim[1]]
+            if not self.r_enzs:
+                out.append('@%s\n%s\n+\n%s\n' % (header, seq, qal))
                 continue
+            # get the generator of restriction enzyme fragments
+            iter_frags = self._split_read(seq, qal, self.enz_pattern,
+                                          self.site, len(seq))
+            # the first fragment should not be preceded by the RE site
+            try:
+                frag = next(iter_frags)
             except StopIteration:
+                # read full of ligation events, fragments not reaching minimum
                 continue
-        out.write(_map2fastq('\t'.join((insert_mark(header, cnt),
-                                        seq, qal, '0', '-\n'))))
-        # the next fragments should be preceded by the RE site
-        # continue
-        for seq, qal, cnt in  iter_frags:
-            out.write(_map2fastq('\t'.join((insert_mark(header, cnt),
-                                            seq, qal, '0', '-\n'))))
-    out.close()
-    return out_name, counter
+            except ValueError:
+                # or not ligation site found, in which case we try with half
+                # ligation site in case there was a sequencing error (half
+                # ligation site is a RE site or nearly, and thus should not be
+                # found anyway)
+                iter_frags = self._split_read(seq, qal, self.sub_enz_pattern,
+                                              self.no_site, len(seq))
+                try:
+                    frag = next(iter_frags)
+                except (ValueError, StopIteration):
+                    continue
+            # the next fragments should be preceded by the RE site
+            for seq, qal, cnt in chain([frag], iter_frags):
+                out.append('@%s\n%s\n+\n%s\n' % (insert_mark(header, cnt),
+                                                 seq, qal))
+        return ''.join(out)
 
 
 def insert_mark_heavy(header, num):
@@ -325,7 +365,13 @@ def _gem_filter(fnam, unmap_out, map_out):
        - GEM unique-maps can not be used as it gets rid of reads like 1:0:0:5
        - not feasible with gt.filter
     """
-    fhandler = magic_open(fnam) if isinstance(fnam, basestring) else fnam
+    if not isinstance(fnam, basestring):
+        fhandler = fnam
+    elif S_ISFIFO(os.stat(fnam).st_mode):
+        # named pipes can not be inspected before reading them
+        fhandler = open(fnam)
+    else:
+        fhandler = magic_open(fnam)
     unmap_out = open(unmap_out, 'w')
     map_out   = open(map_out  , 'w')
     def _strip_read_name(line):
@@ -355,9 +401,13 @@ def _gem_filter(fnam, unmap_out, map_out):
     map_out.close()
 
 def _bowtie2_mapping(bowtie2_index_path, fastq_path1, out_map_path, fastq_path2 = None,
-                     bowtie2_binary='bowtie2', bowtie2_params=None, **kwargs):
+                     bowtie2_binary='bowtie2', bowtie2_params=None, feed=None,
+                     **kwargs):
     """
-    
+    :param None feed: function writing the reads into the standard input of
+       the mapper (instead of reading them from fastq_path1)
+
+    :returns: the value returned by feed
     """
     bowtie2_index_path= os.path.abspath(os.path.expanduser(bowtie2_index_path))
     fastq_path1       = os.path.abspath(os.path.expanduser(fastq_path1))
@@ -383,7 +433,7 @@ def _bowtie2_mapping(bowtie2_index_path, fastq_path1, out_map_path, fastq_path2
     if paired_map:
         bowtie2_cmd += ['-1',fastq_path1,'-2',fastq_path2]
     else:
-        bowtie2_cmd += ['-U', fastq_path1]
+        bowtie2_cmd += ['-U', '-' if feed else fastq_path1]
 
     if bowtie2_params:
         if isinstance(bowtie2_params, dict):
@@ -396,24 +446,90 @@ def _bowtie2_mapping(bowtie2_index_path, fastq_path1, out_map_path, fastq_path2
     elif bowtie2_binary == 'bowtie2':
         bowtie2_cmd.append('--very-sensitive')
     print(' '.join(bowtie2_cmd))
+    return _run_mapper(bowtie2_cmd, feed)
+
+
+def _run_mapper(cmd, feed=None):
+    """
+    Runs the mapper command. If feed is given, it is called with the standard
+    input of the mapper, where it writes the reads while they are mapped.
+
+    :returns: the value returned by feed
+    """
+    if not feed:
+        try:
+            # check_call(gem_cmd, stdout=PIPE, stderr=PIPE)
+            out, err = Popen(cmd, stdout=PIPE, stderr=PIPE,
+                             universal_newlines=True).communicate()
+        except CalledProcessError as e:
+            print(out)
+            print(err)
+            raise Exception(e.output)
+        return None
+    # mapper messages are discarded (as above), not piped, to avoid blocking
+    with open(os.devnull, 'w') as devnull:
+        proc = Popen(cmd, stdin=PIPE, stdout=devnull, stderr=devnull,
+                     universal_newlines=True)
+        try:
+            result = feed(proc.stdin)
+            proc.stdin.close()
+        except IOError:
+            # the mapper stopped reading its input, most likely it failed
+            if proc.wait():
+                raise Exception('ERROR: mapping failed:\n' + ' '.join(cmd))
+            raise
+        proc.wait()
+    if proc.returncode:
+        raise Exception('ERROR: mapping failed:\n' + ' '.join(cmd))
+    return result
+
+
+def _feed_mapper(transform, pipe):
+    return transform(pipe=pipe)
+
+
+def _wait_results(results):
+    """
+    Waits for a list of asynchronous results, raising the first error found
+    as soon as it occurs (other steps may never end otherwise)
+    """
+    while results:
+        for result in results:
+            if result.ready():
+                result.get()
+        results = [result for result in results if not result.ready()]
+        if results:
+            results[0].wait(0.1)
+
+
+def _release_fifo(fifo):
+    """
+    Opens both ends of a named pipe, to release the steps waiting to open it
+    (readers get an end of file, writers a broken pipe), and removes it
+    """
+    for flags in (os.O_RDONLY, os.O_WRONLY):
+        try:
+            os.close(os.open(fifo, flags | os.O_NONBLOCK))
+        except OSError:
+            pass
     try:
-        # check_call(gem_cmd, stdout=PIPE, stderr=PIPE)
-        out, err = Popen(bowtie2_cmd, stdout=PIPE, stderr=PIPE,
-                         universal_newlines=True).communicate()
-    except CalledProcessError as e:
-        print(out)
-        print(err)
-        raise Exception(e.output)
+        os.remove(fifo)
+    except OSError:
+        pass
 
 
 def _gem_mapping(gem_index_path, fastq_path, out_map_path, fastq_path2 = None,
                  r_enz=None, gem_binary='gem-mapper', gem_version=2, compress=False,
-                 gem_params=None, **kwargs):
+                 gem_params=None, feed=None, **kwargs):
     """
     :param None focus: trims the sequence in the input FASTQ file according to a
        (start, end) position, or the name of a restriction enzyme. By default it
        uses the full sequence.
     :param 33 quality: set it to 'ignore' in order to speed-up the mapping
+    :param None feed: function writing the reads into the standard input of
+       the mapper (instead of reading them from fastq_path)
+
+    :returns: the value returned by feed
     """
     gem_index_path    = os.path.abspath(os.path.expanduser(gem_index_path))
     fastq_path        = os.path.abspath(os.path.expanduser(fastq_path))
@@ -446,8 +562,9 @@ def _gem_mapping(gem_index_path, fastq_path, out_map_path, fastq_path2 = None,
             '--max-extensions-per-match', kgt('max-extensions-per-match', '1'     ),
             '-e'                        , kgt('e', str(mismatches)                ),
             '-T'                        , str(nthreads),
-            '-i'                        , fastq_path,
             '-o', out_map_path.replace('.map', '')]
+        if not feed:
+            gem_cmd += ['-i', fastq_path]
 
         if 'paired-end-alignment' in kwargs or 'p' in kwargs:
             gem_cmd.append('--paired-end-alignment')
@@ -493,7 +610,7 @@ def _gem_mapping(gem_index_path, fastq_path, out_map_path, fastq_path2 = None,
             elif isinstance(r_enz, list):
                 for r_z in r_enz:
                     gem_cmd += ['--restriction-enzyme', r_z]
-        else:
+        elif not feed:
             gem_cmd += ['-i', fastq_path]
         if gem_params:
             if isinstance(gem_params, dict):
@@ -504,20 +621,14 @@ def _gem_mapping(gem_index_path, fastq_path, out_map_path, fastq_path2 = None,
             elif isinstance(gem_params, list):
                  gem_cmd += gem_params
     print(' '.join(gem_cmd))
-    try:
-        # check_call(gem_cmd, stdout=PIPE, stderr=PIPE)
-        out, err = Popen(gem_cmd, stdout=PIPE, stderr=PIPE,
-                         universal_newlines=True).communicate()
-    except CalledProcessError as e:
-        print(out)
-        print(err)
-        raise Exception(e.output)
+    return _run_mapper(gem_cmd, feed)
 
 
 def full_mapping(mapper_index_path, fastq_path, out_map_dir, mapper='gem',
                  r_enz=None, frag_map=True, min_seq_len=15, windows=None,
                  add_site=True, clean=False, get_nread=False,
-                 mapper_binary=None, mapper_params=None, **kwargs):
+                 mapper_binary=None, mapper_params=None, stream=False,
+                 pipeline=False, **kwargs):
     """
     Maps FASTQ reads to an indexed reference genome. Mapping can be done either
     without knowledge of the restriction enzyme used, or for experiments
@@ -556,6 +667,15 @@ def full_mapping(mapper_index_path, fastq_path, out_map_dir, mapper='gem',
        a path and the number of reads processed
     :param gem-mapper mapper_binary: path to the binary mapper
     :param None mapper_params: extra parameters for the mapper
+    :param False stream: transform the reads (trimming or splitting into RE
+       fragments) while they are mapped, writing them directly into the
+       standard input of the mapper. The transformed reads are still stored
+       in temp_dir, as they are needed to filter the mapped reads.
+    :param False pipeline: run all the mapping steps at the same time, the
+       reads left unmapped by one window being streamed, through named pipes,
+       into the mapping of the next window (or into the fragment based
+       mapping). Implies stream, and neither the output of the mapper nor the
+       unmapped reads are stored in temp_dir.
 
     :returns: a list of paths to generated outfiles. To be passed to
        :func:`pytadbit.parsers.map_parser.parse_map`
@@ -619,130 +739,206 @@ def full_mapping(mapper_index_path, fastq_path, out_map_dir, mapper='gem',
         # in this case we will need to keep the information about original
         # sequence at any point, light storage is thus not possible.
         light_storage = False
-    for win in windows:
-        # Prepare the FASTQ file and iterate over them
-        curr_map, counter = transform_fastq(
-            input_reads, mkstemp(prefix=base_name + '_', dir=temp_dir)[1],
-            fastq=is_fastq(input_reads),
-            min_seq_len=min_seq_len, trim=win, skip=skip, nthreads=nthreads,
-            light_storage=light_storage)
-        # clean
-        if input_reads != fastq_path and clean:
-            print('   x removing original input %s' % input_reads)
-            os.system('rm -f %s' % (input_reads))
-        # First mapping, full length
-        if not win:
-            beg, end = 1, 'end'
-        else:
-            beg, end = win
-        out_map_path = curr_map + '_full_%s-%s%s.map' % (beg, end, suffix)
-        if end:
-            print('Mapping reads in window %s-%s%s...' % (beg, end, suffix))
-        else:
-            print('Mapping full reads...', curr_map)
-
-        if not skip:
-            if mapper == 'gem':
-                _gem_mapping(mapper_index_path, curr_map, out_map_path,
-                             gem_binary=gem_binary, gem_version=gem_version,
-                             gem_params=mapper_params, **kwargs)
-                # parse map file to extract not uniquely mapped reads
-                print('Parsing result...')
-                if gem_version >= 3:
-                    _sam_filter(out_map_path, curr_map,
-                                curr_map + '_filt_%s-%s%s.map' % (beg, end, suffix),
-                                os.path.join(out_map_dir,
-                                             base_name + '_full_%s-%s%s.map' % (beg, end, suffix)))
+    pipeline = pipeline and not skip
+    stream = (stream or pipeline) and not skip
+    # one thread to run each mapper and one to filter its output
+    pool = ThreadPool(2 * (len(windows) + bool(frag_map))) if pipeline else None
+    fifos = []
+    tmp_files = []
+    stages = []
+    done = False
+    try:
+        for nwin, win in enumerate(windows):
+            if not win:
+                beg, end = 1, 'end'
+            else:
+                beg, end = win
+            # Prepare the FASTQ file and iterate over them
+            curr_map = mkstemp(prefix=base_name + '_', dir=temp_dir)[1]
+            if pipeline:
+                tmp_files.append(curr_map)
+            out_map_path = curr_map + '_full_%s-%s%s.map' % (beg, end, suffix)
+            filt_map = curr_map + '_filt_%s-%s%s.map' % (beg, end, suffix)
+            if pipeline:
+                # mapped reads and remaining unmapped reads go through named pipes
+                os.mkfifo(out_map_path)
+                fifos.append(out_map_path)
+                if frag_map or nwin < len(windows) - 1:
+                    os.mkfifo(filt_map)
+                    fifos.append(filt_map)
+            transform = partial(
+                transform_fastq, input_reads, curr_map,
+                fastq=not (pipeline and nwin) and is_fastq(input_reads),
+                min_seq_len=min_seq_len, trim=win, skip=skip,
+                nthreads=1 if pipeline else nthreads, light_storage=light_storage)
+            if stream:
+                # reads will be transformed while mapped
+                counter = None
+                feed = partial(_feed_mapper, transform)
+            else:
+                curr_map, counter = transform()
+                feed = None
+            # clean
+            if input_reads != fastq_path and clean and not stream:
+                print('   x removing original input %s' % input_reads)
+                os.system('rm -f %s' % (input_reads))
+            # First mapping, full length
+            if end:
+                print('Mapping reads in window %s-%s%s...' % (beg, end, suffix))
+            else:
+                print('Mapping full reads...', curr_map)
+
+            if not skip:
+                if mapper == 'gem':
+                    run_mapper = partial(
+                        _gem_mapping, mapper_index_path, curr_map, out_map_path,
+                        gem_binary=gem_binary, gem_version=gem_version,
+                        gem_params=mapper_params, feed=feed, **kwargs)
+                elif mapper == 'bowtie2' or mapper == 'hisat2':
+                    run_mapper = partial(
+                        _bowtie2_mapping, mapper_index_path, curr_map, out_map_path,
+                        bowtie2_binary=(mapper_binary if mapper_binary else mapper),
+                        bowtie2_params=mapper_params, feed=feed, **kwargs)
                 else:
-                    _gem_filter(out_map_path,
-                                curr_map + '_filt_%s-%s%s.map' % (beg, end, suffix),
-                                os.path.join(out_map_dir,
-                                             base_name + '_full_%s-%s%s.map' % (
-                                                 beg, end, suffix)))
-            elif mapper == 'bowtie2' or mapper == 'hisat2':
-                _bowtie2_mapping(mapper_index_path, curr_map, out_map_path,
-                                 bowtie2_binary=(mapper_binary if mapper_binary else mapper),
-                                 bowtie2_params=mapper_params, **kwargs)
+                    raise Exception('ERROR: unknown mapper.')
                 # parse map file to extract not uniquely mapped reads
-                print('Parsing result...')
-                _sam_filter(out_map_path, curr_map,
-                                curr_map + '_filt_%s-%s%s.map' % (beg, end, suffix),
-                                os.path.join(out_map_dir,
-                                             base_name + '_full_%s-%s%s.map' % (beg, end, suffix)))
+                if mapper == 'gem' and gem_version < 3:
+                    run_filter = partial(
+                        _gem_filter, out_map_path, filt_map,
+                        os.path.join(out_map_dir,
+                                     base_name + '_full_%s-%s%s.map' % (
+                                         beg, end, suffix)))
+                else:
+                    run_filter = partial(
+                        _sam_filter, out_map_path, curr_map, filt_map,
+                        os.path.join(out_map_dir,
+                                     base_name + '_full_%s-%s%s.map' % (beg, end, suffix)))
+                if pipeline:
+                    # next window starts mapping while this one is still running
+                    stages.append((pool.apply_async(run_mapper),
+                                   pool.apply_async(run_filter)))
+                else:
+                    transformed = run_mapper()
+                    print('Parsing result...')
+                    run_filter()
+                    if stream:
+                        counter = transformed[1]
+                        if input_reads != fastq_path and clean:
+                            print('   x removing original input %s' % input_reads)
+                            os.system('rm -f %s' % (input_reads))
+                    # clean
+                    if clean:
+                        print('   x removing %s input %s' % (mapper.upper(),curr_map))
+                        os.system('rm -f %s' % (curr_map))
+                        print('   x removing map %s' % out_map_path)
+                        os.system('rm -f %s' % (out_map_path))
+                # for next round, we will use remaining unmapped reads
+                input_reads = filt_map
+            outfiles.append(
+                [os.path.join(out_map_dir,
+                              base_name + '_full_%s-%s%s.map' % (beg, end, suffix)),
+                 counter])
+
+        # map again splitting unmapped reads into RE fragments
+        # (no need to trim this time)
+        if frag_map:
+            if not r_enz:
+                raise Exception('ERROR: need enzyme name to fragment.')
+            frag_map = mkstemp(prefix=base_name + '_', dir=temp_dir)[1]
+            if pipeline:
+                tmp_files.extend([frag_map, curr_map + '_fail%s.map' % (suffix)])
+            transform = partial(
+                transform_fastq, input_reads, frag_map,
+                min_seq_len=min_seq_len, trim=win, fastq=False, r_enz=r_enz,
+                add_site=add_site, skip=skip, nthreads=1 if pipeline else nthreads,
+                light_storage=light_storage)
+            if stream:
+                # reads will be split while mapped
+                counter = None
+                feed = partial(_feed_mapper, transform)
             else:
-                raise Exception('ERROR: unknown mapper.')
+                frag_map, counter = transform()
+                feed = None
             # clean
-            if clean:
-                print('   x removing %s input %s' % (mapper.upper(),curr_map))
-                os.system('rm -f %s' % (curr_map))
-                print('   x removing map %s' % out_map_path)
-                os.system('rm -f %s' % (out_map_path))
-            # for next round, we will use remaining unmapped reads
-            input_reads = curr_map + '_filt_%s-%s%s.map' % (beg, end, suffix)
-        outfiles.append(
-            (os.path.join(out_map_dir,
-                          base_name + '_full_%s-%s%s.map' % (beg, end, suffix)),
-             counter))
-
-    # map again splitting unmapped reads into RE fragments
-    # (no need to trim this time)
-    if frag_map:
-        if not r_enz:
-            raise Exception('ERROR: need enzyme name to fragment.')
-        frag_map, counter = transform_fastq(
-            input_reads, mkstemp(prefix=base_name + '_', dir=temp_dir)[1],
-            min_seq_len=min_seq_len, trim=win, fastq=False, r_enz=r_enz,
-            add_site=add_site, skip=skip, nthreads=nthreads,
-            light_storage=light_storage)
-        # clean
-        if clean:
-            print('   x removing pre-%s input %s' % (mapper.upper(),input_reads))
-            os.system('rm -f %s' % (input_reads))
-        if not win:
-            beg, end = 1, 'end'
-        else:
-            beg, end = win
-        out_map_path = frag_map + '_frag_%s-%s%s.map' % (beg, end, suffix)
-        if not skip:
-            if mapper == 'gem':
+            if clean and not stream:
+                print('   x removing pre-%s input %s' % (mapper.upper(),input_reads))
+                os.system('rm -f %s' % (input_reads))
+            if not win:
+                beg, end = 1, 'end'
+            else:
+                beg, end = win
+            out_map_path = frag_map + '_frag_%s-%s%s.map' % (beg, end, suffix)
+            if pipeline:
+                os.mkfifo(out_map_path)
+                fifos.append(out_map_path)
+            if not skip:
                 print('Mapping fragments of remaining reads...')
-                _gem_mapping(mapper_index_path, frag_map, out_map_path,
-                             gem_binary=gem_binary, gem_version=gem_version,
-                             **kwargs)
-                print('Parsing result...')
+                if mapper == 'gem':
+                    run_mapper = partial(
+                        _gem_mapping, mapper_index_path, frag_map, out_map_path,
+                        gem_binary=gem_binary, gem_version=gem_version,
+                        feed=feed, **kwargs)
+                elif mapper == 'bowtie2' or mapper == 'hisat2':
+                    run_mapper = partial(
+                        _bowtie2_mapping, mapper_index_path, frag_map, out_map_path,
+                        bowtie2_binary=(mapper_binary if mapper_binary else mapper),
+                        bowtie2_params=mapper_params, feed=feed, **kwargs)
+                else:
+                    raise Exception('ERROR: unknown mapper.')
                 # check if output is sam format for gem3
-                if gem_version >= 3:
-                    _sam_filter(out_map_path, frag_map,
-                                curr_map + '_fail%s.map' % (suffix),
-                                os.path.join(out_map_dir,
-                                         base_name + '_frag_%s-%s%s.map' % (beg, end, suffix)))
+                if mapper == 'gem' and gem_version < 3:
+                    run_filter = partial(
+                        _gem_filter, out_map_path, curr_map + '_fail%s.map' % (suffix),
+                        os.path.join(out_map_dir,
+                                     base_name + '_frag_%s-%s%s.map' % (beg, end, suffix)))
                 else:
-                    _gem_filter(out_map_path, curr_map + '_fail%s.map' % (suffix),
-                                os.path.join(out_map_dir,
-                                             base_name + '_frag_%s-%s%s.map' % (beg, end, suffix)))
-            elif mapper == 'bowtie2' or mapper == 'hisat2':
-                print('Mapping fragments of remaining reads...')
-                _bowtie2_mapping(mapper_index_path, frag_map, out_map_path,
-                                 bowtie2_binary=(mapper_binary if mapper_binary else mapper),
-                                 bowtie2_params=mapper_params, **kwargs)
-                print('Parsing result...')
-                _sam_filter(out_map_path, frag_map,
-                                curr_map + '_fail%s.map' % (suffix),
-                                os.path.join(out_map_dir,
-                                         base_name + '_frag_%s-%s%s.map' % (beg, end, suffix)))
-            else:
-                raise Exception('ERROR: unknown mapper.')
-        # clean
-        if clean:
-            print('   x removing %s input %s' % (mapper.upper(),frag_map))
-            os.system('rm -f %s' % (frag_map))
-            print('   x removing failed to map ' + curr_map + '_fail%s.map' % (suffix))
-            os.system('rm -f %s' % (curr_map + '_fail%s.map' % (suffix)))
-            print('   x removing tmp mapped %s' % out_map_path)
-            os.system('rm -f %s' % (out_map_path))
-        outfiles.append((os.path.join(out_map_dir,
-                                      base_name + '_frag_%s-%s%s.map' % (beg, end, suffix)),
-                         counter))
+                    run_filter = partial(
+                        _sam_filter, out_map_path, frag_map,
+                        curr_map + '_fail%s.map' % (suffix),
+                        os.path.join(out_map_dir,
+                                     base_name + '_frag_%s-%s%s.map' % (beg, end, suffix)))
+                if pipeline:
+                    stages.append((pool.apply_async(run_mapper),
+                                   pool.apply_async(run_filter)))
+                else:
+                    transformed = run_mapper()
+                    print('Parsing result...')
+                    run_filter()
+                    if stream:
+                        counter = transformed[1]
+                        if clean:
+                            print('   x removing pre-%s input %s' % (mapper.upper(),input_reads))
+                            os.system('rm -f %s' % (input_reads))
+            # clean
+            if clean and not pipeline:
+                print('   x removing %s input %s' % (mapper.upper(),frag_map))
+                os.system('rm -f %s' % (frag_map))
+                print('   x removing failed to map ' + curr_map + '_fail%s.map' % (suffix))
+                os.system('rm -f %s' % (curr_map + '_fail%s.map' % (suffix)))
+                print('   x removing tmp mapped %s' % out_map_path)
+                os.system('rm -f %s' % (out_map_path))
+            outfiles.append([os.path.join(out_map_dir,
+                                          base_name + '_frag_%s-%s%s.map' % (beg, end, suffix)),
+                             counter])
+        if pipeline:
+            print('Waiting for the %d mapping steps to finish...' % len(stages))
+            _wait_results([result for stage in stages for result in stage])
+            pool.close()
+            pool.join()
+            for (mapped, _), outfile in zip(stages, outfiles):
+                outfile[1] = mapped.get()[1]
+        done = True
+    finally:
+        # also on errors: release the steps still waiting on a named pipe,
+        # and remove the temporary files even without clean
+        if pipeline:
+            pool.terminate()
+            for fifo in fifos:
+                _release_fifo(fifo)
+            if (clean or not done) and tmp_files:
+                print('   x removing %s' % ', '.join(tmp_files))
+                os.system('rm -f %s' % (' '.join(tmp_files)))
+    outfiles = [tuple(outfile) for outfile in outfiles]
     if clean:
         os.system('rm -rf %s' % (temp_dir))
     if get_nread:
@@ -851,8 +1047,7 @@ def fast_fragment_mapping(mapper_index_path, fastq_path1, fastq_path2, r_enz,
     os.system(samtools + ' sort -n -O SAM -@ %d -T %s -o %s %s'
                       % (nthreads, out_map_path, out_map_path, out_map_path))
     genome_lengths = dict((crm, len(genome_seq[crm])) for crm in genome_seq)
-    frag_chunk = kwargs.get('frag_chunk', 100000)
-    frags = map_re_sites(r_enz, genome_seq, frag_chunk=frag_chunk)
+    frags = map_re_sites_array(r_enz, genome_seq)
     if samtools and nthreads > 1:
         print('Splitting sam file')
         # headers
@@ -875,11 +1070,10 @@ def fast_fragment_mapping(mapper_index_path, fastq_path1, fastq_path2, r_enz,
         procs = []
         pool = mu.Pool(nthreads)
         for i in range(nthreads):
-            frags_shared = copy.deepcopy(frags)
             procs.append(pool.apply_async(
                 parse_gem_3c, args=('%s_%d' % (out_map_path,(i+1)),
                                     '%s_parsed_%d' % (out_map_path,(i+1)),
-                                    copy.deepcopy(genome_lengths), frags_shared,
+                                    genome_lengths, frags,
                                     False, True), kwds=kwargs))
             #results.append('%s_parsed_%d' % (out_map_path,(i+1)))
         pool.close()
@@ -6,10 +6,12 @@ Definition and mapping of restriction enymes
 from __future__ import print_function
 
 from re import compile
+from os import path, rename
 from warnings import warn
 
 from collections import OrderedDict
 from scipy.stats import binom_test
+import numpy as np
 
 from pytadbit.utils.file_handling import magic_open
 
@@ -18,6 +20,17 @@ try:
 except NameError:
     basestring = str
 
+def _finditer(pattern, seq):
+    """
+    Iterates over the matches of a compiled pattern in a sequence, either a
+    string or a :class:`pytadbit.parsers.genome_parser.MappedSequence`
+    (searched directly in the memory-mapped bytes)
+    """
+    if isinstance(seq, basestring):
+        return pattern.finditer(seq)
+    return compile(pattern.pattern.encode()).finditer(seq.buffer)
+
+
 def iupac2regex(restring):
     """
     Convert target sites with IUPAC nomenclature to regex pattern
@@ -38,7 +51,7 @@ def iupac2regex(restring):
 
 def count_re_fragments(fnam):
     frag_count = {}
-    fhandler = open(fnam)
+    fhandler = magic_open(fnam)
     line = next(fhandler)
     while line.startswith('#'):
         line = next(fhandler)
@@ -106,7 +119,7 @@ def map_re_sites_nochunk(enzyme_name, genome_seq, verbose=False):
     for crm in genome_seq:
         seq = genome_seq[crm]
         frags[crm] = [1]
-        for match in enz_pattern.finditer(seq):
+        for match in _finditer(enz_pattern, seq):
             pos = match.end() + 1
             frags[crm].append(pos)
             count += 1
@@ -164,7 +177,7 @@ def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
         seq = genome_seq[crm]
         frags[crm] = dict([(i, []) for i in range(int(len(seq) // frag_chunk + 1))])
         frags[crm][0] = [1]
-        for match in enz_pattern.finditer(seq):
+        for match in _finditer(enz_pattern, seq):
             pos = match.end() + 1
             frags[crm][pos // frag_chunk].append(pos)
             count += 1
@@ -199,6 +212,114 @@ def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
     return frags
 
 
+def map_re_sites_array(enzyme_name, genome_seq, cache=None, verbose=False):
+    """
+    map all restriction enzyme (RE) sites of a given enzyme in a genome, and
+    store them in one sorted array per chromosome (see :func:`map_re_sites` for
+    the definition of the position of a RE site). Each array starts with 1 and
+    ends with the length of the chromosome.
+
+    Use :func:`find_re_sites` to get the RE sites surrounding a list of
+    positions.
+
+    :param enzyme_name: name of the enzyme to map (upper/lower case are
+       important)
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+    :param None cache: path to a file (NumPy .npz format) where to store the
+       RE sites. If the file exists, and corresponds to the same enzymes and
+       chromosomes, RE sites are loaded from it instead of being searched.
+
+    :returns: an ordered dictionary with, for each chromosome, an array of RE
+       sites positions
+    """
+    if isinstance(enzyme_name, basestring):
+        enzyme_names = [enzyme_name]
+    else:
+        enzyme_names = list(enzyme_name)
+    enzymes = '-'.join(sorted(enzyme_names))
+    lengths = np.array([len(genome_seq[crm]) for crm in genome_seq])
+    if cache and path.exists(cache):
+        try:
+            frags = _load_re_sites(cache, enzymes, list(genome_seq), lengths)
+        except (IOError, KeyError, ValueError):
+            frags = None
+        if frags is not None:
+            if verbose:
+                print('Loaded %d RE sites from %s' % (
+                    sum(len(f) - 2 for f in frags.values()), cache))
+            return frags
+
+    restring = '|'.join(['(?<=%s(?=%s))' % tuple(
+        RESTRICTION_ENZYMES[n].split('|')) for n in enzyme_names])
+    enz_pattern = compile(iupac2regex(restring))
+
+    frags = OrderedDict()
+    count = 0
+    for crm in genome_seq:
+        seq = genome_seq[crm]
+        sites = np.fromiter((m.end() + 1 for m in _finditer(enz_pattern, seq)),
+                            dtype=np.int64)
+        count += len(sites)
+        frags[crm] = np.concatenate(([1], sites, [len(seq)]))
+    if verbose:
+        print('Found %d RE sites' % count)
+
+    if cache:
+        try:
+            with open(cache + '.tmp', 'wb') as out:
+                np.savez(out, enzymes=np.array(enzymes),
+                         chromosomes=np.array(list(frags)), lengths=lengths,
+                         sizes=np.array([len(f) for f in frags.values()]),
+                         sites=np.concatenate(list(frags.values())))
+            rename(cache + '.tmp', cache)
+        except (IOError, OSError):
+            warn('WARNING: could not write RE sites to %s' % cache)
+    return frags
+
+
+def _load_re_sites(cache, enzymes, chromosomes, lengths):
+    """
+    :returns: RE sites stored in cache, or None if the cache corresponds to
+       other enzymes or chromosomes
+    """
+    data = np.load(cache)
+    if (str(data['enzymes']) != enzymes or
+        list(data['chromosomes']) != chromosomes or
+        not np.array_equal(data['lengths'], lengths)):
+        return None
+    sites = np.split(data['sites'], np.cumsum(data['sizes'])[:-1])
+    return OrderedDict(zip(chromosomes, sites))
+
+
+def find_re_sites(re_sites, positions, lengths):
+    """
+    Find the RE sites surrounding a list of positions in a chromosome.
+
+    :param re_sites: sorted array of RE sites in a chromosome as returned by
+       :func:`map_re_sites_array`
+    :param positions: array of positions of the reads
+    :param lengths: array with the length of the mapped reads. Reads
+       partially mapped beyond the end of the chromosome are moved back inside
+       of it (positions returned are modified).
+
+    :returns: an array of positions, and arrays with the closest upstream and
+       downstream RE sites
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    idx = np.searchsorted(re_sites, positions, side='right')
+    outside = idx >= len(re_sites)
+    if outside.any():
+        last = re_sites[-1] - 1
+        if (positions[outside] - last >= np.asarray(lengths)[outside]).any():
+            raise Exception('Read mapped mostly outside ' +
+                            'chromosome\n(also reference genome can be truncated)')
+        positions = positions.copy()
+        positions[outside] = last
+        idx[outside] = np.searchsorted(re_sites, last, side='right')
+    return positions, re_sites[np.maximum(idx - 1, 0)], re_sites[idx]
+
+
 def complementary(seq):
     trs = dict([(nt1, nt2) for nt1, nt2 in zip('ATGCN', 'TACGN')])
     return ''.join([trs[s] for s in seq[::-1]])
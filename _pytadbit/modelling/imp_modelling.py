@@ -11,6 +11,8 @@ from math            import fabs
 from pickle         import load, dump
 from sys             import stdout
 from os.path         import exists
+from heapq           import heappush, heapreplace
+from tempfile        import TemporaryFile
 import multiprocessing as mu
 from scipy           import polyfit
 
@@ -38,7 +40,8 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
                        values=None, experiment=None, coords=None, zeros=None,
                        first=None, container=None, use_HiC=True,
                        use_confining_environment=True, use_excluded_volume=True,
-                       single_particle_restraints=None):
+                       single_particle_restraints=None, batch_size=None,
+                       keep_logs=False):
     """
     This function generates three-dimensional models starting from Hi-C data.
     The final analysis will be performed on the n_keep top models.
@@ -63,7 +66,14 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
        the top 20% of the generated models). The models are ranked according to
        their objective function value (the lower the better)
     :param False keep_all: whether or not to keep the discarded models (if
-       True, models will be stored under StructuralModels.bad_models)
+       True, models will be stored under StructuralModels.bad_models). Note
+       that discarded models are written to a temporary file while they are
+       generated, but are all loaded back in memory at the end
+    :param None batch_size: number of models generated by a worker in a
+       single task. By default, models are split in 4 batches per CPU
+    :param False keep_logs: keep the log of the objective function of each
+       model (value at each step of the optimization). Needed to plot it with
+       :func:`pytadbit.modelling.structuralmodels.StructuralModels.objective_function_model`
     :param 1 close_bins: number of particles away (i.e. the bin number
        difference) a particle pair must be in order to be considered as
        neighbors (e.g. 1 means consecutive particles)
@@ -200,7 +210,8 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
         n_cpus, n_models, n_keep, keep_all, HiCRestraints,
         use_HiC=use_HiC, use_confining_environment=use_confining_environment,
         use_excluded_volume=use_excluded_volume,
-        single_particle_restraints=single_particle_restraints)
+        single_particle_restraints=single_particle_restraints,
+        batch_size=batch_size, keep_logs=keep_logs)
 
     try:
         xpr = experiment
@@ -247,49 +258,109 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
 
 def multi_process_model_generation(n_cpus, n_models, n_keep, keep_all,HiCRestraints, use_HiC=True,
                                    use_confining_environment=True, use_excluded_volume=True,
-                                   single_particle_restraints=None):
+                                   single_particle_restraints=None, batch_size=None,
+                                   keep_logs=False):
     """
     Parallelize the
     :func:`pytadbit.modelling.imp_model.StructuralModels.generate_IMPmodel`.
 
+    Each worker computes the list of restraints once, and generates the
+    models of batches of random seeds, that are collected as they finish.
+    Only the n_keep best models are kept in memory while models are
+    generated, the others are written to a temporary file if keep_all is set,
+    or discarded. With keep_all, the discarded models are loaded back at the
+    end, and the memory used is the same as keeping all of them.
+
     :param n_cpus: number of CPUs to use
     :param n_models: number of models to generate
+    :param None batch_size: number of models generated by a worker in a
+       single task. By default, models are split in 4 batches per CPU
+    :param False keep_logs: keep the log of the objective function of each
+       model
     """
-
-    pool = mu.Pool(n_cpus, maxtasksperchild=1)
-    jobs = {}
-    for rand_init in range(START, n_models + START):
-        jobs[rand_init] = pool.apply_async(generate_IMPmodel,
-                                           args=(rand_init,HiCRestraints, use_HiC,
-                                                 use_confining_environment, use_excluded_volume,
-                                                 single_particle_restraints))
-
+    seeds = list(range(START, n_models + START))
+    if not batch_size:
+        batch_size = max(1, -(-n_models // (n_cpus * 4)))
+    batches = [seeds[i:i + batch_size] for i in range(0, n_models, batch_size)]
+
+    pool = mu.Pool(n_cpus, initializer=_init_model_worker,
+                   initargs=(HiCRestraints, use_HiC, use_confining_environment,
+                             use_excluded_volume, single_particle_restraints))
+    # heap of the n_keep best models, ranked by objective function and seed,
+    # with the worst one on top
+    best = []
+    spill = TemporaryFile() if keep_all else None
+    for batch in pool.imap_unordered(_generate_IMPmodels, batches):
+        for rand_init, m in batch:
+            if not keep_logs:
+                m['log_objfun'] = None
+            item = (-m['objfun'], -rand_init, m)
+            if len(best) < n_keep:
+                heappush(best, item)
+                continue
+            if n_keep and item[:2] > best[0][:2]:
+                item = heapreplace(best, item)
+            if spill is not None:
+                dump(item, spill, -1)
     pool.close()
     pool.join()
 
-    results = []
-    for rand_init in range(START, n_models + START):
-        results.append((rand_init, jobs[rand_init].get()))
-
     models = {}
     bad_models = {}
-    for i, (_, m) in enumerate(
-        sorted(results, key=lambda x: x[1]['objfun'])[:n_keep]):
+    for i, (_, _, m) in enumerate(
+        sorted(best, key=lambda x: x[:2], reverse=True)):
         models[i] = m
     if keep_all:
-        for i, (_, m) in enumerate(
-        sorted(results, key=lambda x: x[1]['objfun'])[n_keep:]):
+        spill.seek(0)
+        rest = []
+        while True:
+            try:
+                rest.append(load(spill))
+            except EOFError:
+                break
+        spill.close()
+        for i, (_, _, m) in enumerate(
+            sorted(rest, key=lambda x: x[:2], reverse=True)):
             bad_models[i+n_keep] = m
     return models, bad_models
 
 
+def _init_model_worker(HiCRestraints, use_HiC, use_confining_environment,
+                       use_excluded_volume, single_particle_restraints):
+    """
+    Stores, in each worker, the restraints shared by all the models
+    """
+    global WORKER_ARGS
+    WORKER_ARGS = {'HiCRestraints'             : HiCRestraints,
+                   'use_HiC'                   : use_HiC,
+                   'use_confining_environment' : use_confining_environment,
+                   'use_excluded_volume'       : use_excluded_volume,
+                   'single_particle_restraints': single_particle_restraints,
+                   'HiCbasedRestraints'        : None}
+    if use_HiC:
+        WORKER_ARGS['HiCbasedRestraints'] = HiCRestraints.get_hicbased_restraints()
+
+
+def _generate_IMPmodels(rand_inits):
+    """
+    Generates the models of a batch of random seeds, with the restraints
+    stored by :func:`_init_model_worker`
+
+    :returns: a list of (random seed, model)
+    """
+    return [(rand_init, generate_IMPmodel(rand_init, **WORKER_ARGS))
+            for rand_init in rand_inits]
+
 
 def generate_IMPmodel(rand_init, HiCRestraints,use_HiC=True, use_confining_environment=True,
-                      use_excluded_volume=True, single_particle_restraints=None):
+                      use_excluded_volume=True, single_particle_restraints=None,
+                      HiCbasedRestraints=None):
     """
     Generates one IMP model
 
     :param rand_init: random number kept as model key, for reproducibility.
+    :param None HiCbasedRestraints: list of restraints, as returned by
+       HiCRestraints.get_hicbased_restraints(), computed if not given
 
     :returns: a model, that is a dictionary with the log of the objective
        function value optimization, and the coordinates of each particles.
@@ -333,16 +404,18 @@ def generate_IMPmodel(rand_init, HiCRestraints,use_HiC=True, use_confining_envir
 
     # Add restraints on single particles
     if single_particle_restraints:
-        for ap in single_particle_restraints:
-            ap[1] = [(c / SCALE) for c in ap[1]]
-            ap[4] /= SCALE
+        # scaled copy, the input list is shared by the models of the worker
+        single_particle_restraints = [
+            [ap[0], [(c / SCALE) for c in ap[1]], ap[2], ap[3], ap[4] / SCALE]
+            + list(ap[5:]) for ap in single_particle_restraints]
         # This function is specific for IMP
         add_single_particle_restraints(model, single_particle_restraints)
 
     # Separated function fot the HiC-based restraints
     if use_HiC:
         # print "\nEnforcing the HiC-based Restraints"
-        HiCbasedRestraints = HiCRestraints.get_hicbased_restraints()
+        if HiCbasedRestraints is None:
+            HiCbasedRestraints = HiCRestraints.get_hicbased_restraints()
         add_hicbased_restraints(model, HiCbasedRestraints)
 
     # Separated function for the excluded volume restraint
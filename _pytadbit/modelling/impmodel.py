@@ -183,6 +183,9 @@ class IMPmodel(StructuralModel):
            of the file name will determine the desired format).
 
         """
+        if self['log_objfun'] is None:
+            raise Exception('ERROR: log of the objective function not stored, '
+                            'models should be generated with keep_logs=True')
         show = False
         if not axe:
             fig = plt.figure(figsize=(7, 7))
@@ -105,6 +105,8 @@ class IMPoptimizer(object):
 
         self.container      = container
         self.results = {}
+        # correlations of the pilot rounds of the successive halving search
+        self.pilot_results = {}
 
     def run_grid_search(self,
                         scale_range=0.01,
@@ -116,7 +118,8 @@ class IMPoptimizer(object):
                         corr='spearman', off_diag=1,
                         savedata=None, n_cpus=1, verbose=True,
                         use_HiC=True, use_confining_environment=True,
-                        use_excluded_volume=True):
+                        use_excluded_volume=True, pilot_models=None,
+                        reduction=3):
         """
         This function calculates the correlation between the models generated
         by IMP and the input data for the four main IMP parameters (scale,
@@ -145,8 +148,20 @@ class IMPoptimizer(object):
            from which to consider 2 beads as being close). The last value of the
            input tuple is the incremental step for scale parameter values.
         :param None savedata: concatenate all generated models into a dictionary
-           and save it into a file named by this argument
+           and save it into a file named by this argument (with pilot_models,
+           only the models of the final round are saved)
         :param True verbose: print the results to the standard output
+        :param None pilot_models: if set, the search is done by successive
+           halving: all sets of parameters are first evaluated with this number
+           of models, and only the best ones are evaluated again with more
+           models, until the final round where the remaining sets are evaluated
+           with n_models. Only these last correlations are stored in
+           self.results, the ones of the previous rounds are stored in
+           self.pilot_results.
+        :param 3 reduction: in the successive halving search, fraction of the
+           sets of parameters kept at each round (1/reduction), and factor
+           by which the number of models increases from one round to the next
+           (should be greater than 1)
         """
         if verbose:
             stderr.write('Optimizing %s particles\n' % self.nloci)
@@ -270,77 +285,65 @@ class IMPoptimizer(object):
                                             [my_round(i) for i in lowfreq_arange ],
                                             [my_round(i) for i in upfreq_arange  ])
 
-
-        #for (scale, maxdist, upfreq, lowfreq, kbending) in zip([my_round(i) for i in scale_arange  ],
-        for (scale, kbending, maxdist, lowfreq, upfreq) in parameters_sets:
-            #print (scale, kbending, maxdist, lowfreq, upfreq)
-
+        done = {}
+        for k in self.results:
+            done.setdefault(tuple(k[:5]), k[-1])
+        to_evaluate = []
+        for params in parameters_sets:
             # This check whether this optimization has been already done for this set of parameters
-            if (scale, kbending, maxdist, lowfreq, upfreq) in [tuple(k[:5]) for k in self.results]:
-                k = [k for k in self.results
-                     if (scale, kbending, maxdist, lowfreq, upfreq) == tuple(k[:5])
-                ][0]
-                result = self.results[(scale, kbending, maxdist, lowfreq, upfreq, k[-1])]
+            if params in done:
+                result = self.results[params + (done[params], )]
                 if verbose:
                     verb = '  %-5s\t%-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%-7s\t' % (
-                        'xx', scale, kbending, maxdist, lowfreq, upfreq, k[-1])
+                        ('xx', ) + params + (done[params], ))
                     if verbose == 2:
                         stderr.write(verb + str(round(result, 4)) + '\n')
                     else:
                         print(verb + str(round(result, 4)))
                 continue
-
-            config_tmp = {'kforce'   : 5,
-                          'scale'    : float(scale),
-                          'kbending' : float(kbending),
-                          'lowrdist' : 100, # This parameters is fixed to XXX
-                          'maxdist'  : float(maxdist),
-                          'lowfreq'  : float(lowfreq),
-                          'upfreq'   : float(upfreq)}
-
-            try:
+            to_evaluate.append(params)
+
+        # budgets of models of each round: all parameter sets are first
+        # evaluated with pilot_models, and at each round only the best
+        # 1/reduction are kept and evaluated with reduction times more models
+        budgets = [self.n_models]
+        if pilot_models:
+            if not reduction > 1:
+                raise Exception('ERROR: reduction should be greater than 1 in '
+                                'the successive halving search')
+            while float(budgets[0]) / reduction >= pilot_models:
+                budgets.insert(0, int(float(budgets[0]) / reduction))
+            if budgets[0] > pilot_models:
+                budgets.insert(0, pilot_models)
+
+        scores = {}
+        for n_round, n_models in enumerate(budgets):
+            if n_round:
+                # rank by best correlation over distance cutoffs, failed
+                # parameter sets (NaN) are discarded
+                to_evaluate = sorted(
+                    [k for k in to_evaluate if scores[k] == scores[k]],
+                    reverse=True, key=lambda k: scores[k])
+                to_evaluate = to_evaluate[:max(1, int(
+                    np.ceil(float(len(to_evaluate)) / reduction)))]
+            if verbose and len(budgets) > 1:
+                stderr.write('  - round %d: %d parameter sets, %d models each\n' % (
+                    n_round + 1, len(to_evaluate), n_models))
+            final = n_round == len(budgets) - 1
+            n_keep = max(1, int(round(float(self.n_keep) * n_models / self.n_models)))
+            scores = {}
+            for params in to_evaluate:
                 count += 1
-                tdm = generate_3d_models(
-                    self.zscores, self.resolution,
-                    self.nloci, n_models=self.n_models,
-                    n_keep=self.n_keep, config=config_tmp,
-                    n_cpus=n_cpus, first=0,
-                    values=self.values, container=self.container,
-                    coords = self.coords, close_bins=self.close_bins,
-                    zeros=self.zeros, use_HiC=use_HiC,
-                    use_confining_environment=use_confining_environment,
-                    use_excluded_volume=use_excluded_volume,
-                    single_particle_restraints=self.single_particle_restraints)
-                result = 0
-                cutoff = my_round(dcutoff_arange[0])
-
-                matrices = tdm.get_contact_matrix(
-                    cutoff=[i * self.resolution * float(scale) for i in dcutoff_arange])
-                for m in matrices:
-                    cut = m**0.5
-                    result = tdm.correlate_with_real_data(cutoff=cut, corr=corr,
-                                                          off_diag=off_diag,
-                                                          contact_matrix=matrices[m])[0]
-
-                    cutoff = my_round(float(cut) / self.resolution / float(scale))
-                    if verbose:
-                        verb = '  %-4s%-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%-7s' % (
-                            count, scale, kbending, maxdist, lowfreq, upfreq, cutoff)
-                        if verbose == 2:
-                            stderr.write(verb + str(round(result, 4)) + '\n')
-                        else:
-                            print(verb + str(round(result, 4)))
-
-                    # Store the correlation for the TADbit parameters set
-                    self.results[(scale, kbending, maxdist, lowfreq, upfreq, float(cutoff))] = result
-            except Exception as e:
-                print('  SKIPPING: %s' % e)
-                result = 0
-                cutoff = my_round(dcutoff_arange[0])
-
-            if savedata and result:
-                models[(scale, kbending, maxdist, lowfreq, upfreq, cutoff)] = \
-                    tdm._reduce_models(minimal=["restraints", "zscores", "original_data"])
+                result, cutoff, best, tdm = self._evaluate_parameters(
+                    params, n_models, n_keep, dcutoff_arange, corr, off_diag,
+                    n_cpus, verbose, count, use_HiC, use_confining_environment,
+                    use_excluded_volume,
+                    self.results if final else self.pilot_results)
+                scores[params] = best
+                # only models of the final round, all with n_models
+                if savedata and final and tdm is not None:
+                    models[params + (cutoff, )] = tdm._reduce_models(
+                        minimal=["restraints", "zscores", "original_data"])
 
         if savedata:
             out = open(savedata, 'wb')
@@ -354,6 +357,73 @@ class IMPoptimizer(object):
         self.upfreq_range.sort( key=float)
         self.dcutoff_range.sort(key=float)
 
+    def _evaluate_parameters(self, params, n_models, n_keep, dcutoff_arange,
+                             corr, off_diag, n_cpus, verbose, count, use_HiC,
+                             use_confining_environment, use_excluded_volume,
+                             results):
+        """
+        Generates models for one set of parameters and correlates them with the
+        input data, for each distance cutoff. Correlations are stored in the
+        results dictionary.
+
+        :returns: the correlation for the last distance cutoff (NaN if the
+           modelling failed), the cutoff, the best correlation over all
+           cutoffs (NaN if the modelling failed), and the models
+        """
+        scale, kbending, maxdist, lowfreq, upfreq = params
+        config_tmp = {'kforce'   : 5,
+                      'scale'    : float(scale),
+                      'kbending' : float(kbending),
+                      'lowrdist' : 100, # This parameters is fixed to XXX
+                      'maxdist'  : float(maxdist),
+                      'lowfreq'  : float(lowfreq),
+                      'upfreq'   : float(upfreq)}
+        tdm = None
+        best = float('nan')
+        try:
+            tdm = generate_3d_models(
+                self.zscores, self.resolution,
+                self.nloci, n_models=n_models,
+                n_keep=n_keep, config=config_tmp,
+                n_cpus=n_cpus, first=0,
+                values=self.values, container=self.container,
+                coords = self.coords, close_bins=self.close_bins,
+                zeros=self.zeros, use_HiC=use_HiC,
+                use_confining_environment=use_confining_environment,
+                use_excluded_volume=use_excluded_volume,
+                single_particle_restraints=self.single_particle_restraints)
+            result = 0
+            cutoff = my_round(dcutoff_arange[0])
+
+            matrices = tdm.get_contact_matrix(
+                cutoff=[i * self.resolution * float(scale) for i in dcutoff_arange])
+            for m in matrices:
+                cut = m**0.5
+                result = tdm.correlate_with_real_data(cutoff=cut, corr=corr,
+                                                      off_diag=off_diag,
+                                                      contact_matrix=matrices[m])[0]
+
+                cutoff = my_round(float(cut) / self.resolution / float(scale))
+                if verbose:
+                    verb = '  %-4s%-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%-7s' % (
+                        count, scale, kbending, maxdist, lowfreq, upfreq, cutoff)
+                    if verbose == 2:
+                        stderr.write(verb + str(round(result, 4)) + '\n')
+                    else:
+                        print(verb + str(round(result, 4)))
+
+                # Store the correlation for the TADbit parameters set
+                results[(scale, kbending, maxdist, lowfreq, upfreq, float(cutoff))] = result
+                if result > best or best != best:  # best may be NaN
+                    best = result
+        except Exception as e:
+            print('  SKIPPING: %s' % e)
+            tdm = None
+            result = float('nan')
+            cutoff = my_round(dcutoff_arange[0])
+            best = result
+        return result, cutoff, best, tdm
+
     def load_grid_search_OLD(self, filenames, corr='spearman', off_diag=1,
                          verbose=True, n_cpus=1):
         """
@@ -722,7 +792,7 @@ def _mu_correlate(svd, corr, off_diag, scale, kbending, maxdist, lowfreq, upfreq
         resolution=svd['resolution'],
         original_data=svd['original_data'],
         clusters=svd['clusters'], config=svd['config'],
-        zscores=svd['zscore'])
+        zscores=svd['zscore'], coordinates=svd.get('coordinates', None))
     try:
         result = tdm.correlate_with_real_data(
             cutoff=dcutoff, corr=corr,
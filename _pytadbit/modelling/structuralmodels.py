@@ -31,6 +31,8 @@ from numpy                            import std as np_std, log2
 from numpy                            import array, cross, dot, ma, isnan
 from numpy                            import histogram, linspace, errstate
 from numpy                            import nanmin, nanmax
+from numpy                            import zeros as np_zeros
+from numpy                            import triu_indices
 from numpy.linalg                     import norm
 
 from scipy.optimize                   import curve_fit
@@ -109,7 +111,8 @@ def load_structuralmodels(input_):
             resolution=svd['resolution'], original_data=svd['original_data'],
             clusters=svd['clusters'], config=svd['config'], zscores=svd['zscore'],
             zeros=svd['zeros'], restraints=svd.get('restraints', None),
-            description=svd.get('description', None))
+            description=svd.get('description', None),
+            coordinates=svd.get('coordinates', None))
     except KeyError:  # old version
         return StructuralModels(
             nloci=svd['nloci'], models=svd['models'], bad_models=svd['bad_models'],
@@ -118,6 +121,14 @@ def load_structuralmodels(input_):
             restraints=svd.get('restraints', None))
 
 
+def _without_coordinates(model):
+    """
+    :returns: a copy of a model without its coordinates
+    """
+    return model.__class__((k, v) for k, v in model.items()
+                           if not k in ('x', 'y', 'z'))
+
+
 class StructuralModels(object):
     """
     This class contains three-dimensional models generated from a single Hi-C
@@ -141,13 +152,21 @@ class StructuralModels(object):
        :class:`pytadbit.modelling.structuralmodels.ClusterOfModels`
     :param None config: a dictionary containing the parameter to be used for the
        generation of three dimensional models.
+    :param None coordinates: array with the coordinates of all the models, as
+       saved by
+       :func:`pytadbit.modelling.structuralmodels.StructuralModels.save_models`.
+       By default coordinates are read from the models.
+
+    The coordinates of all the models (best and bad ones) are stored in a
+    single array, of shape (models, 3, particles), and the 'x', 'y' and 'z'
+    of each model are views of this array.
 
     """
 
     def __init__(self, nloci, models, bad_models, resolution,
                  original_data=None, zscores=None, clusters=None,
                  config=None, experiment=None, zeros=None, restraints=None,
-                 description=None):
+                 description=None, coordinates=None):
 
         self.__models       = models
         self._bad_models    = bad_models
@@ -161,6 +180,27 @@ class StructuralModels(object):
         self.experiment     = experiment
         self._restraints    = restraints
         self.description    = description
+        self._coords        = self._pack_coordinates(coordinates)
+
+    def _pack_coordinates(self, coordinates=None):
+        """
+        Moves the coordinates of all the models to a single array, replacing
+        the 'x', 'y' and 'z' lists of each model by views of this array.
+
+        :param None coordinates: array of shape (models, 3, particles), with
+           the models in the order of the best models followed by the bad
+           models. If None, it is built from the coordinates of the models.
+
+        :returns: the array of coordinates
+        """
+        models = ([self.__models[m] for m in self.__models] +
+                  [self._bad_models[m] for m in self._bad_models])
+        if coordinates is None:
+            coordinates = array([[m['x'], m['y'], m['z']] for m in models],
+                                dtype=float)
+        for model, (x, y, z) in zip(models, coordinates):
+            model['x'], model['y'], model['z'] = x, y, z
+        return coordinates
 
     def __getitem__(self, nam):
         if isinstance(nam, basestring):
@@ -241,6 +281,7 @@ class StructuralModels(object):
             new_models[i] = m
             new_models[i]['index'] = i
         self.__models = new_models
+        self._coords = self._pack_coordinates()
         # keep the same number of best models
         self.define_best_models(nbest)
 
@@ -280,16 +321,16 @@ class StructuralModels(object):
                 if not in_place:
                     for midx in range(len(self.__models)):
                         if not aligned_coords[midx]:
-                            aligned_coords[midx] = [self[midx]['x'][:],
-                                                    self[midx]['y'][:],
-                                                    self[midx]['z'][:]]
+                            aligned_coords[midx] = [self[midx]['x'].tolist(),
+                                                    self[midx]['y'].tolist(),
+                                                    self[midx]['z'].tolist()]
                 return aligned_coords if not in_place else None
             else:
                 models = [m for m in self.__models]
         ref_model = models[0] if reference_model is None else reference_model
-        firstx, firsty, firstz = (self[ref_model]['x'][:],
-                                  self[ref_model]['y'][:],
-                                  self[ref_model]['z'][:])
+        firstx, firsty, firstz = (self[ref_model]['x'].tolist(),
+                                  self[ref_model]['y'].tolist(),
+                                  self[ref_model]['z'].tolist())
         mass_center(firstx, firsty, firstz, self._zeros)
         aligned = []
         for sec in models:
@@ -298,13 +339,13 @@ class StructuralModels(object):
                     aligned.append([firstx, firsty, firstz])
                 continue
             coords = aligner3d_wrapper(firstx, firsty, firstz,
-                                       self[sec]['x'],
-                                       self[sec]['y'],
-                                       self[sec]['z'],
+                                       self[sec]['x'].tolist(),
+                                       self[sec]['y'].tolist(),
+                                       self[sec]['z'].tolist(),
                                        self._zeros,
                                        self.nloci)
             if in_place:
-                self[sec]['x'], self[sec]['y'], self[sec]['z'] = coords
+                self[sec]['x'][:], self[sec]['y'][:], self[sec]['z'][:] = coords
             else:
                 aligned.append(coords)
 
@@ -685,7 +726,7 @@ class StructuralModels(object):
            all_angles particles instead of a contact_map matrix using the cutoff
         :param True show_bad_columns: show bad columns in contact map
 
-        :returns: matrix frequency of interaction
+        :returns: matrix frequency of interaction, as a NumPy array
         """
         cluster = cluster or -1
         if models:
@@ -703,26 +744,38 @@ class StructuralModels(object):
         if not cutoff:
             cutoff = [float(2 * self.resolution * self._config['scale'])]
         cutoff = [c**2 for c in cutoff]
-        matrix = dict([(c, [[0. for _ in range(self.nloci)]
-                            for _ in range(self.nloci)]) for c in cutoff])
         # remove (or not) interactions from bad columns
         if show_bad_columns:
             wloci = [i for i in range(self.nloci) if self._zeros[i]]
         else:
             wloci = [i for i in range(self.nloci)]
         models = [self[mdl] for mdl in models]
-
-        frac = 1.0 / len(models)
-
-        for model in models:
-            squared_distance_matrix = squared_distance_matrix_calculation_wrapper(
-                model['x'], model['y'], model['z'], self.nloci)
-            #print model, len(x), len(y), len(z)
+        # pairs of particles (upper triangle of the matrix)
+        pairs1, pairs2 = triu_indices(len(wloci), 1)
+        counts = dict((c, np_zeros(len(pairs1))) for c in cutoff)
+        # squared distances are computed for chunks of models, of at most
+        # 2**22 (~32 Mb) values
+        step = max(1, 2**22 // max(1, len(pairs1)))
+        for beg in range(0, len(models), step):
+            sqr_dist = 0
+            for coord in ('x', 'y', 'z'):
+                # (models, particles) array of one coordinate
+                coords = array([model[coord] for model in models[beg:beg + step]],
+                               dtype=float)[:, wloci]
+                diff = coords[:, pairs1]
+                diff -= coords[:, pairs2]
+                diff *= diff
+                sqr_dist = sqr_dist + diff
             for c in cutoff:
-                for i, j in combinations(wloci, 2):
-                    if squared_distance_matrix[i][j] <= c:
-                        matrix[c][i][j] += frac  # * 100
-                        matrix[c][j][i] += frac  # * 100
+                counts[c] += (sqr_dist <= c).sum(axis=0)
+        frac = 1.0 / len(models)
+        pairs1 = array(wloci, dtype=int)[pairs1]
+        pairs2 = array(wloci, dtype=int)[pairs2]
+        matrix = {}
+        for c in cutoff:
+            matrix[c] = np_zeros((self.nloci, self.nloci))
+            matrix[c][pairs1, pairs2] = counts[c] * frac
+            matrix[c][pairs2, pairs1] = counts[c] * frac
         if cutoff_list:
             return matrix
         return list(matrix.values())[0]
@@ -1826,7 +1879,7 @@ class StructuralModels(object):
         """
         if not cutoff:
             cutoff = 2.0 * self.resolution * self._config['scale']
-        if contact_matrix:
+        if contact_matrix is not None:
             model_matrix = contact_matrix
         else:
             model_matrix = self.get_contact_matrix(models=models, cluster=cluster,
@@ -3018,13 +3071,14 @@ class StructuralModels(object):
                     X[i] = px + random() * rnd_factor
                     Y[i] = py + random() * rnd_factor
                     Z[i] = pz + random() * rnd_factor
-            m['x'] = X
-            m['y'] = Y
-            m['z'] = Z
+            m['x'][:] = X
+            m['y'][:] = Y
+            m['z'][:] = Z
 
     def save_models(self, outfile, minimal=()):
         """
         Saves all the models in pickle format (python object written to disk).
+        The coordinates of all models are written as a single array.
 
         :param path_f: path where to save the pickle file
         :param () minimal: list of items to exclude from save. Options:
@@ -3056,10 +3110,16 @@ class StructuralModels(object):
         if 'objfun' in minimal:
             for m in self.__models:
                 self.__models[m]['log_objfun'] = None
-            to_save['models']    = self.__models
-        else:
-            to_save['models']    = self.__models
-        to_save['bad_models']    = self._bad_models
+        # coordinates are saved apart, as a single array
+        models = ([self.__models[m] for m in self.__models] +
+                  [self._bad_models[m] for m in self._bad_models])
+        to_save['coordinates']   = array([[m['x'], m['y'], m['z']]
+                                          for m in models], dtype=float)
+        to_save['models']        = dict(
+            (m, _without_coordinates(self.__models[m])) for m in self.__models)
+        to_save['bad_models']    = dict(
+            (m, _without_coordinates(self._bad_models[m]))
+            for m in self._bad_models)
         to_save['description']   = self.description
         to_save['nloci']         = self.nloci
         to_save['clusters']      = self.clusters
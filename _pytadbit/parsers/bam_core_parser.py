@@ -0,0 +1,269 @@
+"""
+Bulk reader of the fixed fields of the records of a BAM file (reference,
+position, flag, and reference and position of the mate), without decoding the
+rest of the record.
+
+BGZF blocks are decompressed directly, records are delimited by their size,
+and their first 36 bytes are viewed as a NumPy structured array. Regions are
+found through the BAI index of the BAM file.
+
+Records are delimited by the C extension pytadbit.bam_records, or by a slower
+pure Python loop if it is not compiled.
+"""
+from __future__ import print_function
+
+from os     import path
+from struct import Struct
+import zlib
+
+import numpy as np
+
+try:
+    from pytadbit.bam_records import core_fields as _c_core_fields
+except ImportError:
+    _c_core_fields = None
+
+# fixed size part of a BAM record
+CORE_FIELDS = np.dtype([('block_size', '<i4'), ('refid'      , '<i4'),
+                        ('pos'       , '<i4'), ('l_read_name', 'u1' ),
+                        ('mapq'      , 'u1' ), ('bin'        , '<u2'),
+                        ('n_cigar_op', '<u2'), ('flag'       , '<u2'),
+                        ('l_seq'     , '<i4'), ('next_refid' , '<i4'),
+                        ('next_pos'  , '<i4'), ('tlen'       , '<i4')])
+
+_INT32  = Struct('<i')
+_UINT16 = Struct('<H')
+
+# BAI indexes parsed by this process
+_INDEXES = {}
+
+
+def bam_index_path(inbam):
+    """
+    :returns: path to the BAI index of a BAM file, None if not found
+    """
+    for fnam in (inbam + '.bai', path.splitext(inbam)[0] + '.bai'):
+        if path.exists(fnam):
+            return fnam
+    return None
+
+
+def _parse_bai(fnam):
+    """
+    :returns: for each reference, a dictionary of bins with their chunks of
+       virtual offsets, and the linear index (array of virtual offsets)
+    """
+    with open(fnam, 'rb') as fhandler:
+        data = fhandler.read()
+    if data[:4] != b'BAI\x01':
+        raise Exception('ERROR: %s is not a BAI index' % fnam)
+    pos = 4
+    n_ref = _INT32.unpack_from(data, pos)[0]
+    pos += 4
+    refs = []
+    for _ in range(n_ref):
+        n_bin = _INT32.unpack_from(data, pos)[0]
+        pos += 4
+        bins = {}
+        for _ in range(n_bin):
+            bin_id = _INT32.unpack_from(data, pos)[0]
+            n_chunk = _INT32.unpack_from(data, pos + 4)[0]
+            pos += 8
+            bins[bin_id] = np.frombuffer(data, dtype='<u8', count=2 * n_chunk,
+                                         offset=pos).reshape(-1, 2)
+            pos += 16 * n_chunk
+        n_intv = _INT32.unpack_from(data, pos)[0]
+        pos += 4
+        linear = np.frombuffer(data, dtype='<u8', count=n_intv, offset=pos)
+        pos += 8 * n_intv
+        refs.append((bins, linear))
+    return refs
+
+
+def _reg2bins(beg, end):
+    """
+    :returns: list of the bins (as defined in the SAM specifications) that
+       may contain reads overlapping the region [beg, end)
+    """
+    end -= 1
+    bins = [0]
+    for shift, first in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(first + (beg >> shift), first + (end >> shift) + 1))
+    return bins
+
+
+def region_offset(index, tid, beg, end):
+    """
+    :returns: virtual offset in the BAM file from which to read the records
+       overlapping a region, None if there are none
+    """
+    try:
+        refs = _INDEXES[index]
+    except KeyError:
+        refs = _INDEXES[index] = _parse_bai(index)
+    if tid >= len(refs):
+        return None
+    bins, linear = refs[tid]
+    min_offset = 0
+    if len(linear):
+        min_offset = int(linear[min(beg >> 14, len(linear) - 1)])
+    offsets = [int(chunk[0]) for b in _reg2bins(beg, end) if b in bins
+               for chunk in bins[b] if chunk[1] > min_offset]
+    if not offsets:
+        return None
+    return max(min(offsets), min_offset)
+
+
+def _iter_bgzf_blocks(fhandler, coffset, buffer_size=256 * 1024):
+    """
+    Decompresses BGZF blocks from a position in the BAM file.
+
+    :returns: lists of (position in the file, decompressed data) of the
+       blocks, by pieces of several blocks
+    """
+    fhandler.seek(coffset)
+    rest = b''
+    while True:
+        data = rest + fhandler.read(buffer_size)
+        if not data:
+            break
+        pos = 0
+        blocks = []
+        while pos + 18 <= len(data):
+            # total size of the block is stored in the extra field "BC"
+            bsize = _UINT16.unpack_from(data, pos + 16)[0] + 1
+            if pos + bsize > len(data):
+                break
+            blocks.append((coffset + pos,
+                           zlib.decompress(data[pos + 18:pos + bsize - 8], -15)))
+            pos += bsize
+        coffset += pos
+        rest = data[pos:]
+        if not blocks:
+            if len(data) < buffer_size:  # truncated file
+                break
+            continue
+        yield blocks
+
+
+def _iter_bgzf(fhandler, coffset, uoffset, buffer_size=256 * 1024):
+    """
+    Decompresses BGZF blocks from a position in the BAM file.
+
+    :returns: decompressed data, by pieces of several blocks
+    """
+    for blocks in _iter_bgzf_blocks(fhandler, coffset, buffer_size):
+        blocks = b''.join(block for _, block in blocks)
+        yield blocks[uoffset:]
+        uoffset = 0
+
+
+def _core_fields(data):
+    """
+    :returns: structured array (see CORE_FIELDS) with the fixed fields of the
+       complete records in data, and the position after the last one
+    """
+    if _c_core_fields is not None:
+        cores, pos = _c_core_fields(data, 0)
+        return np.frombuffer(cores, dtype=CORE_FIELDS), pos
+    offsets = []
+    pos = 0
+    size = len(data)
+    while pos + CORE_FIELDS.itemsize <= size:
+        nxt = pos + 4 + _INT32.unpack_from(data, pos)[0]
+        if nxt > size or nxt < pos + CORE_FIELDS.itemsize:
+            break
+        offsets.append(pos)
+        pos = nxt
+    core_bytes = np.arange(CORE_FIELDS.itemsize)
+    records = np.frombuffer(data, dtype=np.uint8)[
+        np.array(offsets, dtype=np.int64)[:, None] + core_bytes]
+    return records.view(CORE_FIELDS)[:, 0], pos
+
+
+def iter_record_offsets(inbam, voffset, step):
+    """
+    Walks the records of a BAM file, delimited by their size only (they are
+    not decoded), to split the file in blocks of records.
+
+    :param inbam: path to the BAM file
+    :param voffset: virtual offset of the first record to consider (e.g. the
+       one after the header)
+    :param step: number of records in each block
+
+    :returns: virtual offsets of the first record of each block
+    """
+    nrecords = 0
+    data = b''
+    # position in data of the beginning of each block, and its position
+    # in the file
+    starts = np.zeros(0, dtype=np.int64)
+    coffsets = np.zeros(0, dtype=np.int64)
+    uoffset = voffset & 0xffff
+    with open(inbam, 'rb') as fhandler:
+        for blocks in _iter_bgzf_blocks(fhandler, voffset >> 16):
+            sizes = np.array([len(block) for _, block in blocks], dtype=np.int64)
+            starts = np.concatenate((starts, len(data) + np.cumsum(sizes) - sizes))
+            coffsets = np.concatenate(
+                (coffsets, np.array([c for c, _ in blocks], dtype=np.int64)))
+            data = b''.join([data] + [block for _, block in blocks])
+            if uoffset:  # first record is inside the first block
+                data = data[uoffset:]
+                starts -= uoffset
+                uoffset = 0
+            records, pos = _core_fields(data)
+            if not len(records):
+                continue
+            # position in data of the first record of each block of records
+            firsts = np.arange((-nrecords) % step, len(records), step)
+            sizes = records['block_size'].astype(np.int64) + 4
+            recpos = (np.cumsum(sizes) - sizes)[firsts]
+            idx = np.searchsorted(starts, recpos, side='right') - 1
+            for coffset, upos in zip(coffsets[idx].tolist(),
+                                     (recpos - starts[idx]).tolist()):
+                yield (coffset << 16) | upos
+            nrecords += len(records)
+            # keep the data, and blocks, of the last incomplete record
+            data = data[pos:]
+            keep = max(0, np.searchsorted(starts, pos, side='right') - 1)
+            starts = starts[keep:] - pos
+            coffsets = coffsets[keep:]
+
+
+def iter_core_fields(inbam, tid, beg, end, index=None):
+    """
+    Reads the fixed fields of the records of a sorted and indexed BAM file,
+    by blocks of records.
+
+    :param inbam: path to the BAM file
+    :param tid: reference ID of the chromosome to read
+    :param beg: start of the region (0-based)
+    :param end: end of the region (not included)
+    :param None index: path to the BAI index
+
+    :returns: structured arrays (see CORE_FIELDS) of the records of the
+       chromosome from the first one overlapping the region, up to the last one
+       starting before its end. Some records before the region may be
+       included.
+    """
+    index = index or bam_index_path(inbam)
+    if index is None:
+        raise Exception('ERROR: BAI index of %s not found, run '
+                        '"samtools index" on it' % inbam)
+    voffset = region_offset(index, tid, beg, end)
+    if voffset is None:
+        return
+    with open(inbam, 'rb') as fhandler:
+        rest = b''
+        for data in _iter_bgzf(fhandler, voffset >> 16, voffset & 0xffff):
+            data = rest + data
+            records, pos = _core_fields(data)
+            rest = data[pos:]
+            if not len(records):
+                continue
+            stop = np.flatnonzero((records['refid'] != tid) |
+                                  (records['pos'] >= end))
+            if len(stop):
+                yield records[:stop[0]]
+                return
+            yield records
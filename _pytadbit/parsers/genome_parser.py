@@ -7,19 +7,163 @@ from __future__ import print_function
 
 from collections import OrderedDict
 import multiprocessing as mu
-from os import path
+from os import path, rename
+import mmap
 import re
+from warnings import warn
+
+import numpy as np
 
 from pytadbit.utils.file_handling import magic_open
+from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES
 from functools import reduce
 
+try:
+    from math import gcd
+except ImportError:  # python 2
+    from fractions import gcd
+
 try:
     basestring
 except NameError:
     basestring = str
 
+# memory-mapped genome caches opened by this process
+_MAPPED_GENOMES = {}
+
+
+class MappedSequence(object):
+    """
+    Chromosome sequence stored in a memory-mapped genome cache (see
+    :func:`parse_fasta`). It behaves like the string of the sequence: it has a
+    length, it can be indexed, sliced (returning strings), iterated and
+    searched (with `in`, find and count).
+
+    The genome cache is shared between processes: pickling a sequence (e.g.
+    to send it to a multiprocessing worker) copies only its location in the
+    cache file.
+
+    :param fname: path to the memory-mapped genome cache
+    :param start: offset of the sequence in the file
+    :param length: length of the sequence
+    """
+
+    def __init__(self, fname, start, length):
+        self.fname  = fname
+        self.start  = start
+        self.length = length
+        self._buffer = None
+
+    @property
+    def buffer(self):
+        """
+        Sequence as a read-only buffer of bytes (can be searched with
+        regular expressions compiled from bytes)
+        """
+        if self._buffer is None:
+            try:
+                genome = _MAPPED_GENOMES[self.fname]
+            except KeyError:
+                with open(self.fname, 'rb') as fhandler:
+                    genome = mmap.mmap(fhandler.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+                _MAPPED_GENOMES[self.fname] = genome
+            try:
+                self._buffer = memoryview(genome)[
+                    self.start:self.start + self.length]
+            except TypeError:  # python 2 mmap objects
+                self._buffer = buffer(genome, self.start, self.length)
+        return self._buffer
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            beg, end, step = item.indices(self.length)
+            if step != 1:
+                # contiguous range covered by the slice, then the step
+                if step > 0:
+                    return self[beg:end][::step]
+                return self[end + 1:beg + 1][::step]
+            seq = bytes(self.buffer[beg:max(beg, end)])
+        else:
+            if item < 0:
+                item += self.length
+            if not 0 <= item < self.length:
+                raise IndexError('sequence index out of range')
+            seq = bytes(self.buffer[item:item + 1])
+        return seq if str is bytes else seq.decode('ascii')
+
+    def __iter__(self):
+        for beg in range(0, self.length, 100000):
+            for nt in self[beg:beg + 100000]:
+                yield nt
+
+    def __str__(self):
+        return self[:]
+
+    def __contains__(self, sub):
+        return sub in self[:]
+
+    def find(self, sub, *args):
+        """
+        Same as str.find on the sequence
+        """
+        return self[:].find(sub, *args)
+
+    def count(self, sub, *args):
+        """
+        Same as str.count on the sequence
+        """
+        return self[:].count(sub, *args)
+
+    def __repr__(self):
+        return 'MappedSequence(%r, %d, %d)' % (self.fname, self.start,
+                                               self.length)
+
+    def __reduce__(self):
+        return (MappedSequence, (self.fname, self.start, self.length))
+
+
+def _save_mapped_genome(genome_seq, fname):
+    """
+    Writes the genome as a text header with chromosome names and lengths,
+    followed by the sequences (one byte per nucleotide) one after the other.
+    """
+    with open(fname + '.tmp', 'wb') as out:
+        out.write(b'# TADbit genome\n')
+        for crm in genome_seq:
+            out.write(('>%s\t%d\n' % (crm, len(genome_seq[crm]))).encode())
+        out.write(b'\n')
+        for crm in genome_seq:
+            out.write(str(genome_seq[crm]).encode())
+    rename(fname + '.tmp', fname)
+
+
+def _load_mapped_genome(fname, only_length=False):
+    fname = path.abspath(fname)
+    genome_seq = OrderedDict()
+    with open(fname, 'rb') as fhandler:
+        if fhandler.readline() != b'# TADbit genome\n':
+            raise Exception('ERROR: %s is not a TADbit genome cache' % fname)
+        lengths = []
+        for line in iter(fhandler.readline, b'\n'):
+            crm, length = line[1:].decode().split()
+            lengths.append((crm, int(length)))
+        start = fhandler.tell()
+    for crm, length in lengths:
+        if only_length:
+            genome_seq[crm] = length
+        else:
+            genome_seq[crm] = MappedSequence(fname, start, length)
+        start += length
+    return genome_seq
+
+
 def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
-                verbose=True, save_cache=True, reload_cache=False, only_length=False):
+                verbose=True, save_cache=True, reload_cache=False, only_length=False,
+                memory_map=False):
     """
     Parse a list of fasta files, or just one fasta.
 
@@ -34,6 +178,10 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
        loadings (~4 times faster)
     :param False reload_cache: reload cached genome
     :param False only_length: returns dictionary with length of genome,not sequence
+    :param False memory_map: store the genome in a binary cache (one byte per
+       nucleotide) that is memory-mapped instead of loaded. Sequences are
+       returned as :class:`MappedSequence` objects, that are shared by all the
+       processes using them. The cache is written even if save_cache is False.
 
     :returns: a sorted dictionary with chromosome names as keys, and sequences
        as values (sequence in upper case)
@@ -45,6 +193,11 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
         fname = f_names[0] + '_genome.TADbit'
     else:
         fname = path.join(path.commonprefix(f_names), 'genome.TADbit')
+    mmap_fname = fname[:-len('.TADbit')] + '_mmap.TADbit'
+    if memory_map and path.exists(mmap_fname) and not reload_cache:
+        if verbose:
+            print('Loading memory-mapped genome')
+        return _load_mapped_genome(mmap_fname, only_length)
     if path.exists(fname) and not reload_cache:
         if verbose:
             print('Loading cached genome')
@@ -58,6 +211,9 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
                         genome_seq[c] = len(line.strip())
                     else:
                         genome_seq[c] = line.strip()
+        if memory_map and not only_length:
+            _save_mapped_genome(genome_seq, mmap_fname)
+            return _load_mapped_genome(mmap_fname)
         return genome_seq
 
     if isinstance(chr_names, basestring):
@@ -130,6 +286,11 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
                     genome_seq[header] = ''.join([l.rstrip() for l in fhandler]).upper()
         if 'UNWANTED' in genome_seq:
             del(genome_seq['UNWANTED'])
+    if memory_map and not only_length:
+        if verbose:
+            print('saving genome in memory-mapped cache')
+        _save_mapped_genome(genome_seq, mmap_fname)
+        return _load_mapped_genome(mmap_fname)
     if save_cache and not only_length:
         if verbose:
             print('saving genome in cache')
@@ -144,7 +305,8 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
     return genome_seq
 
 
-def get_gc_content(genome, resolution, chromosomes=None, n_cpus=None, by_chrom=False):
+def get_gc_content(genome, resolution, chromosomes=None, n_cpus=None, by_chrom=False,
+                   cache=None):
     """
     Get GC content by bins of a given size. Ns are nottaken into account in the
        calculation, only the number of Gs and Cs over As, Ts, Gs and Cs
@@ -155,43 +317,201 @@ def get_gc_content(genome, resolution, chromosomes=None, n_cpus=None, by_chrom=F
     :param None n_cpus: parallelize (can't parallelize more than the number of
        chromosomes)
     :param False by_chrom: if False returns a unique list for the full genome
+    :param None cache: prefix of the file where to store the GC content (see
+       :func:`get_bin_tracks`)
     """
     chromosomes = chromosomes if chromosomes else list(genome.keys())
-    if not n_cpus:
-        n_cpus = mu.cpu_count()
-    pool = mu.Pool(n_cpus)
-    get_chr_gc = _get_chr_gc_dico if by_chrom else _get_chr_gc_list
-    jobs = {}
-    for crm in chromosomes:
-        jobs[crm] = pool.apply_async(get_chr_gc, args=(genome[crm], resolution))
-    pool.close()
-    pool.join()
+    gc_content = get_bin_tracks(genome, resolution, chromosomes=chromosomes,
+                                cache=cache, n_cpus=n_cpus)['gc']
     if by_chrom:
-        gc_content = dict((crm, jobs[crm].get()) for crm in chromosomes)
-    else:
-        gc_content = reduce(lambda x,y: x + y, (jobs[crm].get() for crm in chromosomes))
-    return gc_content
+        return dict((crm, dict(enumerate(gc_content[crm].tolist())))
+                    for crm in chromosomes)
+    return [gc for crm in chromosomes for gc in gc_content[crm].tolist()]
 
 
-def _get_chr_gc_list(chrom, resolution):
-    gc_content = []
-    for pos in range(0, len(chrom), resolution):
-        seq = chrom[pos:pos + resolution]
-        try:
-            gc_content.append(float(seq.count('G') + seq.count('C')) /
-                              (len(seq) - seq.count('N')))
-        except ZeroDivisionError:
-            gc_content.append(float('nan'))
-    return gc_content
+def get_bin_tracks(genome, resolutions, r_enz=None, chromosomes=None,
+                   re_extend=400, cache=None, n_cpus=None, verbose=False):
+    """
+    Computes, for each bin of each resolution, the GC content (Ns are not
+    taken into account), the fraction of Ns and the number of restriction
+    enzyme (RE) sites. All the resolutions are computed in a single pass over
+    the sequence of each chromosome.
 
+    :param genome: a TADbit parsed genome object
+    :param resolutions: a bin size, or a list of bin sizes
+    :param None r_enz: name of the restriction enzyme (or list of names). If
+       None, RE sites are not counted
+    :param None chromosomes: tracks only calculated over these chromosomes
+    :param 400 re_extend: RE sites are counted in each bin extended by this
+       number of nucleotides at its end. Sites are matched as literal strings
+       (no IUPAC ambiguity codes), as in previous versions of tadbit normalize
+    :param None cache: prefix of the files (NumPy .npz format) where to store
+       the tracks, one per resolution. Tracks found there, for the same
+       enzymes and chromosomes, are loaded instead of computed.
+    :param None n_cpus: number of chromosomes to process in parallel
 
-def _get_chr_gc_dico(chrom, reso):
-    gc_content = {}
-    for pos in range(0, len(chrom), reso):
-        seq = chrom[pos:pos + reso]
+    :returns: a dictionary with, for each resolution, a dictionary of tracks:
+       'gc', 'n' and 'rsites' (if r_enz is given). Each track is an ordered
+       dictionary with, for each chromosome, an array with one value per bin.
+       If a single resolution is passed, only its dictionary of tracks is
+       returned.
+    """
+    single = isinstance(resolutions, int)
+    resolutions = [resolutions] if single else list(resolutions)
+    chromosomes = chromosomes if chromosomes else list(genome.keys())
+    if isinstance(r_enz, basestring):
+        r_enz = [r_enz]
+    enzymes = '-'.join(sorted(r_enz)) if r_enz else ''
+    lengths = [len(genome[crm]) for crm in chromosomes]
+
+    cache_name = lambda reso: '%s_%s_%d.npz' % (cache, enzymes or 'noRE', reso)
+    tracks = {}
+    for reso in resolutions:
+        fname = cache_name(reso) if cache else None
+        if not fname or not path.exists(fname):
+            continue
         try:
-            gc_content[pos  /reso] = (float(seq.count('G') + seq.count('C')) /
-                                      (len(seq) - seq.count('N')))
-        except ZeroDivisionError:
-            gc_content[pos  /reso] = float('nan')
-    return gc_content
+            tracks[reso] = _load_bin_tracks(fname, reso, enzymes, re_extend,
+                                            chromosomes, lengths)
+        except (IOError, KeyError, ValueError):
+            pass
+        if tracks.get(reso) is None:
+            del tracks[reso]
+        elif verbose:
+            print('Loaded tracks at %d bp from %s' % (reso, fname))
+
+    missing = [reso for reso in resolutions if not reso in tracks]
+    if missing:
+        re_sites = ([RESTRICTION_ENZYMES[n].replace('|', '') for n in r_enz]
+                    if r_enz else None)
+        if n_cpus and n_cpus > 1:
+            pool = mu.Pool(min(n_cpus, len(chromosomes)))
+            jobs = [pool.apply_async(_get_chr_tracks,
+                                     args=(genome[crm], missing, re_sites,
+                                           re_extend))
+                    for crm in chromosomes]
+            pool.close()
+            pool.join()
+            results = [job.get() for job in jobs]
+        else:
+            results = [_get_chr_tracks(genome[crm], missing, re_sites, re_extend)
+                       for crm in chromosomes]
+        for reso in missing:
+            tracks[reso] = dict(
+                (track, OrderedDict((crm, result[reso][track])
+                                    for crm, result in zip(chromosomes, results)))
+                for track in results[0][reso])
+            if cache:
+                fname = cache_name(reso)
+                try:
+                    with open(fname + '.tmp', 'wb') as out:
+                        np.savez(out, enzymes=np.array(enzymes),
+                                 re_extend=re_extend,
+                                 chromosomes=np.array(chromosomes),
+                                 lengths=np.array(lengths),
+                                 **dict((track, np.concatenate(list(values.values())))
+                                        for track, values in tracks[reso].items()))
+                    rename(fname + '.tmp', fname)
+                except (IOError, OSError):
+                    warn('WARNING: could not write tracks to %s' % fname)
+    if single:
+        return tracks[resolutions[0]]
+    return tracks
+
+
+def _load_bin_tracks(fname, reso, enzymes, re_extend, chromosomes, lengths):
+    """
+    :returns: tracks stored in fname, or None if they correspond to other
+       enzymes or chromosomes
+    """
+    data = np.load(fname)
+    cached = dict(zip(data['chromosomes'].tolist(), data['lengths'].tolist()))
+    if (str(data['enzymes']) != enzymes or int(data['re_extend']) != re_extend or
+        any(cached.get(crm) != length for crm, length in zip(chromosomes, lengths))):
+        return None
+    # position of each chromosome in the concatenated tracks
+    bins = {}
+    pos = 0
+    for crm in data['chromosomes'].tolist():
+        nbins = -(-cached[crm] // reso)
+        bins[crm] = slice(pos, pos + nbins)
+        pos += nbins
+    return dict((track, OrderedDict((crm, data[track][bins[crm]])
+                                    for crm in chromosomes))
+                for track in ('gc', 'n', 'rsites') if track in data)
+
+
+def _seq_bytes(seq):
+    """
+    :returns: the sequence as bytes (no copy for memory-mapped sequences)
+    """
+    if isinstance(seq, MappedSequence):
+        return seq.buffer
+    if isinstance(seq, bytes):
+        return seq
+    return seq.encode()
+
+
+def _get_chr_tracks(seq, resolutions, re_sites=None, re_extend=400,
+                    chunk=10000000):
+    """
+    Computes the tracks of :func:`get_bin_tracks` for one chromosome.
+    Nucleotides are counted by chunks of the sequence, in bins of the greatest
+    common divisor of the resolutions, and these bins are then summed into
+    the bins of each resolution.
+    RE sites are counted like str.count in each extended bin. Sites that
+    cannot overlap with themselves are located once in the chromosome, the
+    others (e.g. GCGC) are counted in each extended bin.
+    """
+    seq = _seq_bytes(seq)
+    arr = np.frombuffer(seq, dtype=np.uint8)
+    size = len(arr)
+    step = reduce(gcd, resolutions)
+    chunk = max(1, chunk // step) * step
+    n_gc = np.zeros(-(-size // step), dtype=np.int64)
+    n_n  = np.zeros(-(-size // step), dtype=np.int64)
+    for beg in range(0, size, chunk):
+        sub = arr[beg:beg + chunk]
+        edges = np.arange(0, len(sub), step)
+        idx = slice(beg // step, beg // step + len(edges))
+        n_gc[idx] = np.add.reduceat((sub == ord('G')) | (sub == ord('C')),
+                                    edges, dtype=np.int64)
+        n_n[idx] = np.add.reduceat(sub == ord('N'), edges, dtype=np.int64)
+    if re_sites:
+        re_sites = [site.encode() if not isinstance(site, bytes) else site
+                    for site in re_sites]
+        overlapping = [site for site in re_sites
+                       if any(site[i:] == site[:len(site) - i]
+                              for i in range(1, len(site)))]
+        sites = [np.array([m.start() for m in re.finditer(re.escape(site), seq)],
+                          dtype=np.int64)
+                 for site in re_sites if not site in overlapping]
+    tracks = {}
+    for reso in resolutions:
+        nbins = -(-size // reso)
+        fold = reso // step
+        bins = np.arange(nbins, dtype=np.int64) * reso
+        lens = np.minimum(bins + reso, size) - bins
+        gc = np.zeros(nbins * fold, dtype=np.int64)
+        gc[:len(n_gc)] = n_gc
+        gc = gc.reshape(nbins, fold).sum(axis=1)
+        ns = np.zeros(nbins * fold, dtype=np.int64)
+        ns[:len(n_n)] = n_n
+        ns = ns.reshape(nbins, fold).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gc = np.where(lens > ns, gc / (lens - ns).astype(float), np.nan)
+        tracks[reso] = {'gc': gc, 'n': ns / lens.astype(float)}
+        if re_sites:
+            # sites fully inside each bin extended by re_extend at its end
+            ends = np.minimum(bins + reso + re_extend, size)
+            rsites = np.zeros(nbins, dtype=np.int64)
+            for site, starts in zip([site for site in re_sites
+                                     if not site in overlapping], sites):
+                rsites += np.maximum(
+                    np.searchsorted(starts, ends - len(site), side='right') -
+                    np.searchsorted(starts, bins, side='left'), 0)
+            for site in overlapping:
+                rsites += [bytes(seq[beg:end]).count(site)
+                           for beg, end in zip(bins.tolist(), ends.tolist())]
+            tracks[reso]['rsites'] = rsites
+    return tracks
@@ -14,8 +14,10 @@ except ImportError:
     from pickle                      import load
 from time                         import sleep
 from collections                  import OrderedDict
+from itertools                    import chain
 from subprocess                   import Popen, PIPE
 from math                         import isnan
+from functools                    import reduce
 from random                       import getrandbits
 from tarfile                      import open as taropen
 from io                           import StringIO
@@ -25,6 +27,13 @@ from distutils.version            import LooseVersion
 import os
 import multiprocessing as mu
 
+import numpy as np
+
+try:
+    from math                     import gcd
+except ImportError:  # python 2
+    from fractions                import gcd
+
 try:
     from lockfile                 import LockFile
 except ImportError:
@@ -33,9 +42,10 @@ except ImportError:
 from pysam                        import AlignmentFile
 
 from pytadbit.utils                 import printime
-from pytadbit.utils.file_handling   import mkdir, which
+from pytadbit.utils.file_handling   import mkdir, which, magic_open
 from pytadbit.utils.extraviews      import nicer
 from pytadbit.mapping.filter        import MASKED
+from pytadbit.parsers.bam_core_parser import bam_index_path, iter_core_fields
 try:
     from pytadbit.parsers.cooler_parser import cooler_file
 except ImportError:
@@ -242,15 +252,12 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
 
     # write header
     output += ("\t".join(("@HD" ,"VN:1.5", "SO:queryname")) + '\n')
-    fhandler = open(infile)
+    fhandler = magic_open(infile)
     line = next(fhandler)
     # chromosome lengths
-    pos_fh = 0
-
     while line.startswith('#'):
         (_, _, cr, ln) = line.replace("\t", " ").strip().split(" ")
         output += ("\t".join(("@SQ", "SN:" + cr, "LN:" + ln)) + '\n')
-        pos_fh += len(line)
         line = next(fhandler)
 
     # filter codes
@@ -277,7 +284,7 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
     # open and init filter files
     if not valid:
         filter_line, filter_handler = get_filters(infile, masked)
-    fhandler.seek(pos_fh)
+    lines = chain([line], fhandler)
     # check samtools version number and modify command line
     version = LooseVersion([l.split()[1]
                             for l in Popen(samtools, stderr=PIPE,
@@ -298,12 +305,12 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
         map2sam = _map2sam_short
 
     if valid:
-        for line in fhandler:
+        for line in lines:
             flag = 0
             # get output in sam format
             proc.stdin.write(map2sam(line, flag))
     else:
-        for line in fhandler:
+        for line in lines:
             flag = 0
             # check if read matches any filter
             rid = line.split("\t")[0]
@@ -363,55 +370,294 @@ def get_filters(infile, masked):
     return filter_line, filter_handler
 
 
-def _read_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
+def _frag_fname(tmpdir, rand_hash, region, start, end, binary=False):
+    """
+    Path to the temporary file holding the sub-matrix of one chunk of the BAM
+    """
+    return os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
+                        '%s:%d-%d.%s' % (region, start, end,
+                                         'npy' if binary else 'tsv'))
+
+
+def _write_matrix_frag(frag, region, fname, binary=False):
+    """
+    Writes the interactions of one chunk of the BAM.
+
+    :param frag: array of int32 with one row per pair of bins and four
+       columns: bin1, bin2, number of interactions and a cis flag (1 for
+       intra-chromosomal interactions)
+    :param region: chromosome name of the chunk
+    :param fname: path to output file
+    :param False binary: if True the chunk is stored as a NumPy array (.npy),
+       otherwise as tab separated text (chromosome name, empty for
+       inter-chromosomal interactions, bin1, bin2 and interactions).
+    """
+    if binary:
+        np.save(fname, frag)
+        return
+    out = open(fname, 'w')
+    out.write(''.join('%s\t%d\t%d\t%d\n' % (region if c else '', a, b, v)
+                      for a, b, v, c in frag.tolist()))
+    out.close()
+
+
+class GenomeBins(object):
+    """
+    Index of the genomic bins of a list of chromosomes, at a given resolution.
+    Only the position of the first bin of each chromosome is stored, lookups
+    are arithmetic. Replaces lists of (chromosome, bin) tuples, and
+    dictionaries of these tuples to their index in the genomic matrix.
+
+    :param sections: ordered dictionary with chromosome names as keys, and
+       their number of bins as values
+    :param resolution: size of the bins in nucleotides
+    """
+    def __init__(self, sections, resolution):
+        self.chromosomes = list(sections)
+        self.resolution  = resolution
+        self.offsets = np.zeros(len(self.chromosomes) + 1, dtype=np.int64)
+        np.cumsum([sections[c] for c in self.chromosomes],
+                  out=self.offsets[1:])
+        self._crm_idx = dict((c, i) for i, c in enumerate(self.chromosomes))
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, idx):
+        """
+        :returns: the chromosome name and the position of the bin in this
+           chromosome
+        """
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('ERROR: bin %d out of genome' % idx)
+        c = int(np.searchsorted(self.offsets, idx, side='right')) - 1
+        return self.chromosomes[c], idx - int(self.offsets[c])
+
+    def index(self, crm, pos):
+        """
+        :returns: index in the genomic matrix of the bin number pos of
+           chromosome crm
+        """
+        return int(self.offsets[self._crm_idx[crm]]) + pos
+
+    def section_pos(self, crm):
+        """
+        :returns: index of the first bin of the chromosome, and of the first
+           bin after it
+        """
+        c = self._crm_idx[crm]
+        return int(self.offsets[c]), int(self.offsets[c + 1])
+
+    def bam_offsets(self, refs, start=0, end=None):
+        """
+        Summarizes the bins between start and end (not included) into three
+        arrays, indexed by reference ID in the BAM: first bin, last bin (not
+        included) and offset to add to a bin to get its index in the matrix
+        starting at start (see _bins_from_positions).
+
+        :param refs: list of chromosome names in the BAM
+        :param 0 start: index of the first bin of the matrix
+        :param None end: index of the last bin of the matrix (not included),
+           by default last bin of the genome
+        """
+        if end is None:
+            end = len(self)
+        firsts = np.zeros(len(refs), dtype=np.int64)
+        lasts  = np.zeros(len(refs), dtype=np.int64)
+        offset = np.zeros(len(refs), dtype=np.int64)
+        for i, crm in enumerate(refs):
+            try:
+                beg_crm, end_crm = self.section_pos(crm)
+            except KeyError:  # chromosome not in the matrix
+                continue
+            beg, fin = max(beg_crm, start), min(end_crm, end)
+            if beg < fin:
+                firsts[i] = beg - beg_crm
+                lasts[i]  = fin - beg_crm
+                offset[i] = beg_crm - start
+        return firsts, lasts, offset
+
+    def chunks(self, start_bin, end_bin, nchunks):
+        """
+        Splits the bins between start_bin and end_bin in chunks of (roughly)
+        equal number of bins, each chunk being in a single chromosome.
+
+        :returns: three lists: chromosome, first and last nucleotide of each
+           chunk (the last one not included, except for the last chunk)
+        """
+        resolution = self.resolution
+        total = end_bin - start_bin
+        regs  = []
+        begs  = []
+        ends  = []
+        njobs = min(total, nchunks) + 1
+        nbins = total // njobs + 1
+        for i in range(start_bin, end_bin, nbins):
+            if i + nbins > end_bin:  # make sure that we stop at the right place
+                nbins = end_bin - i
+            (crm1, beg1), (crm2, fin2) = self[i], self[min(i + nbins,
+                                                           len(self)) - 1]
+            if crm1 != crm2:
+                fin1 = self.section_pos(crm1)[1] - self.section_pos(crm1)[0]
+                regs.append(crm1)
+                begs.append(beg1 * resolution)
+                ends.append(fin1 * resolution + resolution)  # last nt included
+                # be sure we don't miss chromosomes in between the start and end bins
+                for c in range(self._crm_idx[crm1] + 1, self._crm_idx[crm2]):
+                    crm = self.chromosomes[c]
+                    regs.append(crm)
+                    begs.append(0)
+                    ends.append(int(self.offsets[c + 1] - self.offsets[c]) *
+                                resolution + resolution - 1)
+                regs.append(crm2)
+                begs.append(0)
+                ends.append(fin2 * resolution + resolution - 1)  # last nt not included (overlap with next window)
+            else:
+                regs.append(crm1)
+                begs.append(beg1 * resolution)
+                ends.append(fin2 * resolution + resolution - 1)
+        ends[-1] += 1  # last nucleotide included
+        return regs, begs, ends
+
+
+def _bins_from_positions(refids, positions, resolution, offsets):
+    """
+    Maps genomic positions to the index of their bin in the matrix.
+
+    :returns: the array of bin indexes and the boolean mask of positions
+       falling inside the matrix
+    """
+    firsts, lasts, offset = offsets
+    bins = positions // resolution
+    inside = (bins >= firsts[refids]) & (bins < lasts[refids])
+    return bins + offset[refids], inside
+
+
+def _iter_bam_core(bamfile, region, start, end, batch_size=1000000):
+    """
+    Iterates over the reads of a region of the BAM by batches, as arrays of
+    flags, positions, mate reference IDs and mate positions.
+    If the BAM has a BAI index, only the fixed fields of the records are
+    decoded (see :func:`pytadbit.parsers.bam_core_parser.iter_core_fields`),
+    otherwise reads are fetched with pysam (e.g. with a CSI index).
+    Reads before the region, or not overlapping it, may be included.
+    """
+    inbam = bamfile.filename
+    if isinstance(inbam, bytes) and not isinstance(inbam, str):
+        inbam = inbam.decode()
+    index = bam_index_path(inbam)
+    if index:
+        for records in iter_core_fields(inbam, bamfile.get_tid(region), start,
+                                        end, index=index):
+            yield (records['flag'], records['pos'], records['next_refid'],
+                   records['next_pos'])
+        return
+    if not bamfile.has_index():
+        raise Exception('ERROR: index of %s not found, run "samtools index" '
+                        'on it' % inbam)
+    flags, pos1, refs2, pos2 = [], [], [], []
+    for r in bamfile.fetch(region=region, start=start, end=end,
+                           multiple_iterators=True):
+        flags.append(r.flag)
+        pos1.append(r.reference_start)
+        refs2.append(r.next_reference_id)
+        pos2.append(r.next_reference_start)
+        if len(flags) == batch_size:
+            yield tuple(np.array(l) for l in (flags, pos1, refs2, pos2))
+            flags, pos1, refs2, pos2 = [], [], [], []
+    yield tuple(np.array(l, dtype=np.int64) for l in (flags, pos1, refs2, pos2))
+
+
+def _count_pixels(bamfile, region, start, end, filter_exclude, resolution,
+                  offsets1, offsets2, half=False, batch_size=1000000):
+    """
+    Counts the number of interactions between pairs of bins in a chunk of the
+    BAM. Positions, mate positions and flags are pulled by batches into arrays,
+    and pixels are counted over a linearized index.
+    Only reads starting between start and end (1-based, included) are counted,
+    as reads before the chunk are also pulled from the BAM (up to the beginning
+    of the window of the index), and belong to the previous chunks.
+
+    :returns: an array of int32 with one row per pair of bins, and four
+       columns: bin1, bin2, number of interactions and a cis flag
+    """
+    nrows = int((offsets2[1] + offsets2[2]).max()) + 1
+    tid  = bamfile.get_tid(region)
+    keys = []
+    cnts = []
+    for flag, ps1, ref2, ps2 in _iter_bam_core(bamfile, region, max(0, start - 2),
+                                               end, batch_size):
+        flag = flag.astype(np.int64)
+        ref2 = ref2.astype(np.int64)
+        # BAM coordinates starts at 0
+        ps1  = ps1.astype(np.int64) + 1
+        ps2  = ps2.astype(np.int64) + 1
+        ref1 = np.full(len(ps1), tid, dtype=np.int64)
+        keep = ((flag & filter_exclude) == 0) & (ps1 >= start) & (ps1 <= end)
+        bin1, in1 = _bins_from_positions(ref1, ps1, resolution, offsets1)
+        bin2, in2 = _bins_from_positions(ref2, ps2, resolution, offsets2)
+        keep &= in1 & in2  # not in the subset matrix we want
+        if half:
+            keep &= bin1 <= bin2
+        pix, cnt = np.unique((bin1[keep] * nrows + bin2[keep]) * 2 +
+                             (ref1[keep] == ref2[keep]), return_counts=True)
+        keys.append(pix)
+        cnts.append(cnt)
+    if not keys:
+        keys.append(np.empty(0, dtype=np.int64))
+        cnts.append(np.empty(0, dtype=np.int64))
+    return _pixels_to_frag(np.concatenate(keys), np.concatenate(cnts), nrows)
+
+
+def _pixels_to_frag(pix, cnt, nrows):
+    """
+    Sums the interactions of each pixel, given as a linearized index of the
+    pixel ((bin1 * nrows + bin2) * 2 + cis flag).
+
+    :returns: an array of int32 with one row per pair of bins, and four
+       columns: bin1, bin2, number of interactions and a cis flag
+    """
+    pix, inverse = np.unique(pix, return_inverse=True)
+    cnt = np.bincount(inverse, weights=cnt)
+    frag = np.empty((len(pix), 4), dtype=np.int32)
+    frag[:, 0] = pix // 2 // nrows
+    frag[:, 1] = pix // 2 % nrows
+    frag[:, 2] = cnt
+    frag[:, 3] = pix % 2
+    return frag
+
+
+def _sum_frag_columns(frag):
+    """
+    :returns: the sum of interactions per row, and the number of trans and cis
+       interactions per row, as dictionaries
+    """
+    sumcol = {}
+    cisprc = {}
+    for i, _, v, c in frag.tolist():
+        try:
+            sumcol[i] += v
+            cisprc[i][c] += v
+        except KeyError:
+            sumcol[i]  = v
+            cisprc[i]  = [0, 0]
+            cisprc[i][c] += v
+    return sumcol, cisprc
+
+
+def _read_bam_frag(inbam, filter_exclude, offsets1, offsets2,
                    rand_hash, resolution, tmpdir, region, start, end,
-                   sum_columns=False):
+                   sum_columns=False, binary=False, half=False):
     bamfile = AlignmentFile(inbam, 'rb')
-    refs = bamfile.references
-    bam_start = start - 2
-    bam_start = max(0, bam_start)
     try:
-        dico = {}
-        for r in bamfile.fetch(region=region,
-                               start=bam_start, end=end,  # coords starts at 0
-                               multiple_iterators=True):
-            if r.flag & filter_exclude:
-                continue
-            crm1 = r.reference_name
-            pos1 = r.reference_start + 1
-            crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
-            try:
-                pos1 = sections1[(crm1, pos1 // resolution)]
-                pos2 = sections2[(crm2, pos2 // resolution)]
-            except KeyError:
-                continue  # not in the subset matrix we want
-            crm = crm1 * (crm1 == crm2)
-            try:
-                dico[(crm, pos1, pos2)] += 1
-            except KeyError:
-                dico[(crm, pos1, pos2)] = 1
-            # print '%-50s %5s %9s %5s %9s' % (r.query_name,
-            #                                  crm1, r.reference_start + 1,
-            #                                  crm2, r.mpos + 1)
-        out = open(os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                                '%s:%d-%d.tsv' % (region, start, end)), 'w')
-        out.write(''.join('%s\t%d\t%d\t%d\n' % (c, a, b, v)
-                          for (c, a, b), v in dico.items()))
-        out.close()
+        frag = _count_pixels(bamfile, region, start, end, filter_exclude,
+                             resolution, offsets1, offsets2, half=half)
+        _write_matrix_frag(frag, region, _frag_fname(tmpdir, rand_hash, region,
+                                                     start, end, binary), binary)
         if sum_columns:
-            sumcol = {}
-            cisprc = {}
-            for (c, i, j), v in dico.items():
-                # out.write('%d\t%d\t%d\n' % (i, j, v))
-                try:
-                    sumcol[i] += v
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-                except KeyError:
-                    sumcol[i]  = v
-                    cisprc[i]  = [0, 0]
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-            return sumcol, cisprc
+            return _sum_frag_columns(frag)
     except Exception as e:
         exc_type, exc_obj, exc_tb = exc_info()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
@@ -419,81 +665,20 @@ def _read_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
         print(exc_type, fname, exc_tb.tb_lineno)
 
 
-def _read_half_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
+def _read_half_bam_frag(inbam, filter_exclude, offsets1, offsets2,
                         rand_hash, resolution, tmpdir, region, start, end,
-                        sum_columns=False):
-    bamfile = AlignmentFile(inbam, 'rb')
-    refs = bamfile.references
-    bam_start = start - 2
-    bam_start = max(0, bam_start)
-    section_pos = []
-    for sec in sections1:
-        if sec not in section_pos:
-            section_pos.append(sec[0])
-    for sec in sections2:
-        if sec not in section_pos:
-            section_pos.append(sec[0])
-    try:
-        dico = {}
-        for r in bamfile.fetch(region=region,
-                               start=bam_start, end=end,  # coords starts at 0
-                               multiple_iterators=True):
-            if r.flag & filter_exclude:
-                continue
-            crm1 = r.reference_name
-            pos1 = r.reference_start + 1
-            crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
-            try:
-                pos1 = sections1[(crm1, pos1 // resolution)]
-                pos2 = sections2[(crm2, pos2 // resolution)]
-            except KeyError:
-                continue  # not in the subset matrix we want
-            if crm1 == crm2:
-                crm = crm1
-                if pos1 > pos2:
-                    continue
-            else:
-                if pos1 > pos2:
-                    continue
-                crm = ''
-            try:
-                dico[(crm, pos1, pos2)] += 1
-            except KeyError:
-                dico[(crm, pos1, pos2)] = 1
-            # print '%-50s %5s %9s %5s %9s' % (r.query_name,
-            #                                  crm1, r.reference_start + 1,
-            #                                  crm2, r.mpos + 1)
-        out = open(os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                                '%s:%d-%d.tsv' % (region, start, end)), 'w')
-        out.write(''.join('%s\t%d\t%d\t%d\n' % (c, a, b, v)
-                          for (c, a, b), v in dico.items()))
-        out.close()
-        if sum_columns:
-            sumcol = {}
-            cisprc = {}
-            for (c, i, j), v in dico.items():
-                # out.write('%d\t%d\t%d\n' % (i, j, v))
-                try:
-                    sumcol[i] += v
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-                except KeyError:
-                    sumcol[i]  = v
-                    cisprc[i]  = [0, 0]
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-            return sumcol, cisprc
-    except Exception as e:
-        exc_type, exc_obj, exc_tb = exc_info()
-        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        print(e)
-        print(exc_type, fname, exc_tb.tb_lineno)
+                        sum_columns=False, binary=False):
+    return _read_bam_frag(inbam, filter_exclude, offsets1,
+                          offsets2, rand_hash, resolution, tmpdir, region,
+                          start, end, sum_columns=sum_columns, binary=binary,
+                          half=True)
 
 
 def read_bam(inbam, filter_exclude, resolution, ncpus=8,
              region1=None, start1=None, end1=None,
              region2=None, start2=None, end2=None, nchunks=100,
              tmpdir='.', verbose=True, normalize=False, max_size=None,
-             chr_order=None, half=False):
+             chr_order=None, half=False, binary=False):
 
     bamfile = AlignmentFile(inbam, 'rb')
     bam_refs = bamfile.references
@@ -511,30 +696,20 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
     sections = OrderedDict(list(zip(bam_refs,
                                [x // resolution + 1 for x in bam_lengths])))
     # get chromosomes and genome sizes
-    total = 0
-    section_pos = dict()
-    for crm in sections:
-        section_pos[crm] = (total, total + sections[crm])
-        total += sections[crm]
-
-    # define genomic bins
-    bins = []
-    for crm in sections:
-        len_crm = sections[crm]
-        bins.extend([(crm, i) for i in range(len_crm)])
-    if not bins:
-        raise Exception('ERROR: Chromosome %s smaller than bin size\n' % (crm))
+    bins = GenomeBins(sections, resolution)
+    section_pos = dict((crm, bins.section_pos(crm)) for crm in sections)
+    if not len(bins):
+        raise Exception('ERROR: Chromosome %s smaller than bin size\n' % (
+            ' '.join(bam_refs)))
 
     # define start, end position of region to grab
-    start_bin1 = 0
-    end_bin1   = len(bins) + 1
     regions = bam_refs
+    total = len(bins)
     if region1:
         regions = [region1]
         if region2:
             regions.append(region2)
     else:
-        total = len(bins)
         if start1 is not None or end1:
             raise Exception('ERROR: Cannot use start/end1 without region')
 
@@ -557,71 +732,11 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
             end1 = total * resolution
 
     # define chunks, using at most 100 sub-divisions of region1
-    total = end_bin1 - start_bin1
-    regs  = []
-    begs  = []
-    ends  = []
-
-    njobs = min(total, nchunks) + 1
+    regs, begs, ends = bins.chunks(start_bin1, end_bin1, nchunks)
 
-    nbins = total // njobs + 1
-    for i in range(start_bin1, end_bin1, nbins):
-        if i + nbins > end_bin1:  # make sure that we stop at the right place
-            nbins = end_bin1 - i
-        try:
-            (crm1, beg1), (crm2, fin2) = bins[i], bins[i + nbins - 1]
-        except IndexError:
-            (crm1, beg1), (crm2, fin2) = bins[i], bins[-1]
-        if crm1 != crm2:
-            fin1 = sections[crm1]
-            regs.append(crm1)
-            begs.append(beg1 * resolution)
-            ends.append(fin1 * resolution + resolution)  # last nt included
-            # be sure we don't miss regions in between the start and end bins
-            start_chunk = i+fin1-beg1
-            end_chunk = i + nbins - 1 if i + nbins - 1 < len(bins) else len(bins) - 1
-            (crm1, beg1) = bins[start_chunk]
-            fin1 = beg1
-            for j in range(start_chunk, end_chunk+1):
-                (crm2, beg2) = bins[j]
-                if crm1 == crm2:
-                    fin1 = beg2
-                    continue
-                regs.append(crm1)
-                begs.append(beg1 * resolution)
-                fin1 = sections[crm1]
-                ends.append(fin1 * resolution + resolution - 1)  # last nt not included (overlap with next window)
-                (crm1, beg1) = (crm2, beg2)
-            regs.append(crm1)
-            begs.append(beg1 * resolution)
-            ends.append(fin1 * resolution + resolution - 1)  # last nt not included (overlap with next window)
-        else:
-            regs.append(crm1)
-            begs.append(beg1 * resolution)
-            ends.append(fin2 * resolution + resolution - 1)
-    ends[-1] += 1  # last nucleotide included
-    # reduce dictionaries
-    all_bins = []
-    seenbins = set()
-    for crm in regions:
-        beg_crm = section_pos[crm][0]
-        if region1:
-            start = start_bin1 - beg_crm
-            end   = end_bin1   - beg_crm
-        else:
-            start = 0
-            end   = section_pos[crm][1] - section_pos[crm][0]
-        all_bins.extend([(crm, i) for i in range(start, end)
-                          if not (crm, i) in seenbins])
-        seenbins = set(all_bins)
-    del(seenbins)
-
-    bins_dict1 = dict((j, i) for i, j in enumerate(all_bins))
     if region2:
         if not region2 in section_pos:
             raise Exception('ERROR: chromosome %s not found' % region2)
-        bins = []
-        beg_crm = section_pos[region2][0]
         if start2 is not None:
             start_bin2 = section_pos[region2][0] + start2 // resolution
         else:
@@ -632,14 +747,12 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
         else:
             end_bin2   = section_pos[region2][1]
             end2       = sections[region2] * resolution
-        start = start_bin2 - beg_crm
-        end   = end_bin2   - beg_crm
-        bins = [(region2, i) for i in range(start, end)]
-        bins_dict2 = dict([(j, i) for i, j in enumerate(bins)])
     else:
         start_bin2 = start_bin1
         end_bin2 = end_bin1
-        bins_dict2 = bins_dict1
+    # where to find the bins of each chromosome in the sub-matrices
+    offsets1 = bins.bam_offsets(bamfile.references, start_bin1, end_bin1)
+    offsets2 = bins.bam_offsets(bamfile.references, start_bin2, end_bin2)
 
     size1 = end_bin1 - start_bin1
     size2 = end_bin2 - start_bin2
@@ -657,21 +770,18 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
     if verbose:
         printime('\n  - Parsing BAM (%d chunks)' % (len(regs)))
     mkdir(os.path.join(tmpdir, '_tmp_%s' % (rand_hash)))
-    # empty all_bins array if we are not going to normalize
-    if not normalize:
-        all_bins = []
     procs = []
     read_bam_frag = _read_half_bam_frag if half else _read_bam_frag
     for i, (region, b, e) in enumerate(zip(regs, begs, ends)):
         if ncpus == 1:
-            read_bam_frag(inbam, filter_exclude, all_bins,
-                          bins_dict1, bins_dict2, rand_hash,
-                          resolution, tmpdir, region, b, e)
+            read_bam_frag(inbam, filter_exclude, offsets1, offsets2, rand_hash,
+                          resolution, tmpdir, region, b, e, binary=binary)
         else:
             procs.append(pool.apply_async(
-                read_bam_frag, args=(inbam, filter_exclude, all_bins,
-                                     bins_dict1, bins_dict2, rand_hash,
-                                     resolution, tmpdir, region, b, e,)))
+                read_bam_frag, args=(inbam, filter_exclude, offsets1,
+                                     offsets2, rand_hash,
+                                     resolution, tmpdir, region, b, e,),
+                kwds={'binary': binary}))
     pool.close()
     if verbose:
         print_progress(procs)
@@ -681,8 +791,201 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
     return regions, rand_hash, bin_coords, chunks
 
 
-def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
-                       include_chunk_count=False):
+def _coarsen_frag(frag, bins1, bins2, ratio, nrows):
+    """
+    Sums the interactions of a sub-matrix into bins ratio times larger.
+
+    :param bins1: first bin of each chromosome in the rows of the sub-matrix,
+       and in the rows of the coarser sub-matrix (two arrays)
+    :param bins2: same as bins1 for the columns
+    :param nrows: number of columns of the coarser sub-matrix
+    """
+    coarse = []
+    for col, (fine_starts, coarse_starts) in ((0, bins1), (1, bins2)):
+        pos = frag[:, col].astype(np.int64)
+        crm = np.searchsorted(fine_starts, pos, side='right') - 1
+        coarse.append(coarse_starts[crm] + (pos - fine_starts[crm]) // ratio)
+    return _pixels_to_frag((coarse[0] * nrows + coarse[1]) * 2 + frag[:, 3],
+                           frag[:, 2], nrows)
+
+
+def _frag_marginals(frag, half=False):
+    """
+    :returns: the rows of a sub-matrix and their sum of interactions (if half,
+       interactions of the columns are added, out of the diagonal)
+    """
+    rows, vals = frag[:, 0], frag[:, 2].astype(np.int64)
+    if half:
+        out = frag[:, 0] != frag[:, 1]
+        rows = np.concatenate((rows, frag[out, 1]))
+        vals = np.concatenate((vals, vals[out]))
+    rows, inverse = np.unique(rows, return_inverse=True)
+    return rows, np.bincount(inverse, weights=vals).astype(np.int64)
+
+
+def _read_bam_frag_multires(inbam, filter_exclude, offsets1, offsets2,
+                            resolutions, coarse_bins, rand_hashes, tmpdir,
+                            region, start, end, half=False):
+    """
+    Counts the interactions of a chunk of the BAM at the finest resolution,
+    and sums them into each coarser resolution. Sub-matrices are written as
+    binary arrays.
+
+    :returns: for each resolution, the rows of the chunk and their sum of
+       interactions (see _frag_marginals)
+    """
+    bamfile = AlignmentFile(inbam, 'rb')
+    try:
+        # the half matrix is taken after coarsening, as interactions below
+        # the diagonal at the finest resolution can end up on the diagonal
+        frag = _count_pixels(bamfile, region, start, end, filter_exclude,
+                             resolutions[0], offsets1, offsets2)
+    finally:
+        bamfile.close()
+    marginals = []
+    for reso, rand_hash in zip(resolutions, rand_hashes):
+        if reso != resolutions[0]:
+            bins1, bins2, nrows = coarse_bins[reso]
+            frag_reso = _coarsen_frag(frag, bins1, bins2,
+                                      reso // resolutions[0], nrows)
+        else:
+            frag_reso = frag
+        if half:
+            frag_reso = frag_reso[frag_reso[:, 0] <= frag_reso[:, 1]]
+        _write_matrix_frag(frag_reso, region, _frag_fname(
+            tmpdir, rand_hash, region, start, end, True), True)
+        marginals.append(_frag_marginals(frag_reso, half=half))
+    return marginals
+
+
+def check_resolutions(resolutions):
+    """
+    Checks a list of resolutions given to a tool, to be read with
+    :func:`read_bam_multires`.
+
+    :returns: the resolution if only one is given, otherwise the sorted list
+       of resolutions
+    """
+    if isinstance(resolutions, int):
+        return resolutions
+    resolutions = sorted(set(resolutions))
+    if len(resolutions) == 1:
+        return resolutions[0]
+    if any(reso % resolutions[0] for reso in resolutions):
+        raise Exception('ERROR: resolutions should be multiples of %d' % (
+            resolutions[0]))
+    return resolutions
+
+
+def read_bam_multires(inbam, filter_exclude, resolutions, ncpus=8,
+                      region1=None, region2=None, nchunks=100, tmpdir='.',
+                      verbose=True, chr_order=None, half=False):
+    """
+    Reads the BAM file once, and counts interactions at several resolutions.
+    Pairs of reads are binned at the finest resolution, and coarser matrices
+    are obtained by summing these bins. Chunks of the BAM are aligned to the
+    bins of all resolutions, each sub-matrix being thus complete.
+
+    :param resolutions: list of resolutions, all multiples of the finest one
+    :param None region1: chromosome name of the rows of the matrices (all
+       the genome by default)
+    :param None region2: chromosome name of the columns of the matrices
+
+    :returns: two dictionaries with resolutions as keys: the first with
+       the values returned by :func:`read_bam` (sub-matrices are stored in
+       binary format), the second with the sum of interactions per row of the
+       matrix
+    """
+    resolutions = sorted(set(resolutions))
+    finest = resolutions[0]
+    if any(reso % finest for reso in resolutions):
+        raise Exception('ERROR: resolutions should be multiples of %d' % finest)
+    # chunks have to start and end at bin borders in all resolutions
+    chunk_reso = reduce(lambda a, b: a * b // gcd(a, b), resolutions)
+
+    bamfile = AlignmentFile(inbam, 'rb')
+    bam_refs = bamfile.references
+    bam_lengths = bamfile.lengths
+    if chr_order:
+        lengths = dict(zip(bam_refs, bam_lengths))
+        bam_refs = [crm for crm in chr_order if crm in lengths]
+        if not bam_refs:
+            raise Exception('''ERROR: Wrong number of chromosomes in chr_order.
+                Found %s in bam file \n''' % (' '.join(lengths)))
+        bam_lengths = [lengths[crm] for crm in bam_refs]
+    regions = [region1, region2] if region2 else [region1] if region1 else bam_refs
+    for region in regions:
+        if not region in bam_refs:
+            raise Exception('ERROR: chromosome %s not found' % region)
+    matrix_crms1 = [region1] if region1 else list(bam_refs)
+    matrix_crms2 = [region2] if region2 else matrix_crms1
+
+    def genome_bins(reso):
+        return GenomeBins(OrderedDict((c, l // reso + 1)
+                                      for c, l in zip(bam_refs, bam_lengths)), reso)
+
+    def matrix_bins(bins, crms):
+        # first bin of each chromosome in the matrix
+        starts = np.array([bins.section_pos(c)[0] for c in crms], dtype=np.int64)
+        return starts - starts[0], bins.section_pos(crms[0])[0], bins.section_pos(crms[-1])[1]
+
+    bins = dict((reso, genome_bins(reso)) for reso in resolutions)
+    bin_coords = {}
+    matrix_starts = {}
+    for reso in resolutions:
+        starts1, start_bin1, end_bin1 = matrix_bins(bins[reso], matrix_crms1)
+        starts2, start_bin2, end_bin2 = matrix_bins(bins[reso], matrix_crms2)
+        bin_coords[reso] = start_bin1, end_bin1, start_bin2, end_bin2
+        matrix_starts[reso] = starts1, starts2
+    # first bin of each chromosome in the finest and in the coarser matrices,
+    # for rows and columns, and number of columns of the coarser matrices
+    coarse_bins = dict(
+        (reso, ((matrix_starts[finest][0], matrix_starts[reso][0]),
+                (matrix_starts[finest][1], matrix_starts[reso][1]),
+                bin_coords[reso][3] - bin_coords[reso][2]))
+        for reso in resolutions)
+
+    chunk_bins = genome_bins(chunk_reso)
+    regs, begs, ends = chunk_bins.chunks(
+        chunk_bins.section_pos(matrix_crms1[0])[0],
+        chunk_bins.section_pos(matrix_crms1[-1])[1], nchunks)
+    start_bin1, end_bin1, start_bin2, end_bin2 = bin_coords[finest]
+    offsets1 = bins[finest].bam_offsets(bamfile.references, start_bin1, end_bin1)
+    offsets2 = bins[finest].bam_offsets(bamfile.references, start_bin2, end_bin2)
+    bamfile.close()
+
+    rand_hashes = ["%016x" % getrandbits(64) for _ in resolutions]
+    for rand_hash in rand_hashes:
+        mkdir(os.path.join(tmpdir, '_tmp_%s' % (rand_hash)))
+    if verbose:
+        printime('\n  - Parsing BAM (%d chunks) at %s' % (
+            len(regs), ', '.join(nicer(reso) for reso in resolutions)))
+    pool = mu.Pool(ncpus)
+    procs = [pool.apply_async(
+        _read_bam_frag_multires, args=(inbam, filter_exclude, offsets1,
+                                       offsets2, resolutions, coarse_bins,
+                                       rand_hashes, tmpdir, region, b, e),
+        kwds={'half': half})
+             for region, b, e in zip(regs, begs, ends)]
+    pool.close()
+    if verbose:
+        print_progress(procs)
+    pool.join()
+
+    reads = OrderedDict()
+    marginals = OrderedDict()
+    for reso, rand_hash in zip(resolutions, rand_hashes):
+        reads[reso] = regions, rand_hash, bin_coords[reso], (regs, begs, ends)
+        start_bin1, end_bin1 = bin_coords[reso][:2]
+        marginals[reso] = np.zeros(end_bin1 - start_bin1, dtype=np.int64)
+    for proc in procs:
+        for reso, (rows, vals) in zip(resolutions, proc.get()):
+            marginals[reso][rows] += vals
+    return reads, marginals
+
+
+def _iter_frag_fnames(chunks, tmpdir, rand_hash, clean=False, verbose=True,
+                      binary=False):
     if verbose:
         stdout.write('     ')
     countbin = 0
@@ -695,8 +998,43 @@ def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
             stdout.write('.')
             stdout.flush()
 
-        fname = os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                             '%s:%d-%d.tsv' % (region, start, end))
+        fname = _frag_fname(tmpdir, rand_hash, region, start, end, binary)
+        yield countbin, region, fname
+        if clean:
+            os.system('rm -f %s' % fname)
+    if verbose:
+        print('%s %9s\n' % (' ' * (54 - (countbin % 50) - (countbin % 50) // 10),
+                            '%s/%s' % (len(chunks[0]),len(chunks[0]))))
+
+
+def _iter_matrix_arrays(chunks, tmpdir, rand_hash, clean=False, verbose=True):
+    """
+    Yields, for each chunk written in binary mode, the chunk number, the
+    chromosome name and the array of interactions (columns: bin1, bin2,
+    number of interactions and cis flag).
+    Arrays are memory-mapped, and should not be used after the next
+    iteration if clean is True.
+    """
+    for countbin, region, fname in _iter_frag_fnames(
+            chunks, tmpdir, rand_hash, clean=clean, verbose=verbose,
+            binary=True):
+        yield countbin, region, np.load(fname, mmap_mode='r')
+
+
+def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
+                       include_chunk_count=False, binary=False):
+    if binary:
+        for countbin, region, frag in _iter_matrix_arrays(
+                chunks, tmpdir, rand_hash, clean=clean, verbose=verbose):
+            if include_chunk_count:
+                for a, b, v, cis in frag.tolist():
+                    yield countbin, region if cis else '', a, b, v
+            else:
+                for a, b, v, cis in frag.tolist():
+                    yield region if cis else '', a, b, v
+        return
+    for countbin, _, fname in _iter_frag_fnames(
+            chunks, tmpdir, rand_hash, clean=clean, verbose=verbose):
         if include_chunk_count:
             for l in open(fname):
                 c, a, b, v = l.split('\t')
@@ -705,11 +1043,6 @@ def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
             for l in open(fname):
                 c, a, b, v = l.split('\t')
                 yield c, int(a), int(b), int(v)
-        if clean:
-            os.system('rm -f %s' % fname)
-    if verbose:
-        print('%s %9s\n' % (' ' * (54 - (countbin % 50) - (countbin % 50) // 10),
-                            '%s/%s' % (len(chunks[0]),len(chunks[0]))))
 
 
 def get_biases_region(biases, bin_coords, check_resolution=None):
@@ -748,12 +1081,39 @@ def get_biases_region(biases, bin_coords, check_resolution=None):
     return bias1, bias2, decay, bads1, bads2
 
 
+def _bias_array(bias, size):
+    """
+    Converts a dictionary of biases into an array (missing biases are NaN)
+    """
+    arr = np.full(size, np.nan)
+    for k, v in bias.items():
+        if 0 <= k < size:
+            arr[k] = v
+    return arr
+
+
+def _filter_frag(frag, bads1, bads2):
+    """
+    Removes bad rows and columns from a sub-matrix stored as an array
+
+    :returns: bin1, bin2 and number of interactions as three arrays
+    """
+    keep = np.ones(len(frag), dtype=bool)
+    if bads1:
+        keep &= ~np.isin(frag[:, 0], np.fromiter(bads1, dtype=np.int64))
+    if bads2:
+        keep &= ~np.isin(frag[:, 1], np.fromiter(bads2, dtype=np.int64))
+    frag = frag[keep]
+    return frag[:, 0], frag[:, 1], frag[:, 2]
+
+
 def get_matrix(inbam, resolution, biases=None,
                filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
                region1=None, start1=None, end1=None,
                region2=None, start2=None, end2=None, dico=None, clean=False,
                return_headers=False, tmpdir='.', normalization='raw', ncpus=8,
-               nchunks=100, verbose=False, max_size=None, chr_order=None):
+               nchunks=100, verbose=False, max_size=None, chr_order=None,
+               binary=False):
     """
     Get matrix from a BAM file containing interacting reads. The matrix
     will be extracted from the genomic BAM, the genomic coordinates of this
@@ -788,6 +1148,8 @@ def get_matrix(inbam, resolution, biases=None,
     :param 100 nchunks: maximum number of chunks into which to cut the BAM
     :param None max_size: maximum size of matrix to read
     :param None chr_order: chromosome order
+    :param False binary: store intermediate sub-matrices as binary NumPy
+       arrays instead of text files (faster and smaller on disk)
 
     :returns: dictionary with keys being tuples of the indexes of interacting
        bins: dico[(bin1, bin2)] = interactions
@@ -801,7 +1163,7 @@ def get_matrix(inbam, resolution, biases=None,
         region1=region1, start1=start1, end1=end1,
         region2=region2, start2=start2, end2=end2,
         tmpdir=tmpdir, nchunks=nchunks, verbose=verbose,
-        max_size=max_size, chr_order=chr_order)
+        max_size=max_size, chr_order=chr_order, binary=binary)
 
     if region1:
         regions = [region1]
@@ -842,17 +1204,30 @@ def get_matrix(inbam, resolution, biases=None,
                                    'here') % normalization)
 
     return_something = False
-    if dico is None:
+    if dico is None and binary and normalization in ('raw', 'norm'):
+        return_something = True
+        dico = {}
+        if normalization == 'norm':
+            bias1 = _bias_array(bias1, bin_coords[1] - start_bin1)
+            bias2 = _bias_array(bias2, bin_coords[3] - start_bin2)
+        for _, _, frag in _iter_matrix_arrays(chunks, tmpdir, rand_hash,
+                                              clean=clean, verbose=verbose):
+            i, j, v = _filter_frag(frag, bads1, bads2)
+            if normalization == 'norm':
+                v = v / bias1[i] / bias2[j]
+            dico.update(zip(zip(i.tolist(), j.tolist()), v.tolist()))
+    elif dico is None:
         return_something = True
         dico = dict(((i, j), transform_value(c, i, j, v))
                     for c, i, j, v in _iter_matrix_frags(
-                        chunks, tmpdir, rand_hash, clean=clean, verbose=verbose)
+                        chunks, tmpdir, rand_hash, clean=clean,
+                        verbose=verbose, binary=binary)
                     if i not in bads1 and j not in bads2)
         # pull all sub-matrices and write full matrix
     else: # dico probably an HiC data object
         for _, i, j, v in _iter_matrix_frags(
                 chunks, tmpdir, rand_hash,
-                clean=clean, verbose=verbose):
+                clean=clean, verbose=verbose, binary=binary):
             if i not in bads1 and j not in bads2:
                 dico[i, j] = v
 
@@ -867,6 +1242,95 @@ def get_matrix(inbam, resolution, biases=None,
         return dico
 
 
+def get_sparse_matrix(inbam, resolution,
+                      filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
+                      region1=None, start1=None, end1=None,
+                      region2=None, start2=None, end2=None, clean=True,
+                      tmpdir='.', ncpus=8, nchunks=100, verbose=False,
+                      max_size=None, chr_order=None):
+    """
+    Get raw matrix from a BAM file containing interacting reads, as three
+    arrays (coordinate format of sparse matrices). Regions are defined as in
+    :func:`get_matrix`. Sub-matrices are read as binary arrays, without
+    passing through any Python dictionary.
+
+    :param inbam: path to BAM file (generated byt TADbit)
+    :param resolution: resolution at which we want to write the matrix
+    :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
+       set of valid pair of reads.
+    :param True clean: remove temporary files
+    :param '.' tmpdir: where to write temporary files
+    :param 8 ncpus: number of cpus to use to read the BAM file
+    :param 100 nchunks: maximum number of chunks into which to cut the BAM
+
+    :returns: arrays of rows, columns and interactions (int32), and the bin
+       coordinates of the matrix (start_bin1, end_bin1, start_bin2, end_bin2)
+    """
+    if not isinstance(filter_exclude, int):
+        filter_exclude = filters_to_bin(filter_exclude)
+
+    _, rand_hash, bin_coords, chunks = read_bam(
+        inbam, filter_exclude, resolution, ncpus=ncpus,
+        region1=region1, start1=start1, end1=end1,
+        region2=region2, start2=start2, end2=end2,
+        tmpdir=tmpdir, nchunks=nchunks, verbose=verbose,
+        max_size=max_size, chr_order=chr_order, binary=True)
+
+    frags = [np.array(frag[:, :3]) for _, _, frag in _iter_matrix_arrays(
+        chunks, tmpdir, rand_hash, clean=clean, verbose=verbose)]
+    frags = np.concatenate(frags) if frags else np.empty((0, 3), dtype=np.int32)
+
+    if clean:
+        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
+    return frags[:, 0], frags[:, 1], frags[:, 2], bin_coords
+
+
+def get_sparse_matrices(inbam, resolutions,
+                        filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
+                        region1=None, region2=None, clean=True, tmpdir='.',
+                        ncpus=8, nchunks=100, verbose=False, chr_order=None):
+    """
+    Get raw matrices at several resolutions from a BAM file containing
+    interacting reads, reading it only once (see :func:`read_bam_multires`).
+    Matrices are returned as in :func:`get_sparse_matrix`.
+
+    :param inbam: path to BAM file (generated byt TADbit)
+    :param resolutions: list of resolutions, all multiples of the finest one
+    :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
+       set of valid pair of reads.
+    :param None region1: chromosome name of the rows of the matrices (all
+       the genome by default)
+    :param None region2: chromosome name of the columns of the matrices
+    :param True clean: remove temporary files
+    :param '.' tmpdir: where to write temporary files
+    :param 8 ncpus: number of cpus to use to read the BAM file
+    :param 100 nchunks: maximum number of chunks into which to cut the BAM
+
+    :returns: a dictionary with, for each resolution, arrays of rows, columns
+       and interactions (int32), the bin coordinates of the matrix
+       (start_bin1, end_bin1, start_bin2, end_bin2), and the sum of
+       interactions per row
+    """
+    if not isinstance(filter_exclude, int):
+        filter_exclude = filters_to_bin(filter_exclude)
+
+    reads, marginals = read_bam_multires(
+        inbam, filter_exclude, resolutions, ncpus=ncpus, region1=region1,
+        region2=region2, nchunks=nchunks, tmpdir=tmpdir, verbose=verbose,
+        chr_order=chr_order)
+
+    matrices = OrderedDict()
+    for reso, (_, rand_hash, bin_coords, chunks) in reads.items():
+        frags = [np.array(frag[:, :3]) for _, _, frag in _iter_matrix_arrays(
+            chunks, tmpdir, rand_hash, clean=clean, verbose=verbose)]
+        frags = np.concatenate(frags) if frags else np.empty((0, 3), dtype=np.int32)
+        if clean:
+            os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
+        matrices[reso] = (frags[:, 0], frags[:, 1], frags[:, 2], bin_coords,
+                          marginals[reso])
+    return matrices
+
+
 def _generate_name(regions, starts, ends, resolution, chr_order=None):
     """
     Generate file name for write_matrix and get_matrix functions
@@ -892,7 +1356,7 @@ def write_matrix(inbam, resolution, biases, outdir,
                  region2=None, start2=None, end2=None, extra='',
                  half_matrix=True, nchunks=100, tmpdir='.', append_to_tar=None,
                  ncpus=8, cooler=False, cooler_name=None, row_names=False,
-                 chr_order=None, verbose=True):
+                 chr_order=None, verbose=True, binary=False, reads=None):
     """
     Writes matrix file from a BAM file containing interacting reads. The matrix
     will be extracted from the genomic BAM, the genomic coordinates of this
@@ -934,6 +1398,12 @@ def write_matrix(inbam, resolution, biases, outdir,
        WARNING: results in two extra columns
     :param None chr_order: chromosome order
     :param 100 nchunks: maximum number of chunks into which to cut the BAM
+    :param False binary: store intermediate sub-matrices as binary NumPy
+       arrays instead of text files (faster and smaller on disk)
+    :param None reads: sub-matrices already counted at this resolution, as
+       returned by :func:`read_bam_multires` (the BAM is then not read).
+       Regions and half_matrix should be the same as the ones used to count
+       them
 
     :returns: path to output files
     """
@@ -952,12 +1422,17 @@ def write_matrix(inbam, resolution, biases, outdir,
     if not isinstance(filter_exclude, int):
         filter_exclude = filters_to_bin(filter_exclude)
 
-    regions, rand_hash, bin_coords, chunks = read_bam(
-        inbam, filter_exclude, resolution, ncpus=ncpus,
-        region1=region1, start1=start1, end1=end1,
-        region2=region2, start2=start2, end2=end2,
-        tmpdir=tmpdir, nchunks=nchunks, chr_order=chr_order,
-        verbose=verbose, half=half_matrix)
+    if reads:
+        # read_bam_multires writes binary sub-matrices
+        regions, rand_hash, bin_coords, chunks = reads
+        binary = True
+    else:
+        regions, rand_hash, bin_coords, chunks = read_bam(
+            inbam, filter_exclude, resolution, ncpus=ncpus,
+            region1=region1, start1=start1, end1=end1,
+            region2=region2, start2=start2, end2=end2,
+            tmpdir=tmpdir, nchunks=nchunks, chr_order=chr_order,
+            verbose=verbose, half=half_matrix, binary=binary)
 
     if region1:
         regions = [region1]
@@ -1191,13 +1666,21 @@ def write_matrix(inbam, resolution, biases, outdir,
     if cooler:
         for ichunk, c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
                                                      verbose=verbose, clean=clean,
-                                                     include_chunk_count=True):
+                                                     include_chunk_count=True,
+                                                     binary=binary):
             if j not in bads1 and k not in bads2:
                 out_raw.write_iter(ichunk, j, k, v)
         out_raw.close()
+    elif binary and normalizations == ('raw', ) and not row_names:
+        # whole sub-matrices are written at once (same format as write_raw)
+        for _, _, frag in _iter_matrix_arrays(chunks, tmpdir, rand_hash,
+                                              verbose=verbose, clean=clean):
+            np.savetxt(out_raw, np.column_stack(_filter_frag(frag, bads1, bads2)),
+                       fmt='%d\t%d\t\t%d')
     else:
         for c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
-                                             verbose=verbose, clean=clean):
+                                             verbose=verbose, clean=clean,
+                                             binary=binary):
             if j not in bads1 and k not in bads2:
                 write(c, j, k, v)
 
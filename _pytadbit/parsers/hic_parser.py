@@ -21,8 +21,13 @@ from pysam                           import AlignmentFile
 
 import numpy as np
 from pytadbit.parsers.gzopen         import gzopen
+from pytadbit.parsers.pairs_parser   import is_pairs, iter_pairs
+from pytadbit.parsers.pairs_parser   import read_pairs_header
+from pytadbit.utils.file_handling    import magic_open
 from pytadbit                        import HiC_data
-from pytadbit.parsers.hic_bam_parser import get_matrix
+from pytadbit.hic_data               import SparseHiC_data
+from pytadbit.parsers.hic_bam_parser import get_matrix, get_sparse_matrix
+from pytadbit.parsers.hic_bam_parser import get_sparse_matrices
 try:
     from pytadbit.parsers.cooler_parser import parse_cooler, is_cooler
 except ImportError:
@@ -506,27 +511,47 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
         return matrices
 
 
-def load_hic_data_from_reads(fnam, resolution, **kwargs):
+def load_hic_data_from_reads(fnam, resolution, region=None, start=None,
+                             end=None, **kwargs):
     """
-    :param fnam: tsv file with reads1 and reads2
+    :param fnam: tsv file with reads1 and reads2 (can be a compressed file of
+       pairs)
     :param resolution: the resolution of the experiment (size of a bin in
        bases)
     :param genome_seq: a dictionary containing the genomic sequence by
        chromosome
     :param False get_sections: for very very high resolution, when the column
        index does not fit in memory
+    :param None region: only load the interactions within this chromosome
+       (requires a compressed and indexed file of pairs, see
+       :func:`pytadbit.parsers.pairs_parser.iter_pairs`). The matrix
+       returned corresponds to this chromosome.
+    :param None start: with region, only load interactions between reads
+       starting after this position
+    :param None end: with region, only load interactions between reads
+       starting before this position
     """
     sections = []
     genome_seq = OrderedDict()
-    fhandler = open(fnam)
-    line = next(fhandler)
     size = 0
+    if region:
+        if not is_pairs(fnam):
+            raise Exception('ERROR: index not found, loading a region requires'
+                            ' a compressed and indexed file of pairs')
+        genome_seq[region] = (read_pairs_header(fnam)[region] //
+                              resolution + 1)
+        size = genome_seq[region]
+        fhandler = iter_pairs(fnam, region, start, end, region2=region,
+                              start2=start, end2=end)
+    else:
+        fhandler = magic_open(fnam)
+    line = next(fhandler, '')
     while line.startswith('#'):
         if line.startswith('# CRM '):
             crm, clen = line[6:].split()
             genome_seq[crm] = int(clen) // resolution + 1
             size += genome_seq[crm]
-        line = next(fhandler)
+        line = next(fhandler, '')
     if kwargs.get('get_sections', True):
         for crm in genome_seq:
             len_crm = genome_seq[crm]
@@ -534,7 +559,7 @@ def load_hic_data_from_reads(fnam, resolution, **kwargs):
     dict_sec = dict([(j, i) for i, j in enumerate(sections)])
     imx = HiC_data((), size, genome_seq, dict_sec, resolution=resolution)
     try:
-        while True:
+        while line:  # empty if no pair in region
             _, cr1, ps1, _, _, _, _, cr2, ps2, _ = line.split('\t', 9)
             try:
                 ps1 = dict_sec[(cr1, int(ps1) // resolution)]
@@ -554,7 +579,8 @@ def load_hic_data_from_reads(fnam, resolution, **kwargs):
 
 def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
                            filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
-                           region=None, nchunks=100, verbose=True, clean=True):
+                           region=None, nchunks=100, verbose=True, clean=True,
+                           binary=False, sparse=False):
     """
     :param fnam: TADbit-generated BAM file with read-ends1 and read-ends2
     :param resolution: the resolution of the experiment (size of a bin in
@@ -569,9 +595,95 @@ def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
     :param 100 nchunks: maximum number of chunks into which to cut the BAM
     :param True verbose: speak
     :param True clean: remove temps
+    :param False binary: store intermediate sub-matrices as binary NumPy
+       arrays instead of text files
+    :param False sparse: store the interactions in a sparse matrix
+       (SparseHiC_data object), ~10 times less memory than the default
+       dictionary (intermediate sub-matrices are always binary in this case)
 
     :returns: HiC_data object
     """
+    genome_seq, chromosomes, dict_sec, size = _bam_sections(fnam, resolution,
+                                                            region)
+    if sparse:
+        rows, cols, data, _ = get_sparse_matrix(
+            fnam, resolution, filter_exclude=filter_exclude, tmpdir=tmpdir,
+            clean=clean, ncpus=ncpus, nchunks=nchunks, region1=region,
+            verbose=verbose)
+        imx = SparseHiC_data.from_coo(rows, cols, data, size,
+                                      chromosomes=chromosomes,
+                                      dict_sec=dict_sec, resolution=resolution)
+    else:
+        imx = HiC_data((), size, chromosomes=chromosomes, dict_sec=dict_sec,
+                       resolution=resolution)
+
+    if biases:
+        _add_biases(imx, biases, resolution, genome_seq, region)
+
+    if not sparse:
+        get_matrix(fnam, resolution, biases=None, filter_exclude=filter_exclude,
+                   normalization='raw', tmpdir=tmpdir, clean=clean,
+                   ncpus=ncpus, nchunks=nchunks, dico=imx, region1=region,
+                   verbose=verbose, binary=binary)
+    imx._symmetricize()
+    imx.symmetricized = True
+
+    return imx
+
+
+def load_hic_data_from_bam_multires(fnam, resolutions, biases=None,
+                                    tmpdir='.', ncpus=8,
+                                    filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
+                                    region=None, nchunks=100, verbose=True,
+                                    clean=True):
+    """
+    Loads Hi-C data at several resolutions reading the BAM file only once
+    (see :func:`pytadbit.parsers.hic_bam_parser.read_bam_multires`).
+
+    :param fnam: TADbit-generated BAM file with read-ends1 and read-ends2
+    :param resolutions: list of resolutions, all multiples of the finest one
+    :param None biases: dictionary with resolutions as keys, and paths to
+       pickle files with biases (or the loaded biases) as values (see
+       :func:`load_hic_data_from_bam`)
+    :param '.' tmpdir: path to folder where to create temporary files
+    :param 8 ncpus:
+    :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
+       set of valid pair of reads.
+    :param None region: chromosome name, if None, all genome will be loaded
+    :param 100 nchunks: maximum number of chunks into which to cut the BAM
+    :param True verbose: speak
+    :param True clean: remove temps
+
+    :returns: a dictionary with resolutions as keys, and SparseHiC_data
+       objects as values
+    """
+    biases = biases or {}
+    matrices = get_sparse_matrices(
+        fnam, resolutions, filter_exclude=filter_exclude, region1=region,
+        clean=clean, tmpdir=tmpdir, ncpus=ncpus, nchunks=nchunks,
+        verbose=verbose)
+    hic_datas = OrderedDict()
+    for resolution, (rows, cols, data, _, _) in matrices.items():
+        genome_seq, chromosomes, dict_sec, size = _bam_sections(
+            fnam, resolution, region)
+        imx = SparseHiC_data.from_coo(rows, cols, data, size,
+                                      chromosomes=chromosomes,
+                                      dict_sec=dict_sec, resolution=resolution)
+        if biases.get(resolution):
+            _add_biases(imx, biases[resolution], resolution, genome_seq,
+                        region)
+        imx._symmetricize()
+        imx.symmetricized = True
+        hic_datas[resolution] = imx
+    return hic_datas
+
+
+def _bam_sections(fnam, resolution, region=None):
+    """
+    :returns: the number of bins per chromosome in the BAM file, the
+       chromosomes of the matrix, the dictionary of sections and the size of
+       the matrix
+    """
     bam = AlignmentFile(fnam)
     genome_seq = OrderedDict((c, l) for c, l in
                              zip(bam.references,
@@ -591,41 +703,35 @@ def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
 
     chromosomes = {region: genome_seq[region]} if region else genome_seq
     dict_sec = dict([(j, i) for i, j in enumerate(sections)])
-    imx = HiC_data((), size, chromosomes=chromosomes, dict_sec=dict_sec,
-                   resolution=resolution)
+    return genome_seq, chromosomes, dict_sec, size
 
-    if biases:
-        if isinstance(biases, basestring):
-            biases = load(open(biases,'rb'))
-        if biases['resolution'] != resolution:
-            raise Exception('ERROR: resolution of biases do not match to the '
-                            'one wanted (%d vs %d)' % (
-                                biases['resolution'], resolution))
-        if region:
-            chrom_start = 0
-            chrom_end = 0
-            for crm in genome_seq:
-                if crm == region:
-                    chrom_end = chrom_start + genome_seq[crm]
-                    break
-                len_crm = genome_seq[crm]
-                chrom_start += len_crm
-            imx.bias  = dict((k - chrom_start, v)
-                          for k, v in biases.get('biases', {}).items()
-                          if chrom_start <= k < chrom_end)
-            imx.bads  = dict((k - chrom_start, v)
-                          for k, v in biases.get('badcol', {}).items()
-                          if chrom_start <= k < chrom_end)
-        else:
-            imx.bads     = biases['badcol']
-            imx.bias     = biases['biases']
-        imx.expected = biases['decay']
-
-    get_matrix(fnam, resolution, biases=None, filter_exclude=filter_exclude,
-               normalization='raw', tmpdir=tmpdir, clean=clean,
-               ncpus=ncpus, nchunks=nchunks, dico=imx, region1=region,
-               verbose=verbose)
-    imx._symmetricize()
-    imx.symmetricized = True
 
-    return imx
+def _add_biases(imx, biases, resolution, genome_seq, region=None):
+    """
+    Loads biases, bad columns and expected decay into a HiC_data object
+    """
+    if isinstance(biases, basestring):
+        biases = load(open(biases,'rb'))
+    if biases['resolution'] != resolution:
+        raise Exception('ERROR: resolution of biases do not match to the '
+                        'one wanted (%d vs %d)' % (
+                            biases['resolution'], resolution))
+    if region:
+        chrom_start = 0
+        chrom_end = 0
+        for crm in genome_seq:
+            if crm == region:
+                chrom_end = chrom_start + genome_seq[crm]
+                break
+            len_crm = genome_seq[crm]
+            chrom_start += len_crm
+        imx.bias  = dict((k - chrom_start, v)
+                      for k, v in biases.get('biases', {}).items()
+                      if chrom_start <= k < chrom_end)
+        imx.bads  = dict((k - chrom_start, v)
+                      for k, v in biases.get('badcol', {}).items()
+                      if chrom_start <= k < chrom_end)
+    else:
+        imx.bads     = biases['badcol']
+        imx.bias     = biases['biases']
+    imx.expected = biases['decay']
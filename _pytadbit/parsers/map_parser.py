@@ -3,14 +3,17 @@
 """
 from __future__ import print_function
 
-from bisect                               import bisect_right as bisect
 from warnings                             import warn
+from heapq                                import merge
 from sys                                  import stdout
 from subprocess                           import Popen
 import os
 
+import numpy as np
+
 from pytadbit.utils.file_handling         import magic_open
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import map_re_sites_array
+from pytadbit.mapping.restriction_enzymes import find_re_sites
 
 try:
     basestring
@@ -19,7 +22,7 @@ except NameError:
 
 def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, clean=True,
-              **kwargs):
+              re_cache=None, **kwargs):
     """
     Parse map files
 
@@ -46,6 +49,9 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
        multiple-contacts
     :param False compress: compress (gzip) input map files. This is done in the
        background while next MAP files are parsed, or while files are sorted.
+    :param None re_cache: path to a file where to store (or from where to
+       load) the positions of RE sites in the genome (see
+       :func:`pytadbit.mapping.restriction_enzymes.map_re_sites_array`)
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -58,16 +64,13 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print('Searching and mapping RE sites to the reference genome')
     if len(re_name) == 1 and re_name[0] in (None, 'None'):
         frags = {}
-        read_read = read_read_nofrags
     else:
-        frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                             verbose=verbose)
-        read_read = read_read_frags
+        frags = map_re_sites_array(re_name, genome_seq, cache=re_cache,
+                                   verbose=verbose)
 
     if isinstance(f_names1, basestring):
         f_names1 = [f_names1]
@@ -115,18 +118,21 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
                 while not False:
                     for _ in range(max_size):
                         try:
-                            reads.append(read_read(next(fhandler), frags,
-                                                   frag_chunk))
+                            reads.append(read_read(next(fhandler), frags))
                         except KeyError:
                             # Chromosome not in hash
                             continue
                         read_count += 1
                     nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+                    write_reads_to_file(format_reads(reads, frags),
+                                        outfiles[read], tmp_files, nfile)
+                    del reads[:]
             except StopIteration:
                 fhandler.close()
                 nfile += 1
-                write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+                write_reads_to_file(format_reads(reads, frags),
+                                    outfiles[read], tmp_files, nfile)
+                del reads[:]
             windows[read][num] = read_count
             if kwargs.get('compress', False) and fnam.endswith('.map'):
                 print('compressing input MAP file')
@@ -134,26 +140,6 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
         nfile += 1
         write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
 
-        # we have now sorted temporary files
-        # we do merge sort for eah pair
-        if verbose:
-            stdout.write('Merge sort')
-            stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
-            if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
-        if verbose:
-            stdout.write('\n')
-        tmp_name = tmp_files[0]
-
         if verbose:
             print('Getting Multiple contacts')
         reads_fh = open(outfiles[read], 'w')
@@ -167,38 +153,10 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
             reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
 
         ## Multicontacts
-        tmp_reads_fh = open(tmp_name)
-        try:
-            read_line = next(tmp_reads_fh)
-        except StopIteration:
-            raise StopIteration('ERROR!\n Nothing parsed, check input files and'
-                                ' chromosome names (in genome.fasta and SAM/MAP'
-                                ' files).')
-        prev_head = read_line.split('\t', 1)[0]
-        prev_head = prev_head.split('~' , 1)[0]
-        prev_read = read_line
-        multis[read] = {}
-        multi = 0
-        for read_line in tmp_reads_fh:
-            head = read_line.split('\t', 1)[0]
-            head = head.split('~' , 1)[0]
-            if head == prev_head:
-                prev_read =  prev_read.strip() + '|||' + read_line
-                multi += 1
-            else:
-                reads_fh.write(prev_read)
-                prev_read = read_line
-                try:
-                    multis[read][multi] += 1
-                except KeyError:
-                    multis[read][multi] = 1
-                multi = 0
-            prev_head = head
-        reads_fh.write(prev_read)
+        # sorted temporary files are merged while multiple contacts are joined
+        multis[read] = merge_reads(tmp_files, reads_fh, outfiles[read], nfile,
+                                   clean=clean, verbose=verbose)
         reads_fh.close()
-        tmp_reads_fh.close()
-        if clean:
-            os.system('rm -rf ' + tmp_name)
     # wait for compression to finish
     for p in procs:
         p.communicate()
@@ -218,89 +176,148 @@ def write_reads_to_file(reads, outfiles, tmp_files, nfile):
     del(reads[:])  # empty list
 
 
-def merge_sort(file1, file2, outfiles, nfile):
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_file = open(tmp_name, 'w')
-    fh1 = open(file1)
-    fh2 = open(file2)
-    greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
-    read1 = next(fh1)
-    read2 = next(fh2)
-    while True:
-        if greater(read2, read1):
-            tmp_file.write(read1)
-            try:
-                read1 = next(fh1)
-            except StopIteration:
-                tmp_file.write(read2)
-                break
+def merge_reads(tmp_files, out, outfile, nfile, clean=True, max_files=256,
+                verbose=False):
+    """
+    Merges temporary files of reads sorted by read ID, and writes them joining
+    in a single line (separated by '|||') the fragments of a same read
+    (multiple contacts).
+
+    :param tmp_files: list of paths to temporary files sorted by read ID
+    :param out: file handler where to write the merged reads
+    :param outfile: path to the final output file, used to name intermediate
+       files
+    :param nfile: number of the last temporary file created, used to name
+       intermediate files
+    :param True clean: remove temporary files once merged
+    :param 256 max_files: maximum number of files opened at once. If there are
+       more temporary files, they are first merged by groups.
+
+    :returns: a dictionary with the number of reads by number of extra
+       fragments
+    """
+    if verbose:
+        stdout.write('Merge sort')
+        stdout.flush()
+    while len(tmp_files) > max_files:
+        merged = []
+        for beg in range(0, len(tmp_files), max_files):
+            if verbose:
+                stdout.write('.')
+                stdout.flush()
+            nfile += 1
+            tmp_name = os.path.join(*outfile.split('/')[:-1] +
+                                    [('tmp_merged_%03d_' % nfile) +
+                                     outfile.split('/')[-1]])
+            tmp_name = ('/' * outfile.startswith('/')) + tmp_name
+            with open(tmp_name, 'w') as tmp_file:
+                tmp_file.writelines(_merge_files(tmp_files[beg:beg + max_files]))
+            for fname in tmp_files[beg:beg + max_files]:
+                os.remove(fname)
+            merged.append(tmp_name)
+        tmp_files = merged
+    if verbose:
+        stdout.write('\n')
+
+    reads = _merge_files(tmp_files)
+    try:
+        read_line = next(reads)
+    except StopIteration:
+        raise StopIteration('ERROR!\n Nothing parsed, check input files and'
+                            ' chromosome names (in genome.fasta and SAM/MAP'
+                            ' files).')
+    prev_head = _read_id(read_line)
+    prev_read = read_line
+    multis = {}
+    multi = 0
+    for read_line in reads:
+        head = _read_id(read_line)
+        if head == prev_head:
+            prev_read =  prev_read.strip() + '|||' + read_line
+            multi += 1
         else:
-            tmp_file.write(read2)
+            out.write(prev_read)
+            prev_read = read_line
             try:
-                read2 = next(fh2)
-            except StopIteration:
-                tmp_file.write(read1)
-                break
-    for read in fh1:
-        tmp_file.write(read)
-    for read in fh2:
-        tmp_file.write(read)
-    fh1.close()
-    fh2.close()
-    tmp_file.close()
-    os.system('rm -f ' + file1)
-    os.system('rm -f ' + file2)
-    return tmp_name
-
-
-def read_read_nofrags(r, _, __):
-    name, seq, _, _, ali = r.split('\t')[:5]
-    try:
-        crm, strand, pos = ali.split(':')[:3]
-    except ValueError:
-        raise KeyError()
-    positive = strand == '+'
-    crm = crm.split()[0]
-    len_seq  = len(seq)
-    if positive:
-        pos = int(pos)
-    else:
-        pos = int(pos) + len_seq - 1 # remove 1 because all inclusive
-    return ('%s\t%s\t%d\t%d\t%d\t0\t0\n' % (
-        name, crm, pos, positive, len_seq))
+                multis[multi] += 1
+            except KeyError:
+                multis[multi] = 1
+            multi = 0
+        prev_head = head
+    out.write(prev_read)
+    if clean:
+        for fname in tmp_files:
+            os.remove(fname)
+    return multis
+
+
+def _read_id(line):
+    return line.split('\t', 1)[0].split('~', 1)[0]
 
 
-def read_read_frags(r, frags, frag_chunk):
+def _sorted_reads(fname, num):
+    # file number keeps the merge stable
+    with open(fname) as fhandler:
+        for line in fhandler:
+            yield _read_id(line), num, line
+
+
+def _merge_files(fnames):
+    """
+    :returns: an iterator over the lines of files sorted by read ID, merged
+    """
+    return (line for _, _, line in merge(*[_sorted_reads(fname, num)
+                                           for num, fname in enumerate(fnames)]))
+
+
+def read_read(r, frags):
+    """
+    :returns: read ID, chromosome, position, strand and mapped length of a line
+       of a map file
+    """
     name, seq, _, _, ali = r.split('\t')[:5]
     try:
         crm, strand, pos = ali.split(':')[:3]
     except ValueError:
         raise KeyError()
     crm = crm.split()[0]
+    if frags and crm not in frags:
+        raise KeyError()
     positive = strand == '+'
     len_seq  = len(seq)
     if positive:
         pos = int(pos)
     else:
         pos = int(pos) + len_seq - 1 # remove 1 because all inclusive
-    frag_piece = frags[crm][pos // frag_chunk]
-    idx = bisect(frag_piece, pos)
-    try:
-        next_re = frag_piece[idx]
-    except IndexError:
-        # case where part of the read is mapped outside chromosome
-        count = 0
-        while idx >= len(frag_piece) and count < len_seq:
-            pos -= 1
-            count += 1
-            frag_piece = frags[crm][pos // frag_chunk]
-            idx = bisect(frag_piece, pos)
-        if count >= len_seq:
-            raise Exception('Read mapped mostly outside ' +
-                            'chromosome\n(also reference genome can be truncated)')
-        next_re = frag_piece[idx]
-    prev_re = frag_piece[idx - 1 if idx else 0]
-    return ('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-        name, crm, pos, positive, len_seq, prev_re, next_re))
+    return name, crm, pos, positive, len_seq
+
+
+def format_reads(reads, frags):
+    """
+    Search the RE sites surrounding a list of reads, and format them as lines
+    of the parsed map files.
+
+    :param reads: list of reads (read ID, chromosome, position, strand and
+       mapped length)
+    :param frags: dictionary of RE sites by chromosome as returned by
+       :func:`pytadbit.mapping.restriction_enzymes.map_re_sites_array`. If
+       empty RE sites are set to 0
+
+    :returns: a list of lines
+    """
+    if not frags:
+        return ['%s\t%s\t%d\t%d\t%d\t0\t0\n' % r for r in reads]
+    by_crm = {}
+    for i, r in enumerate(reads):
+        by_crm.setdefault(r[1], []).append(i)
+    lines = [None] * len(reads)
+    for crm, idxs in by_crm.items():
+        pos, prev_re, next_re = find_re_sites(
+            frags[crm], np.array([reads[i][2] for i in idxs]),
+            np.array([reads[i][4] for i in idxs]))
+        for i, ps, beg, end in zip(idxs, pos.tolist(), prev_re.tolist(),
+                                   next_re.tolist()):
+            name, _, _, positive, len_seq = reads[i]
+            lines[i] = '%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
+                name, crm, ps, positive, len_seq, beg, end)
+    return lines
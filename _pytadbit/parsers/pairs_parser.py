@@ -0,0 +1,101 @@
+"""
+Pairs of reads (output of get_intersection) stored in a block-compressed
+(BGZF) file, indexed by the chromosome and the position of the first read-end,
+in order to be read by region.
+
+The content is the same as in the tab separated files (header with chromosome
+sizes, and one line per pair of reads with 13 columns), the file can thus also
+be read as a normal gzip file.
+"""
+from __future__ import print_function
+
+from collections import OrderedDict
+from os          import path
+
+from pysam       import BGZFile, TabixFile, tabix_index
+
+
+def is_pairs(fnam):
+    """
+    :returns: True if the file is a compressed and indexed file of pairs
+    """
+    return path.exists(fnam + '.tbi')
+
+
+class PairsWriter(object):
+    """
+    Writes a compressed file of pairs of reads, and indexes it when closed.
+    Lines must be written sorted by chromosome (in the order of the header) and
+    position of the first read-end, as produced by get_intersection.
+
+    :param fnam: path to the output file
+    """
+    def __init__(self, fnam):
+        self.fnam = fnam
+        self._fh  = BGZFile(fnam, 'wb')
+
+    def write(self, text):
+        self._fh.write(text.encode())
+
+    def close(self):
+        self._fh.close()
+        tabix_index(self.fnam, seq_col=1, start_col=2, end_col=2,
+                    meta_char='#', force=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_pairs_header(fnam):
+    """
+    :returns: an ordered dictionary with chromosome names and lengths
+    """
+    tbx = TabixFile(fnam)
+    chromosomes = OrderedDict()
+    for line in tbx.header:
+        if line.startswith('# CRM '):
+            crm, clen = line[6:].split()
+            chromosomes[crm] = int(clen)
+    tbx.close()
+    return chromosomes
+
+
+def iter_pairs(fnam, region=None, start=None, end=None, region2=None,
+               start2=None, end2=None):
+    """
+    Iterates over the lines of a compressed file of pairs of reads. Each pair
+    is stored only once, the upstream read-end first.
+
+    :param fnam: path to the compressed and indexed file of pairs
+    :param None region: chromosome of the first read-end (all the file if None)
+    :param None start: first position (1-based, included) of the first
+       read-end
+    :param None end: last position (included) of the first read-end
+    :param None region2: chromosome of the second read-end
+    :param None start2: first position (1-based, included) of the second
+       read-end
+    :param None end2: last position (included) of the second read-end
+
+    :yields: lines of the file (without header), as in the tab separated files
+    """
+    tbx = TabixFile(fnam)
+    try:
+        if region is None:
+            lines = tbx.fetch()
+        else:
+            lines = tbx.fetch(region, (start or 1) - 1, end)
+        if region2 is None:
+            for line in lines:
+                yield line + '\n'
+        else:
+            start2 = start2 or 1
+            end2 = end2 or float('inf')
+            for line in lines:
+                _, _, _, _, _, _, _, cr2, ps2, _ = line.split('\t', 9)
+                if cr2 == region2 and start2 <= int(ps2) <= end2:
+                    yield line + '\n'
+    finally:
+        tbx.close()
@@ -4,13 +4,16 @@
 from __future__ import print_function
 from builtins import next
 
-from itertools import combinations
-from bisect import bisect_right as bisect
+from itertools import combinations, islice
 from pysam import Samfile
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import map_re_sites_array
+from pytadbit.mapping.restriction_enzymes import find_re_sites
+from pytadbit.parsers.map_parser import format_reads, merge_reads
+from pytadbit.parsers.bam_core_parser import iter_record_offsets
 from shutil import copyfileobj
 from warnings import warn
 import os
+import multiprocessing as mu
 from sys import stdout
 
 try:
@@ -21,7 +24,7 @@ except NameError:
 
 def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, clean=True,
-              mapper=None, **kwargs):
+              mapper=None, re_cache=None, ncpus=1, **kwargs):
     """
     Parse sam/bam file using pysam tools.
 
@@ -43,6 +46,10 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param re_name: name of the restriction enzyme used
     :param None mapper: software used to map (supported are GEM and BOWTIE2).
        Guessed from file by default.
+    :param None re_cache: path to a file where to store (or from where to
+       load) the positions of RE sites in the genome (see
+       :func:`pytadbit.mapping.restriction_enzymes.map_re_sites_array`)
+    :param 1 ncpus: number of processes parsing blocks of reads in parallel
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -55,11 +62,10 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print('Searching and mapping RE sites to the reference genome')
-    frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                         verbose=verbose)
+    frags = map_re_sites_array(re_name, genome_seq, cache=re_cache,
+                               verbose=verbose)
 
     if isinstance(f_names1, basestring):
         f_names1 = [f_names1]
@@ -75,6 +81,16 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     # max number of reads per intermediate files for sorting
     max_size = 1000000
 
+    # blocks of reads are parsed in parallel
+    _init_parse_worker(frags)
+    if ncpus > 1:
+        pool = mu.Pool(ncpus, initializer=_init_parse_worker,
+                       initargs=(frags, ))
+        run = pool.apply_async
+    else:
+        pool = None
+        run = _ParsedBlock
+
     windows = {}
     multis  = {}
     procs   = []
@@ -86,7 +102,7 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
         # iteration over reads
         nfile = 0
         tmp_files = []
-        reads     = []
+        blocks    = []
         for fnam in fnames[read]:
             try:
                 fhandler = Samfile(fnam)
@@ -105,91 +121,31 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
             # guess mapper used
             if not mapper:
                 mapper = fhandler.header['PG'][0]['ID']
-            if mapper.lower()=='gem':
-                condition = lambda x: x[1][0][0] != 'N'
-            elif mapper.lower() in ['bowtie', 'bowtie2']:
-                condition = lambda x: 'XS' == x[0][0]
-            else:
+            if mapper.lower() not in ['gem', 'bowtie', 'bowtie2']:
                 warn('WARNING: unrecognized mapper used to generate file\n')
-                condition = lambda x: x[1][1] != 1
             if verbose:
                 print('loading SAM file from %s: %s' % (mapper, fnam))
-            # getrname chromosome names
-            i = 0
-            crm_dict = {}
-            while True:
-                try:
-                    crm_dict[i] = fhandler.getrname(i)
-                    i += 1
-                except ValueError:
-                    break
-            # iteration over reads
-            sub_count = 0  # to empty read buffer
-            for r in fhandler:
-                if r.is_unmapped:
-                    continue
-                if condition(r.tags):
-                    continue
-                positive = not r.is_reverse
-                crm      = crm_dict[r.tid]
-                len_seq  = len(r.seq)
-                if positive:
-                    pos = r.pos + 1
-                else:
-                    pos = r.pos + len_seq
-                try:
-                    frag_piece = frags[crm][pos // frag_chunk]
-                except KeyError:
-                    # Chromosome not in hash
-                    continue
-                idx = bisect(frag_piece, pos)
-                try:
-                    next_re = frag_piece[idx]
-                except IndexError:
-                    # case where part of the read is mapped outside chromosome
-                    count = 0
-                    while idx >= len(frag_piece) and count < len_seq:
-                        pos -= 1
-                        count += 1
-                        frag_piece = frags[crm][pos // frag_chunk]
-                        idx = bisect(frag_piece, pos)
-                    if count >= len_seq:
-                        raise Exception('Read mapped mostly outside ' +
-                                        'chromosome\n(also reference genome can be truncated)')
-                    next_re    = frag_piece[idx]
-                prev_re    = frag_piece[idx - 1 if idx else 0]
-                name       = r.qname
-                reads.append('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-                    name, crm, pos, positive, len_seq, prev_re, next_re))
-                windows[read][num] += 1
-                sub_count += 1
-                if sub_count >= max_size:
-                    sub_count = 0
-                    nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            nfile += 1
-            write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-
+            # split the file in blocks of reads, that are parsed while the
+            # rest of the file is scanned (records are only delimited, not
+            # decoded, in BAM and uncompressed SAM files)
+            if fhandler.is_bam:
+                offsets = iter_record_offsets(fnam, fhandler.tell(), max_size)
+            elif (getattr(fhandler, 'is_sam', False) and
+                  getattr(fhandler, 'compression', None) == 'NONE'):
+                offsets = _iter_line_offsets(fnam, fhandler.tell(), max_size)
+            else:
+                offsets = _iter_pysam_offsets(fhandler, max_size)
+            for offset in offsets:
+                nfile += 1
+                blocks.append((num, run(_parse_sam_block, (
+                    fnam, offset, max_size, mapper, outfiles[read], nfile))))
+            fhandler.close()
+        for num, block in blocks:
+            count, tmp_name = block.get()
+            windows[read][num] += count
+            if tmp_name:
+                tmp_files.append(tmp_name)
 
-        # we have now sorted temporary files
-        # we do merge sort for eah pair
-        if verbose:
-            stdout.write('Merge sort')
-            stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
-            if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
-        if verbose:
-            stdout.write('\n')
-        tmp_name = tmp_files[0]
 
         if verbose:
             print('Getting Multiple contacts')
@@ -204,43 +160,136 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
             reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
 
         ## Multicontacts
-        tmp_reads_fh = open(tmp_name)
-        try:
-            read_line = next(tmp_reads_fh)
-        except StopIteration:
-            raise StopIteration('ERROR!\n Nothing parsed, check input files and'
-                                ' chromosome names (in genome.fasta and SAM/MAP'
-                                ' files).')
-        prev_head = read_line.split('\t', 1)[0]
-        prev_head = prev_head.split('~' , 1)[0]
-        prev_read = read_line
-        multis[read] = {}
-        multi = 0
-        for read_line in tmp_reads_fh:
-            head = read_line.split('\t', 1)[0]
-            head = head.split('~' , 1)[0]
-            if head == prev_head:
-                prev_read =  prev_read.strip() + '|||' + read_line
-                multi += 1
-            else:
-                reads_fh.write(prev_read)
-                prev_read = read_line
-                try:
-                    multis[read][multi] += 1
-                except KeyError:
-                    multis[read][multi] = 1
-                multi = 0
-            prev_head = head
-        reads_fh.write(prev_read)
+        # sorted temporary files are merged while multiple contacts are joined
+        multis[read] = merge_reads(tmp_files, reads_fh, outfiles[read], nfile,
+                                   clean=clean, verbose=verbose)
         reads_fh.close()
-        tmp_reads_fh.close()
-        if clean:
-            os.system('rm -rf ' + tmp_name)
+    if pool:
+        pool.close()
+        pool.join()
     # wait for compression to finish
     for p in procs:
         p.communicate()
     return windows, multis
 
+
+# RE sites shared by the processes parsing blocks of reads
+_FRAGS = {}
+
+
+def _init_parse_worker(frags):
+    global _FRAGS
+    _FRAGS = frags
+
+
+class _ParsedBlock(object):
+    """
+    Parses a block of reads in the current process (same interface as the
+    results of multiprocessing apply_async)
+    """
+    def __init__(self, func, args):
+        self.result = func(*args)
+
+    def get(self):
+        return self.result
+
+
+def _iter_line_offsets(fnam, offset, step, buffer_size=1024 * 1024):
+    """
+    Splits an uncompressed SAM file in blocks of lines.
+
+    :param fnam: path to the SAM file
+    :param offset: position of the first line to consider (after the header)
+    :param step: number of lines in each block
+
+    :returns: positions in the file of the first line of each block
+    """
+    fhandler = open(fnam, 'rb')
+    fhandler.seek(offset)
+    remaining = 0  # lines to pass before the beginning of the next block
+    while True:
+        data = fhandler.read(buffer_size)
+        if not data:
+            break
+        pos = 0
+        while True:
+            if not remaining:
+                if pos == len(data):
+                    break
+                yield offset + pos
+                remaining = step
+            nlines = data.count(b'\n', pos)
+            if nlines < remaining:
+                remaining -= nlines
+                break
+            for _ in range(remaining):
+                pos = data.index(b'\n', pos) + 1
+            remaining = 0
+        offset += len(data)
+    fhandler.close()
+
+
+def _iter_pysam_offsets(fhandler, step):
+    """
+    Splits a SAM/BAM file in blocks of records, reading all of them (for
+    compressed SAM files).
+
+    :param fhandler: opened Samfile, positioned after the header
+    :param step: number of records in each block
+
+    :returns: virtual offsets of the first record of each block
+    """
+    offset = fhandler.tell()
+    nread = 0
+    for nread, _ in enumerate(fhandler, 1):
+        if not nread % step:
+            yield offset
+            offset = fhandler.tell()
+    if nread % step:
+        yield offset
+
+
+def _parse_sam_block(fnam, offset, max_size, mapper, outfile, nfile):
+    """
+    Parses a block of reads from a SAM/BAM file, starting at a given offset,
+    and writes them into a temporary file sorted by read ID
+
+    :returns: the number of reads parsed, and the name of the temporary file
+       (None if no read was parsed)
+    """
+    if mapper.lower()=='gem':
+        condition = lambda x: x[1][0][0] != 'N'
+    elif mapper.lower() in ['bowtie', 'bowtie2']:
+        condition = lambda x: 'XS' == x[0][0]
+    else:
+        condition = lambda x: x[1][1] != 1
+    fhandler = Samfile(fnam)
+    fhandler.seek(offset)
+    crm_dict = dict(enumerate(fhandler.references))
+    reads = []
+    for r in islice(fhandler, max_size):
+        if r.is_unmapped:
+            continue
+        if condition(r.tags):
+            continue
+        crm = crm_dict[r.tid]
+        if crm not in _FRAGS:
+            # Chromosome not in hash
+            continue
+        positive = not r.is_reverse
+        len_seq  = len(r.seq)
+        if positive:
+            pos = r.pos + 1
+        else:
+            pos = r.pos + len_seq
+        reads.append((r.qname, crm, pos, positive, len_seq))
+    fhandler.close()
+    tmp_files = []
+    count = len(reads)
+    write_reads_to_file(format_reads(reads, _FRAGS), outfile, tmp_files, nfile)
+    return count, tmp_files[0] if tmp_files else None
+
+
 def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
                  tmp_format=False, **kwargs):
     """
@@ -253,7 +302,6 @@ def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
     :param False tmp_format: If True leave the file prepared to be merged with other map files.
     """
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     try:
         fhandler = Samfile(f_name)
     except IOError:
@@ -338,27 +386,13 @@ def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
                 else:
                     pos = read.pos + len_seq
                 try:
-                    frag_piece = frags[crm][pos // frag_chunk]
+                    (pos, ), (prev_re, ), (next_re, ) = [
+                        v.tolist() for v in find_re_sites(frags[crm], [pos],
+                                                          [len_seq])]
                 except KeyError:
                     # Chromosome not in hash
                     read_multi = []
                     break
-                idx = bisect(frag_piece, pos)
-                try:
-                    next_re = frag_piece[idx]
-                except IndexError:
-                    # case where part of the read is mapped outside chromosome
-                    count = 0
-                    while idx >= len(frag_piece) and count < len_seq:
-                        pos -= 1
-                        count += 1
-                        frag_piece = frags[crm][pos // frag_chunk]
-                        idx = bisect(frag_piece, pos)
-                    if count >= len_seq:
-                        raise Exception('Read mapped mostly outside ' +
-                                        'chromosome\n')
-                    next_re    = frag_piece[idx]
-                prev_re    = frag_piece[idx - 1 if idx else 0]
                 reads_grp.append([read.tid, crm, pos, positive,
                                   len_seq, prev_re, next_re])
             if len(reads_grp) > 2:
@@ -35,6 +35,7 @@ from pytadbit.utils.file_handling    import mkdir
 from pytadbit.utils                  import printime
 from pytadbit.parsers.hic_bam_parser import filters_to_bin
 from pytadbit.parsers.hic_bam_parser import write_matrix, get_matrix
+from pytadbit.parsers.hic_bam_parser import read_bam_multires, check_resolutions
 from pytadbit.parsers.tad_parser     import parse_tads
 from pytadbit.utils.sqlite_utils     import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils     import add_path, get_jobid, print_db, retry
@@ -71,6 +72,9 @@ def get_sections(mreads, chr_name):
 def run(opts):
     check_options(opts)
     launch_time = time.localtime()
+    if isinstance(opts.reso, list):
+        bin_resolutions(opts, launch_time)
+        return
     param_hash = digest_parameters(opts, extra=['quiet'])
     biases = None
 
@@ -198,7 +202,7 @@ def run(opts):
                     return_headers=True,
                     nchunks=opts.nchunks, verbose=not opts.quiet,
                     clean=clean, max_size=max_size,
-                    chr_order=opts.chr_name)
+                    chr_order=opts.chr_name, binary=opts.binary_tmp)
             except NotImplementedError:
                 if norm == "raw&decay":
                     warn('WARNING: raw&decay normalization not implemented '
@@ -314,7 +318,7 @@ def run(opts):
             tmpdir=tmpdir, append_to_tar=None, ncpus=opts.cpus,
             nchunks=opts.nchunks, verbose=not opts.quiet,
             extra=param_hash, cooler=opts.cooler, clean=clean,
-            chr_order=opts.chr_name))
+            chr_order=opts.chr_name, binary=opts.binary_tmp))
 
     if clean:
         printime('Cleaning')
@@ -326,6 +330,82 @@ def run(opts):
         save_to_db(opts, launch_time, finish_time, out_files, out_plots)
 
 
+def bin_resolutions(opts, launch_time):
+    """
+    Writes matrices at several resolutions reading the BAM file once, each
+    resolution being stored as a separate job. Only matrices of whole
+    chromosomes can be written this way (no plots).
+    """
+    if opts.matrix or opts.plot:
+        raise Exception('ERROR: several resolutions can only be used to write '
+                        'matrices (no --matrix nor plots)')
+    if any(c and ':' in c for c in (opts.coord1, opts.coord2)):
+        raise Exception('ERROR: several resolutions can only be used with '
+                        'whole chromosomes as coordinates')
+    region1, region2 = opts.coord1, opts.coord2
+    if region2 and not region1:
+        region1, region2 = region2, region1
+
+    resolutions = opts.reso
+    outdir = path.join(opts.workdir, '05_sub-matrices')
+    mkdir(outdir)
+    tmpdir = path.join(opts.workdir, '05_sub-matrices',
+                       '_tmp_sub-matrices_%s' % (
+                           digest_parameters(opts, extra=['quiet'])))
+    mkdir(tmpdir)
+
+    # biases of each resolution
+    biases = {}
+    for reso in resolutions:
+        opts.reso = reso
+        if opts.bam:
+            mreads = path.realpath(opts.bam)
+            if any(v != 'raw' for v in opts.normalizations):
+                raise Exception('ERROR: with several resolutions, biases '
+                                'should be loaded from the database')
+            biases[reso] = None
+        else:
+            reso_biases, reso_mreads = load_parameters_fromdb(opts)
+            reso_mreads = path.join(opts.workdir, reso_mreads)
+            if reso != resolutions[0] and reso_mreads != mreads:
+                raise Exception('ERROR: normalizations at different '
+                                'resolutions come from different BAM files')
+            mreads = reso_mreads
+            biases[reso] = (path.join(opts.workdir, reso_biases)
+                            if reso_biases else None)
+
+    if not opts.quiet:
+        stdout.write('\nExtraction of %s at %s\n' % (
+            ' '.join(r for r in (region1, region2) if r) or
+            ('partial genome' if opts.chr_name else 'full genome'),
+            ', '.join(nicer(reso) for reso in resolutions)))
+    reads, _ = read_bam_multires(
+        mreads, opts.filter, resolutions, ncpus=opts.cpus, region1=region1,
+        region2=region2, nchunks=opts.nchunks, tmpdir=tmpdir,
+        verbose=not opts.quiet, chr_order=opts.chr_name, half=True)
+
+    for reso in resolutions:
+        opts.reso = reso
+        printime('Getting and writing matrices at %s' % (nicer(reso)))
+        out_files = write_matrix(
+            mreads, reso,
+            load(open(biases[reso], 'rb')) if biases[reso] else None,
+            outdir, filter_exclude=opts.filter,
+            normalizations=opts.normalizations,
+            region1=region1, region2=region2, tmpdir=tmpdir,
+            append_to_tar=None, ncpus=opts.cpus, nchunks=opts.nchunks,
+            verbose=not opts.quiet,
+            extra=digest_parameters(opts, extra=['quiet']),
+            cooler=opts.cooler, clean=True, chr_order=opts.chr_name,
+            reads=reads[reso])
+        printime('Saving to DB')
+        save_to_db(opts, launch_time, time.localtime(), out_files, {})
+
+    printime('Cleaning')
+    system('rm -rf %s '% tmpdir)
+    opts.reso = resolutions
+
+
 @retry(lite.OperationalError, tries=20, delay=2)
 def save_to_db(opts, launch_time, finish_time, out_files, out_plots):
     if 'tmpdb' in opts and opts.tmpdb:
@@ -409,6 +489,9 @@ def check_options(opts):
     # transform filtering reads option
     opts.filter = filters_to_bin(opts.filter)
 
+    # several resolutions are kept as a list
+    opts.reso = check_resolutions(opts.reso)
+
     # enlighten plotting parameter writing
     if opts.only_plot:
         opts.plot = True
@@ -485,7 +568,12 @@ def populate_args(parser):
 
     oblopt.add_argument('-r', '--resolution', dest='reso', metavar="INT",
                         action='store', default=None, type=int, required=True,
-                        help='''resolution at which to output matrices''')
+                        nargs='+',
+                        help='''resolution at which to output matrices. With
+                        several resolutions (all multiples of the smallest
+                        one), the BAM is read once, and matrices of each
+                        resolution are written as a separate job (only for
+                        whole chromosomes, without plots)''')
 
     glopts.add_argument('--bam', dest='bam', metavar="PATH",
                         action='store', default=None, type=str,
@@ -516,6 +604,12 @@ def populate_args(parser):
                         help='''maximum number of chunks into which to
                         cut the BAM''')
 
+    glopts.add_argument('--binary_tmp', dest='binary_tmp', action='store_true',
+                        default=False,
+                        help='''store temporary sub-matrices as binary arrays
+                        instead of text files (faster and smaller, recommended
+                        for high resolutions)''')
+
     glopts.add_argument("-C", "--cpus", dest="cpus", type=int,
                         default=cpu_count(), help='''[%(default)s] Maximum
                         number of CPU cores  available in the execution host.
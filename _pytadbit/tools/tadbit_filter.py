@@ -38,10 +38,11 @@ def run(opts):
 
     param_hash = digest_parameters(opts)
 
+    ext = 'tsv.gz' if opts.pairs else 'tsv'
     reads = path.join(opts.workdir, '03_filtered_reads',
-                      'all_r1-r2_intersection_%s.tsv' % param_hash)
+                      'all_r1-r2_intersection_%s.%s' % (param_hash, ext))
     mreads = path.join(opts.workdir, '03_filtered_reads',
-                       'valid_r1-r2_intersection_%s.tsv' % param_hash)
+                       'valid_r1-r2_intersection_%s.%s' % (param_hash, ext))
 
     if not opts.resume:
         mkdir(path.join(opts.workdir, '03_filtered_reads'))
@@ -57,7 +58,10 @@ def run(opts):
             # compute the intersection of the two read ends
             print('Getting intersection between read 1 and read 2')
             count, multiples = get_intersection(fname1, fname2, reads,
-                                                compress=opts.compress_input)
+                                                compress=opts.compress_input,
+                                                pairs=opts.pairs,
+                                                ncpus=opts.cpus,
+                                                max_mem=opts.max_mem)
 
         # compute insert size
         print('Get insert size...')
@@ -101,9 +105,11 @@ def run(opts):
                               min_frag_size=opts.min_frag_size,
                               re_proximity=opts.re_proximity,
                               strict_duplicates=opts.strict_duplicates,
-                              min_dist_to_re=min_dist, fast=True)
+                              min_dist_to_re=min_dist, fast=True,
+                              ncpus=opts.cpus)
 
-    n_valid_pairs = apply_filter(reads, mreads, masked, filters=opts.apply)
+    n_valid_pairs = apply_filter(reads, mreads, masked, filters=opts.apply,
+                                 pairs=opts.pairs)
 
     outbam = path.join(opts.workdir, '03_filtered_reads',
                        'intersection_%s' % param_hash)
@@ -458,6 +464,12 @@ def populate_args(parser):
                         --fast_fragment only one PATHid is needed otherwise one
                         per read is needed, first for read 1, second for read 2.''')
 
+    glopts.add_argument('--max_mem', dest='max_mem', metavar="INT",
+                        action='store', default=1000, type=int,
+                        help='''[%(default)s] approximate memory (in Mb) used
+                        by each CPU when sorting the intersection of read 1 and
+                        read 2''')
+
     glopts.add_argument('--compress_input', dest='compress_input',
                         action='store_true', default=False,
                         help='''Compress input mapped files when parsing is
@@ -475,6 +487,13 @@ def populate_args(parser):
                         help='''stores only valid-pairs discards filtered out
                         reads.''')
 
+    output.add_argument('--pairs', dest='pairs', default=False,
+                        action='store_true',
+                        help='''store intersected and valid reads in
+                        block-compressed files, indexed by the position of the
+                        first read-end (region of these files can be loaded
+                        without parsing the whole file)''')
+
     output.add_argument('--clean', dest='clean', default=False,
                         action='store_true',
                         help='''remove intermediate files. WARNING: together
@@ -493,6 +512,12 @@ def check_options(opts):
     if not opts.workdir:
         raise Exception('ERROR: output option required.')
 
+    # number of cpus
+    if opts.cpus == 0:
+        opts.cpus = cpu_count()
+    else:
+        opts.cpus = min(opts.cpus, cpu_count())
+
     # check resume
     if not path.exists(opts.workdir) and opts.resume:
         print('WARNING: can use output files, found, not resuming...')
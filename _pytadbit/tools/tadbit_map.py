@@ -83,7 +83,7 @@ def run(opts):
             # allows the use of pickle genome to make it faster
             genome_seq = load(open(opts.genome[0],'rb'))
         except (UnpicklingError, KeyError):
-            genome_seq = parse_fasta(opts.genome)
+            genome_seq = parse_fasta(opts.genome, memory_map=True)
 
         logging.info('mapping %s and %s to %s', opts.fastq, opts.fastq2, opts.workdir)
         outfiles = fast_fragment_mapping(opts.index, opts.fastq, opts.fastq2,
@@ -103,7 +103,8 @@ def run(opts):
                                 frag_map=not opts.iterative, clean=not opts.keep_tmp,
                                 windows=opts.windows, get_nread=True, skip=opts.skip,
                                 suffix=param_hash, mapper_binary=opts.mapper_binary,
-                                mapper_params=opts.mapper_param)
+                                mapper_params=opts.mapper_param, stream=opts.stream,
+                                pipeline=opts.pipeline)
 
     # adjust line count
     if opts.skip:
@@ -533,6 +534,19 @@ def populate_args(parser):
                          --fastq2 and --genome needs to be
                         specified and --read value should be 0.''')
 
+    mapper.add_argument('--stream', dest='stream', default=False,
+                        action='store_true',
+                        help='''pipe the transformed reads directly into the
+                        mapper instead of waiting for the whole FASTQ to be
+                        transformed before mapping''')
+
+    mapper.add_argument('--pipeline', dest='pipeline', default=False,
+                        action='store_true',
+                        help='''run all mapping steps (windows of the iterative
+                        mapping and fragment based mapping) at the same time,
+                        passing the reads left unmapped from one step to the
+                        next through named pipes (implies --stream)''')
+
     mapper.add_argument('--windows', dest='windows', default=None,
                         nargs='+',
                         help='''defines windows to be used to trim the input
@@ -173,7 +173,8 @@ try:
                                         n_cpus=opts.cpus_per_job, keep_all=True,
                                         start=int(opts.rand)+%s, container=None,
                                         config=optpar, coords=coords, experiment=exp,
-                                        zeros=zeros)
+                                        zeros=zeros,
+                                        keep_logs="objective function" in opts.analyze_list)
 
     models.save_models(path.join("%s",'results.models'),minimal=%s)
 except Exception as e:
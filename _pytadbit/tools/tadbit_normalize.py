@@ -10,13 +10,13 @@ from __future__ import print_function
 from future import standard_library
 standard_library.install_aliases()
 from argparse                             import HelpFormatter
-from os                                   import path, remove, system
-from sys                                  import exc_info, stdout
+from os                                   import path, remove, rename
+from sys                                  import exc_info
 from string                               import ascii_letters
 from random                               import random
 from shutil                               import copyfile, rmtree
 from collections                          import OrderedDict, defaultdict
-from pickle                               import dump, load, HIGHEST_PROTOCOL
+from pickle                               import dump, HIGHEST_PROTOCOL
 from traceback                            import print_exc
 from multiprocessing                      import cpu_count
 import multiprocessing  as mu
@@ -25,9 +25,11 @@ import time
 
 from pysam                                import AlignmentFile
 from numpy                                import nanmean, isnan, nansum, nanpercentile, seterr
+from numpy                                import fromiter, unique, bincount, zeros, ones, int64
+from numpy                                import empty, save, load, concatenate
 from matplotlib                           import pyplot as plt
 
-from pytadbit                             import load_hic_data_from_bam
+from pytadbit                             import SparseHiC_data
 from pytadbit.utils.sqlite_utils          import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils          import add_path, get_jobid, print_db, retry
 from pytadbit.utils.file_handling         import mkdir
@@ -36,14 +38,17 @@ from pytadbit.mapping.filter              import MASKED
 from pytadbit.utils                       import printime
 from pytadbit.parsers.hic_bam_parser      import print_progress
 from pytadbit.parsers.hic_bam_parser      import filters_to_bin
+from pytadbit.parsers.hic_bam_parser      import _count_pixels, _bias_array
+from pytadbit.parsers.hic_bam_parser      import read_bam_multires, _frag_fname
+from pytadbit.parsers.hic_bam_parser      import check_resolutions
+from pytadbit.parsers.hic_bam_parser      import GenomeBins
 from pytadbit.parsers.bed_parser          import parse_mappability_bedGraph
 from pytadbit.utils.extraviews            import nicer
 # from pytadbit.utils.hic_filtering         import filter_by_local_ratio
 from pytadbit.utils.hic_filtering         import plot_filtering
 # from pytadbit.utils.hic_filtering         import filter_by_zero_count
 from pytadbit.utils.normalize_hic         import oneD
-from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES
-from pytadbit.parsers.genome_parser       import parse_fasta, get_gc_content
+from pytadbit.parsers.genome_parser       import parse_fasta, get_bin_tracks
 from functools import reduce
 
 # removes annoying message when normalizing...
@@ -56,17 +61,49 @@ def run(opts):
     check_options(opts)
     launch_time = time.localtime()
 
-    param_hash = digest_parameters(opts)
     if opts.bam:
         mreads = path.realpath(opts.bam)
     else:
         mreads = path.join(opts.workdir, load_parameters_fromdb(opts))
 
-    filter_exclude = opts.filter
-
     outdir = path.join(opts.workdir, '04_normalization')
     mkdir(outdir)
 
+    if not isinstance(opts.reso, list):
+        normalize_resolution(opts, mreads, outdir, launch_time)
+        return
+
+    # several resolutions: the BAM is read once, and each resolution is
+    # normalized from its sub-matrices, as a separate job
+    resolutions = opts.reso
+    printime('  - Parsing BAM at %s' % (
+        ', '.join(nicer(reso) for reso in resolutions)))
+    reads, _ = read_bam_multires(mreads, opts.filter, resolutions,
+                                 ncpus=opts.cpus, nchunks=opts.max_njobs,
+                                 tmpdir=outdir, verbose=False)
+    for reso in resolutions:
+        _, rand_hash, _, (regs, begs, ends) = reads[reso]
+        chunks = [(region, _frag_fname(outdir, rand_hash, region, beg, end, True))
+                  for region, beg, end in zip(regs, begs, ends)]
+        opts.reso = reso
+        printime('Normalizing at %s' % (nicer(reso)))
+        normalize_resolution(opts, mreads, outdir, launch_time, chunks=chunks)
+        rmtree(path.join(outdir, '_tmp_%s' % (rand_hash)))
+    opts.reso = resolutions
+
+
+def normalize_resolution(opts, mreads, outdir, launch_time, chunks=None):
+    """
+    Normalizes Hi-C data at the resolution opts.reso, and stores the job in the
+    database.
+
+    :param None chunks: list of the chromosome name and path of sub-matrices
+       already counted at this resolution (the BAM is then not read, see
+       :func:`read_bam`)
+    """
+    param_hash = digest_parameters(opts)
+    filter_exclude = opts.filter
+
     mappability = gc_content = n_rsites = None
     if opts.normalization == 'oneD':
         if not opts.fasta:
@@ -81,7 +118,7 @@ def run(opts):
 
         # get genome sequence ~1 min
         printime('  - parsing FASTA')
-        genome = parse_fasta(opts.fasta, verbose=False)
+        genome = parse_fasta(opts.fasta, verbose=False, memory_map=True)
 
         fas = set(genome.keys())
         bam = set(refs)
@@ -115,23 +152,18 @@ def run(opts):
         mappability = reduce(lambda x, y: x + y,
                              (mappability.get(c, []) for c in refs))
 
-        printime('  - Computing GC content per bin (removing Ns)')
-        gc_content = get_gc_content(genome, opts.reso, chromosomes=refs,
-                                    n_cpus=opts.cpus)
+        # GC content and RE sites per bin (cached next to the FASTA)
+        printime('  - Computing GC content (removing Ns) and number of RE '
+                 'sites per bin (+/- 200 bp)')
+        tracks = get_bin_tracks(genome, opts.reso, r_enz=opts.renz,
+                                chromosomes=refs,
+                                cache=opts.fasta + '_tracks', n_cpus=opts.cpus)
+        gc_content = [v for crm in refs for v in tracks['gc'][crm].tolist()]
+        n_rsites   = [v for crm in refs for v in tracks['rsites'][crm].tolist()]
         # pad mappability at the end if the size is close to gc_content
         if len(mappability)<len(gc_content) and len(mappability)/len(gc_content) > 0.95:
             mappability += [float('nan')] * (len(gc_content)-len(mappability))
 
-        # compute r_sites ~30 sec
-        # TODO: read from DB
-        printime('  - Computing number of RE sites per bin (+/- 200 bp)')
-        n_rsites  = []
-        re_site = RESTRICTION_ENZYMES[opts.renz].replace('|', '')
-        for crm in refs:
-            for pos in range(200, len(genome[crm]) + 200, opts.reso):
-                seq = genome[crm][pos-200:pos + opts.reso + 200]
-                n_rsites.append(seq.count(re_site))
-
         ## CHECK TO BE REMOVED
         # out = open('tmp_mappability.txt', 'w')
         # i = 0
@@ -151,7 +183,8 @@ def run(opts):
         normalize_only=opts.normalize_only, max_njobs=opts.max_njobs,
         extra_bads=opts.badcols, biases_path=opts.biases_path, 
         cis_limit=opts.cis_limit, trans_limit=opts.trans_limit, 
-        min_ratio=opts.ratio_limit, fast_filter=opts.fast_filter)
+        min_ratio=opts.ratio_limit, fast_filter=opts.fast_filter,
+        out_of_core=opts.out_of_core, chunks=chunks)
 
     inter_vs_gcoord = path.join(opts.workdir, '04_normalization',
                                 'interactions_vs_genomic-coords.png_%s_%s.png' % (
@@ -382,7 +415,11 @@ def populate_args(parser):
 
     oblopt.add_argument('-r', '--resolution', dest='reso', metavar="INT",
                         action='store', default=None, type=int, required=True,
-                        help='''resolution at which to output matrices''')
+                        nargs='+',
+                        help='''resolution at which to output matrices. With
+                        several resolutions (all multiples of the smallest
+                        one), the BAM is read once, and each resolution is
+                        normalized as a separate job''')
 
     glopts.add_argument('--bam', dest='bam', metavar="PATH",
                         action='store', default=None, type=str,
@@ -426,6 +463,13 @@ def populate_args(parser):
                         help='''[%(default)s] normalization(s) to apply.
                         Order matters. Choices: %(choices)s''')
 
+    normpt.add_argument('--out_of_core', dest='out_of_core',
+                        action='store_true', default=False,
+                        help='''Only for ICE normalization: do not load the
+                        whole Hi-C matrix in memory, iterate instead over the
+                        sub-matrices stored on disk (slower, but only the
+                        vector of biases is kept in memory)''')
+
     normpt.add_argument('--biases_path', dest='biases_path', type=str,
                         default=None, help='''biases file to compute decay.
                         REQUIRED with "custom" normalization. Format: single
@@ -540,6 +584,9 @@ def check_options(opts):
     # transform filtering reads option
     opts.filter = filters_to_bin(opts.filter)
 
+    # several resolutions are kept as a list
+    opts.reso = check_resolutions(opts.reso)
+
     # check custom normalization
     if opts.normalization=='custom':
         if not opts.biases_path:
@@ -588,136 +635,70 @@ def nice(reso):
 ################################################################################
 ## TODO: This should be handled in the hic bam parser
 
-def read_bam_frag_valid(inbam, filter_exclude, all_bins, sections,
-                        resolution, outdir, extra_out,region, start, end,
-                        next_position=1, last_position=None):
-    
+def _cis_trans_bins(frag, next_position, last_position):
+    """
+    Counts, for each row of a sub-matrix, the number of cis interactions, of
+    total interactions, of cis interactions closer than next_position bins and
+    of cis interactions between next_position and last_position bins.
+
+    :returns: an array with one row per bin and five columns: bin, cis, total,
+       next and last
+    """
+    i, j, v, cis = (frag[:, c].astype(int64) for c in range(4))
+    diff = abs(j - i)
+    rows, idx = unique(i, return_inverse=True)
+    cisv = v * cis
+    cisprc = empty((len(rows), 5), dtype=int64)
+    cisprc[:, 0] = rows
+    for col, weights in enumerate((
+            cisv, v, cisv * (diff <= next_position),
+            cisv * ((diff > next_position) & (diff <= last_position))), 1):
+        cisprc[:, col] = bincount(idx, weights=weights, minlength=len(rows))
+    return cisprc
+
+
+def read_bam_frag(inbam, filter_exclude, offsets, resolution, outdir,
+                  extra_out, region, start, end, next_position=1,
+                  last_position=None):
+    """
+    Counts interactions of a chunk of the BAM file. The sub-matrix is saved
+    to disk as a NumPy array (columns: bin1, bin2, count and cis flag), to be
+    memory-mapped by the following passes.
+
+    :returns: the counts of cis and total interactions per bin (see
+       _cis_trans_bins)
+    """
     if last_position is None:
         last_position = next_position * 5
-    
+
     bamfile = AlignmentFile(inbam, 'rb')
-    refs = bamfile.references
     try:
-        dico = {}
-        for r in bamfile.fetch(region=region,
-                               start=start - (1 if start else 0), end=end,  # coords starts at 0
-                               multiple_iterators=True):
-            crm1 = r.reference_name
-            pos1 = r.reference_start + 1
-            crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
-            try:
-                pos1 = sections[(crm1, pos1 // resolution)]
-                pos2 = sections[(crm2, pos2 // resolution)]
-            except KeyError:
-                continue  # not in the subset matrix we want
-            try:
-                dico[(pos1, pos2)] += 1
-            except KeyError:
-                dico[(pos1, pos2)] = 1
-        cisprc = {}
-        for (i, j), v in dico.items():
-            if all_bins[i][0] == all_bins[j][0]:
-                diff = abs(j - i)
-                try:
-                    cisprc[i][0] += v  # add to cis interactions
-                    cisprc[i][1] += v  # add to total interactions
-                    if diff <= next_position:
-                        cisprc[i][2] += v  # add to total interactions
-                    elif diff <= last_position:
-                        cisprc[i][3] += v  # add to total interactions
-                except KeyError:
-                    if diff <= next_position:
-                        cisprc[i] = [v, v, v, 0]
-                    elif diff <= last_position:
-                        cisprc[i] = [v, v, 0, v]
-                    else:
-                        cisprc[i] = [v, v, 0, 0]
-            else:
-                try:
-                    cisprc[i][1] += v  # only add to total interactions
-                except KeyError:
-                    cisprc[i] = [0, v, 0, 0]
-        out = open(path.join(outdir,
-                             'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out)), 'wb')
-        dump(dico, out, HIGHEST_PROTOCOL)
-        out.close()
-        out = open(path.join(outdir,
-                             'tmp_bins_%s:%d-%d_%s.pickle' % (region, start, end, extra_out)), 'wb')
-        dump(cisprc, out, HIGHEST_PROTOCOL)
-        out.close()
+        frag = _count_pixels(bamfile, region, start, end, filter_exclude,
+                             resolution, offsets, offsets)
+        save(_chunk_fname(outdir, region, start, end, extra_out), frag)
+        return _cis_trans_bins(frag, next_position, last_position)
     except Exception as e:
         exc_type, exc_obj, exc_tb = exc_info()
         fname = path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         print(e)
         print(exc_type, fname, exc_tb.tb_lineno)
+    finally:
+        bamfile.close()
 
 
-def read_bam_frag_filter(inbam, filter_exclude, all_bins, sections,
-                         resolution, outdir, extra_out,region, start, end,
-                         next_position=1, last_position=None):
-
+def read_chunk_frag(fname, next_position=1, last_position=None):
+    """
+    Same as :func:`read_bam_frag` for a sub-matrix already saved to disk.
+    """
     if last_position is None:
         last_position = next_position * 5
+    return _cis_trans_bins(load(fname, mmap_mode='r'), next_position,
+                           last_position)
 
-    bamfile = AlignmentFile(inbam, 'rb')
-    refs = bamfile.references
-    try:
-        dico = {}
-        for r in bamfile.fetch(region=region,
-                               start=start - (1 if start else 0), end=end,  # coords starts at 0
-                               multiple_iterators=True):
-            if r.flag & filter_exclude:
-                continue
-            crm1 = r.reference_name
-            pos1 = r.reference_start + 1
-            crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
-            try:
-                pos1 = sections[(crm1, pos1 // resolution)]
-                pos2 = sections[(crm2, pos2 // resolution)]
-            except KeyError:
-                continue  # not in the subset matrix we want
-            try:
-                dico[(pos1, pos2)] += 1
-            except KeyError:
-                dico[(pos1, pos2)] = 1
-        cisprc = {}
-        for (i, j), v in dico.items():
-            if all_bins[i][0] == all_bins[j][0]:  # same chromosome
-                diff = abs(j - i)
-                try:
-                    cisprc[i][0] += v  # add to cis interactions
-                    cisprc[i][1] += v  # add to total interactions
-                    if diff <= next_position:
-                        cisprc[i][2] += v  # add to total interactions
-                    elif diff <= last_position:
-                        cisprc[i][3] += v  # add to total interactions
-                except KeyError:
-                    if diff <= next_position:
-                        cisprc[i] = [v, v, v, 0]
-                    elif diff <= last_position:
-                        cisprc[i] = [v, v, 0, v]
-                    else:
-                        cisprc[i] = [v, v, 0, 0]
-            else:
-                try:
-                    cisprc[i][1] += v  # only add to total interactions
-                except KeyError:
-                    cisprc[i] = [0, v ,0, 0]
-        out = open(path.join(outdir,
-                             'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out)), 'wb')
-        dump(dico, out, HIGHEST_PROTOCOL)
-        out.close()
-        out = open(path.join(outdir, 'tmp_bins_%s:%d-%d_%s.pickle' % (
-            region, start, end, extra_out)), 'wb')
-        dump(cisprc, out, HIGHEST_PROTOCOL)
-        out.close()
-    except Exception as e:
-        exc_type, exc_obj, exc_tb = exc_info()
-        fname = path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        print(e)
-        print(exc_type, fname, exc_tb.tb_lineno)
+
+def _chunk_fname(outdir, region, start, end, extra_out):
+    return path.join(outdir, 'tmp_%s:%d-%d_%s.npy' % (
+        region, start, end, extra_out))
 
 
 def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
@@ -725,56 +706,29 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
              cg_content=None, sigma=2, ncpus=8, factor=1, outdir='.', seed=1,
              extra_out='', only_valid=False, normalize_only=False, p_fit=None,
              max_njobs=100, extra_bads=None, 
-             cis_limit=1, trans_limit=5, min_ratio=1.0, fast_filter=False):
+             cis_limit=1, trans_limit=5, min_ratio=1.0, fast_filter=False,
+             out_of_core=False, chunks=None):
+    """
+    :param None chunks: list of the chromosome name and path of sub-matrices
+       already counted (e.g. by
+       :func:`pytadbit.parsers.hic_bam_parser.read_bam_multires`), instead of
+       counting them from the BAM. Sub-matrices are of the whole genome, and
+       are removed.
+    """
     bamfile = AlignmentFile(inbam, 'rb')
     sections = OrderedDict(list(zip(bamfile.references,
                                [x // resolution + 1 for x in bamfile.lengths])))
-    total = 0
-    section_pos = dict()
-    for crm in sections:
-        section_pos[crm] = (total, total + sections[crm])
-        total += sections[crm]
-    bins = []
-    for crm in sections:
-        len_crm = sections[crm]
-        bins.extend([(crm, i) for i in range(len_crm)])
-
-    start_bin = 0
-    end_bin   = len(bins)
-    total     = len(bins)
-
-    regs = []
-    begs = []
-    ends = []
-    njobs = min(total, max_njobs) + 1
-    nbins = total // njobs + 1
-    for i in range(start_bin, end_bin, nbins):
-        if i + nbins > end_bin:  # make sure that we stop
-            nbins = end_bin - i
-        try:
-            (crm1, beg1), (crm2, end2) = bins[i], bins[i + nbins - 1]
-        except IndexError:
-            try:
-                (crm1, beg1), (crm2, end2) = bins[i], bins[-1]
-            except IndexError:
-                break
-        if crm1 != crm2:
-            end1 = sections[crm1]
-            beg2 = 0
-            regs.append(crm1)
-            regs.append(crm2)
-            begs.append(beg1 * resolution)
-            begs.append(beg2 * resolution)
-            ends.append(end1 * resolution + resolution)  # last nt included
-            ends.append(end2 * resolution + resolution - 1)  # last nt not included (overlap with next window)
-        else:
-            regs.append(crm1)
-            begs.append(beg1 * resolution)
-            ends.append(end2 * resolution + resolution - 1)
-    ends[-1] += 1  # last nucleotide included
+    bins = GenomeBins(sections, resolution)
+    section_pos = dict((crm, bins.section_pos(crm)) for crm in sections)
+    total = len(bins)
+
+    if chunks:
+        regs = [region for region, _ in chunks]
+    else:
+        regs, begs, ends = bins.chunks(0, total, max_njobs)
 
-    # print '\n'.join(['%s %d %d' % (a, b, c) for a, b, c in zip(regs, begs, ends)])
-    printime('  - Parsing BAM (%d chunks)' % (len(regs)))
+        # print '\n'.join(['%s %d %d' % (a, b, c) for a, b, c in zip(regs, begs, ends)])
+        printime('  - Parsing BAM (%d chunks)' % (len(regs)))
     # define limits for cis and trans interactions if not given
     if cis_limit is None:
         cis_limit = int(1_000_000 / resolution)
@@ -785,36 +739,25 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     print('      -> trans interactions are defined as being bellow {}'.format(
         nicer(trans_limit * resolution)))
 
-    bins_dict = dict([(j, i) for i, j in enumerate(bins)])
-    pool = mu.Pool(ncpus)
-    procs = []
-    read_bam_frag = read_bam_frag_valid if only_valid else read_bam_frag_filter
-    for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
-        procs.append(pool.apply_async(
-            read_bam_frag, args=(inbam, filter_exclude, bins, bins_dict,
-                                 resolution, outdir, extra_out,
-                                 region, start, end, cis_limit, trans_limit)))
-    pool.close()
-    print_progress(procs)
-    pool.join()
+    # same workers for all the passes over the sub-matrices
+    pool = ChunkPool(ncpus, outdir, extra_out)
+    if chunks:
+        fnames = [fname for _, fname in chunks]
+        results = pool.map(read_chunk_frag, [
+            (fname, cis_limit, trans_limit) for fname in fnames])
+    else:
+        offsets = bins.bam_offsets(bamfile.references)
+        fnames = [_chunk_fname(outdir, region, start, end, extra_out)
+                  for region, start, end in zip(regs, begs, ends)]
+        results = pool.map(read_bam_frag, [
+            (inbam, 0 if only_valid else filter_exclude, offsets, resolution,
+             outdir, extra_out, region, start, end, cis_limit, trans_limit)
+            for region, start, end in zip(regs, begs, ends)])
     ## COLLECT RESULTS
     cisprc = {}
     printime('  - Collecting cis and total interactions per bin (%d chunks)' % (len(regs)))
-    stdout.write('     ')
-    for countbin, (region, start, end) in enumerate(zip(regs, begs, ends)):
-        if not countbin % 10 and countbin:
-            stdout.write(' ')
-        if not countbin % 50 and countbin:
-            stdout.write(' %9s\n     ' % ('%s/%s' % (countbin , len(regs))))
-        stdout.write('.')
-        stdout.flush()
-
-        fname = path.join(outdir,
-                          'tmp_bins_%s:%d-%d_%s.pickle' % (region, start, end, extra_out))
-        tmp_cisprc = load(open(fname,'rb'))
-        system('rm -f %s' % fname)
-        cisprc.update(tmp_cisprc)
-    stdout.write('\n')
+    for tmp_cisprc in results:
+        cisprc.update((b, [c, t, n, l]) for b, c, t, n, l in tmp_cisprc.tolist())
 
     # get cis/trans ratio
     for k in cisprc:
@@ -896,11 +839,18 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     biases = [float('nan') if k in badcol else cisprc.get(k, [0, 1., 0, 0])[1]
               for k in range(size)]
 
-    if normalization == 'ICE':
+    if normalization == 'ICE' and out_of_core:
+        printime('  - ICE normalization (out-of-core)')
+        biases = ice_from_chunks(fnames, badcol, size, pool=pool,
+                                 iterations=100, max_dev=0.000001)
+    elif normalization == 'ICE':
         printime('  - ICE normalization')
-        hic_data = load_hic_data_from_bam(
-            inbam, resolution, filter_exclude=filter_exclude,
-            tmpdir=outdir, ncpus=ncpus, nchunks=max_njobs)
+        # the genomic matrix is made from the sub-matrices already on disk
+        rows, cols, vals = list(zip(*[_load_chunk(fname) for fname in fnames]))
+        hic_data = SparseHiC_data.from_coo(
+            concatenate(rows), concatenate(cols), concatenate(vals), size,
+            chromosomes=sections, resolution=resolution)
+        del(rows, cols, vals)
         hic_data.bads = badcol
         hic_data.normalize_hic(iterations=100, max_dev=0.000001)
         biases = hic_data.bias.copy()
@@ -957,42 +907,29 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     # out = open(os.path.join(outdir,
     #                         'hicdata_%s.abc' % (nicer(resolution).replace(' ', ''))), 'w')
     printime('  - Getting sum of normalized bins')
-    pool = mu.Pool(ncpus)
-    procs = []
-    for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
-        fname = path.join(outdir,
-                          'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out))
-        procs.append(pool.apply_async(sum_nrm_matrix,
-                                      args=(fname, biases,)))
-    pool.close()
-    print_progress(procs)
-    pool.join()
+    bias_arr = _bias_array(biases, size)
+    shared = pool.share('biases', bias_arr)
+    sumnrm = sum(pool.map(sum_nrm_matrix,
+                          [(fname, shared) for fname in fnames]))
 
     # to correct biases
-    sumnrm = sum(p.get() for p in procs)
-
     target = (sumnrm / float(size * size * factor))**0.5
     biases = dict([(b, biases[b] * target) for b in biases])
+    bias_arr *= target
+    bad_arr = zeros(size, dtype=bool)
+    bad_arr[[b for b in badcol if 0 <= b < size]] = True
+    shared = pool.share('biases', bias_arr), pool.share('bads', bad_arr)
 
     if not normalize_only:
         printime('  - Computing Cis percentage')
         # Calculate Cis percentage
 
-        pool = mu.Pool(ncpus)
-        procs = []
-        for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
-            fname = path.join(outdir,
-                              'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out))
-            procs.append(pool.apply_async(get_cis_perc,
-                                          args=(fname, biases, badcol, bins)))
-        pool.close()
-        print_progress(procs)
-        pool.join()
+        results = pool.map(get_cis_perc,
+                           [(fname, ) + shared for fname in fnames])
 
         # collect results
         cis = total = 0
-        for proc in procs:
-            c, t = proc.get()
+        for c, t in results:
             cis += c
             total += t
         norm_cisprc = float(cis) / total
@@ -1004,22 +941,14 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     # normalize decay by size of the diagonal, and by Vanilla correction
     # (all cells must still be equals to 1 in average)
 
-    pool = mu.Pool(ncpus)
-    procs = []
-    for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
-        fname = path.join(outdir,
-                          'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out))
-        procs.append(pool.apply_async(sum_dec_matrix,
-                                      args=(fname, biases, badcol, bins)))
+    results = pool.map(sum_dec_matrix, [(fname, ) + shared + (region, )
+                                        for fname, region in zip(fnames, regs)])
     pool.close()
-    print_progress(procs)
-    pool.join()
 
     # collect results
     nrmdec = {}
     rawdec = {}
-    for proc in procs:
-        tmpnrm, tmpraw = proc.get()
+    for tmpnrm, tmpraw in results:
         for c, d in tmpnrm.items():
             for k, v in d.items():
                 try:
@@ -1103,56 +1032,240 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     return biases, nrmdec, badcol, raw_cisprc, norm_cisprc
 
 
-def sum_dec_matrix(fname, biases, badcol, bins):
-    dico = load(open(fname,'rb'))
-    rawdec = {}
-    nrmdec = {}
-    for (i, j), v in dico.items():
-        if i < j:
-            continue
-        # different chromosome
-        c = bins[i][0]
-        if c != bins[j][0]:
-            continue
-        if i in badcol or j in badcol:
-            continue
-        k = i - j
-        val = v / biases[i] / biases[j]
+def sum_dec_matrix(fname, biases, bads, crm):
+    """
+    Sums raw and normalized interactions per diagonal of a sub-matrix (all
+    rows of a sub-matrix belong to the chromosome crm). Removes the sub-matrix
+    file.
+    """
+    biases = _load_vector(biases)
+    bads = _load_vector(bads)
+    i, j, v = _load_chunk(fname, cis_only=True)
+    keep = (i >= j) & ~bads[i] & ~bads[j]
+    i, j, v = i[keep], j[keep], v[keep]
+    k = i - j
+    dists = unique(k).tolist()
+    nrm = bincount(k, weights=v / biases[i] / biases[j])
+    raw = bincount(k, weights=v)
+    _forget_chunk(fname)
+    remove(fname)
+    if not dists:
+        return {}, {}
+    return ({crm: dict((d, nrm[d]) for d in dists)},
+            {crm: dict((d, raw[d]) for d in dists)})
+
+
+def get_cis_perc(fname, biases, bads):
+    biases = _load_vector(biases)
+    bads = _load_vector(bads)
+    i, j, v, cis = _load_chunk(fname, with_cis=True)
+    keep = (i > j) & ~bads[i] & ~bads[j]
+    val = v[keep] / biases[i[keep]] / biases[j[keep]]
+    return val[cis[keep]].sum(), val.sum()
+
+
+def sum_nrm_matrix(fname, biases):
+    biases = _load_vector(biases)
+    i, j, v = _load_chunk(fname)
+    return nansum(v / biases[i] / biases[j])
+
+
+# sub-matrices opened by a worker of a ChunkPool (stays None in the main
+# process)
+_CHUNKS = None
+
+
+def _init_worker():
+    global _CHUNKS
+    _CHUNKS = {}
+
+
+def _forget_chunk(fname):
+    if _CHUNKS is not None:
+        _CHUNKS.pop(fname, None)
+
+
+def _load_vector(fname):
+    return load(fname, mmap_mode='r')
+
+
+def _load_chunk(fname, cis_only=False, with_cis=False):
+    """
+    :returns: arrays of rows, columns and values of a sub-matrix stored on disk
+       (memory-mapped), and optionally the boolean array of cis interactions
+    """
+    if _CHUNKS is None:
+        frag = load(fname, mmap_mode='r')
+    else:
         try:
-            nrmdec[c][k] += val
-            rawdec[c][k] += v
+            frag = _CHUNKS[fname]
         except KeyError:
-            try:
-                nrmdec[c][k] = val
-                rawdec[c][k] = v
-            except KeyError:
-                nrmdec[c] = {k: val}
-                rawdec[c] = {k: v}
-    system('rm -f %s' % (fname))
-    return nrmdec, rawdec
-
-
-def get_cis_perc(fname, biases, badcol, bins):
-    dico = load(open(fname,'rb'))
-    cis = total = 0
-    for (i, j), v in dico.items():
-        if i <= j:
-            continue
-        if i in badcol or j in badcol:
-            continue
-        val = v / biases[i] / biases[j]
-        # same chromosome
-        if bins[i][0] == bins[j][0]:
-            cis += val
-        total += val
-    return cis, total
+            frag = _CHUNKS[fname] = load(fname, mmap_mode='r')
+    if cis_only:
+        frag = frag[frag[:, 3] == 1]
+    i, j = frag[:, 0].astype(int64), frag[:, 1].astype(int64)
+    v = frag[:, 2].astype(float)
+    if with_cis:
+        return i, j, v, frag[:, 3] == 1
+    return i, j, v
 
 
-def sum_nrm_matrix(fname, biases):
-    dico = load(open(fname,'rb'))
-    sumnrm = nansum([v / biases[i] / biases[j]
-                     for (i, j), v in dico.items()])
-    return sumnrm
+def sum_ice_matrix(fname, weights):
+    """
+    Sum per row of a sub-matrix, each cell being weighted by the weights of its
+    row and of its column (weights of bad columns are zero).
+
+    :returns: the rows found in the sub-matrix, and their sums
+    """
+    weights = _load_vector(weights)
+    i, j, v = _load_chunk(fname)
+    rows, idx = unique(i, return_inverse=True)
+    return rows, bincount(idx, weights=v * weights[i] * weights[j],
+                          minlength=len(rows))
+
+
+def _sum_ice_chunks(pool, fnames, weights, size):
+    S = zeros(size)
+    shared = pool.share('weights', weights)
+    for rows, sums in pool.map(sum_ice_matrix,
+                               [(fname, shared) for fname in fnames],
+                               verbose=False):
+        S[rows] += sums
+    return S
+
+
+def ice_from_chunks(fnames, badcol, size, pool=None, ncpus=8, tmpdir='.',
+                    iterations=100, max_dev=0.000001, factor=1, verbose=True):
+    """
+    Iterative correction (Imakaev 2012) computed without loading the Hi-C
+    matrix in memory. Each iteration sums the normalized rows of the
+    sub-matrices stored on disk, only the biases are kept in memory. Gives the
+    same biases as HiC_data.normalize_hic.
+
+    :param fnames: list of paths to the sub-matrices
+    :param badcol: dictionary of columns not to be considered
+    :param size: number of bins of the genomic matrix
+    :param None pool: ChunkPool to use, by default a new one is created
+    :param 8 ncpus: number of CPUs to use to sum the sub-matrices (if no pool
+       given)
+    :param '.' tmpdir: where to write the vectors shared with the workers (if
+       no pool given)
+    :param 100 iterations: maximum number of iterations
+    :param 0.000001 max_dev: iterative process stops when the maximum
+       deviation between the sum of row is lower than this number
+    :param 1 factor: final mean number of normalized interactions wanted per
+       cell
+
+    :returns: a dictionary of biases
+    """
+    if verbose:
+        print('iterative correction (%d chunks)' % len(fnames))
+    own_pool = pool is None
+    if own_pool:
+        pool = ChunkPool(ncpus, tmpdir)
+    # normalized cell value is: raw value * weights[i] * weights[j]
+    weights = ones(size)
+    if badcol:
+        weights[fromiter(badcol, dtype=int64)] = 0
+    B = ones(size)
+    if verbose:
+        print("  - computing biases")
+    for it in range(iterations + 1):
+        S = _sum_ice_chunks(pool, fnames, weights, size)
+        if not it:
+            present = S > 0
+            if not present.any():
+                if own_pool:
+                    pool.close()
+                raise ZeroDivisionError(
+                    'ERROR: normalization failed, all bad columns')
+        meanS = S[present].sum() / present.sum()
+        DB = S / meanS
+        B[present] *= DB[present]
+        if iterations == 0:
+            break
+        weights[present] /= DB[present]
+        Sp = S[present]
+        dev = max(abs(Sp.min() / meanS - 1), abs(Sp.max() / meanS - 1))
+        if verbose:
+            print('   %15.3f %15.3f %15.3f %4s %9.5f' % (
+                Sp.min(), meanS, Sp.max(), it, dev))
+        if dev < max_dev:
+            break
+    B[present] *= meanS**.5
+    B[B == 0] = 1.
+    B[~present] = 1.
+    if factor:
+        if verbose:
+            print('rescaling to factor %d' % factor)
+            print('  - getting the sum of the matrix')
+        weights = 1. / B
+        if badcol:
+            weights[fromiter(badcol, dtype=int64)] = 0
+        norm_sum = _sum_ice_chunks(pool, fnames, weights, size).sum()
+        if verbose:
+            print('    => %.3f' % norm_sum)
+            print('  - rescaling biases')
+        B *= (norm_sum / float(size * size * factor))**0.5
+    if own_pool:
+        pool.close()
+    return dict(enumerate(B.tolist()))
+
+
+class ChunkPool(object):
+    """
+    Pool of workers used by all the passes over the sub-matrices of a
+    normalization. Workers keep the sub-matrices they have opened
+    (memory-mapped) from one pass to the next, and the vectors needed by all
+    the tasks of a pass (biases, bad columns) are written once to disk and
+    memory-mapped by the workers, instead of being sent with each task.
+
+    :param ncpus: number of workers
+    :param '.' tmpdir: where to write the shared vectors
+    :param '' extra_out: suffix for the names of the shared vectors
+    """
+    def __init__(self, ncpus, tmpdir='.', extra_out=''):
+        self.pool = mu.Pool(ncpus, initializer=_init_worker)
+        self.tmpdir = tmpdir
+        self.extra_out = extra_out
+        self.shared = set()
+
+    def share(self, name, arr):
+        """
+        Writes an array to be read by the workers
+
+        :returns: the path to pass to the workers (see _load_vector)
+        """
+        fname = path.join(self.tmpdir, 'tmp_%s_%s.npy' % (name, self.extra_out))
+        # new file, workers may still have the previous one memory-mapped
+        out = open(fname + '.tmp', 'wb')
+        save(out, arr)
+        out.close()
+        rename(fname + '.tmp', fname)
+        self.shared.add(fname)
+        return fname
+
+    def map(self, func, tasks, verbose=True):
+        """
+        Calls func in parallel, once per tuple of arguments in tasks
+
+        :param tasks: list of tuples of arguments
+        :param True verbose: print progress
+
+        :returns: the list of results, in the same order as tasks
+        """
+        procs = [self.pool.apply_async(func, args=args) for args in tasks]
+        if verbose:
+            print_progress(procs)
+        return [proc.get() for proc in procs]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for fname in self.shared:
+            if path.exists(fname):
+                remove(fname)
+        self.shared = set()
 
 
 class SmartFormatter(HelpFormatter):
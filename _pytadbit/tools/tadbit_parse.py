@@ -17,6 +17,7 @@ from argparse                       import HelpFormatter
 from pickle                         import load, UnpicklingError
 from warnings                       import warn
 from functools                      import reduce
+from multiprocessing                import cpu_count
 
 import time
 import logging
@@ -79,18 +80,28 @@ def run(opts):
         # allows the use of pickle genome to make it faster
         genome = load(open(opts.genome[0],'rb'))
     except (UnpicklingError, KeyError):
-        genome = parse_fasta(opts.genome, chr_regexp=opts.filter_chrom)
+        genome = parse_fasta(opts.genome, chr_regexp=opts.filter_chrom,
+                             memory_map=True)
+
+    # RE sites are cached next to the genome
+    if len(opts.genome) == 1:
+        re_cache = opts.genome[0] + '_%s_RE_sites.npz' % ('-'.join(renz))
+    else:
+        re_cache = path.join(path.commonprefix(opts.genome),
+                             '%s_RE_sites.npz' % ('-'.join(renz)))
 
     if not opts.skip:
         logging.info('parsing reads in %s project', name)
         if opts.mapped1 or opts.mapped2:
             counts, multis = parse_sam(f_names1, f_names2, out_file1=out_file1,
                                        out_file2=out_file2, re_name=renz, verbose=True,
-                                       genome_seq=genome, compress=opts.compress_input)
+                                       genome_seq=genome, compress=opts.compress_input,
+                                       re_cache=re_cache, ncpus=opts.cpus)
         else:
             counts, multis = parse_map(f_names1, f_names2, out_file1=out_file1,
                                        out_file2=out_file2, re_name=renz, verbose=True,
-                                       genome_seq=genome, compress=opts.compress_input)
+                                       genome_seq=genome, compress=opts.compress_input,
+                                       re_cache=re_cache)
     else:
         counts = {}
         counts[0] = {}
@@ -361,6 +372,12 @@ def populate_args(parser):
                         help='''default: --filter_chrom "%(default)s", regexp
                         to consider only chromosome names passing''')
 
+    glopts.add_argument("-C", "--cpus", dest="cpus", type=int,
+                        default=cpu_count(), help='''[%(default)s] Maximum
+                        number of CPU cores  available in the execution host.
+                        Used to parse blocks of SAM/BAM files in parallel
+                        (if 0 all available cores will be used)''')
+
     glopts.add_argument('--skip', dest='skip', action='store_true',
                       default=False,
                       help='[DEBUG] in case already mapped.')
@@ -404,6 +421,12 @@ def check_options(opts):
     if not opts.genome: raise Exception('ERROR: genome parameter required.')
     if not opts.workdir: raise Exception('ERROR: workdir parameter required.')
 
+    # number of cpus
+    if opts.cpus == 0:
+        opts.cpus = cpu_count()
+    else:
+        opts.cpus = min(opts.cpus, cpu_count())
+
     # check skip
     if not path.exists(opts.workdir) and opts.skip:
         print ('WARNING: can use output files, found, not skipping...')
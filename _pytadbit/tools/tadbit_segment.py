@@ -21,6 +21,7 @@ import sqlite3 as lite
 import time
 
 from pytadbit                       import load_hic_data_from_bam
+from pytadbit                       import load_hic_data_from_bam_multires
 from pytadbit                       import tadbit
 from pytadbit.utils.sqlite_utils    import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils    import add_path, get_jobid, print_db, retry
@@ -28,6 +29,7 @@ from pytadbit.utils.file_handling   import mkdir
 from pytadbit.parsers.tad_parser    import parse_tads
 from pytadbit.parsers.genome_parser import parse_fasta, get_gc_content
 from pytadbit.mapping.filter        import MASKED
+from pytadbit.parsers.hic_bam_parser import check_resolutions
 from pytadbit.utils.extraviews      import nicer
 
 
@@ -36,8 +38,47 @@ DESC = 'Finds TAD or compartment segmentation in Hi-C data.'
 def run(opts):
     check_options(opts)
     launch_time = time.localtime()
-    param_hash = digest_parameters(opts, get_md5=True)
 
+    if not isinstance(opts.reso, list):
+        segment_resolution(opts, launch_time)
+        return
+
+    # several resolutions: the BAM is read once, and each resolution is
+    # segmented as a separate job
+    if opts.nosql or opts.biases or opts.mreads:
+        raise Exception('ERROR: with several resolutions, biases should be '
+                        'loaded from the database')
+    resolutions = opts.reso
+    inputs = {}
+    for reso in resolutions:
+        opts.reso = reso
+        inputs[reso] = _load_inputs(opts)
+    mreads = inputs[resolutions[0]][1]
+    if any(inputs[reso][1] != mreads for reso in resolutions):
+        raise Exception('ERROR: normalizations at different resolutions come '
+                        'from different BAM files')
+    region = None
+    if opts.crms and len(opts.crms) == 1:
+        region = opts.crms[0]
+    print('loading %s \n    at resolutions %s' % (
+        mreads, ', '.join(nice(reso) for reso in resolutions)))
+    hic_datas = load_hic_data_from_bam_multires(
+        mreads, resolutions, ncpus=opts.cpus, region=region,
+        biases=None if opts.all_bins else dict(
+            (reso, inputs[reso][0]) for reso in resolutions),
+        filter_exclude=opts.filter)
+    for reso in resolutions:
+        opts.reso = reso
+        segment_resolution(opts, launch_time, inputs=inputs[reso],
+                           hic_data=hic_datas.pop(reso))
+    opts.reso = resolutions
+
+
+def _load_inputs(opts):
+    """
+    :returns: path to biases, path to the BAM file, and their IDs in the
+       database
+    """
     if opts.nosql:
         biases = opts.biases
         mreads = opts.mreads
@@ -57,19 +98,35 @@ def run(opts):
         # store path ids to be saved in database
         mreads = path.join(opts.workdir, mreads)
         biases = path.join(opts.workdir, biases)
+    return biases, mreads, inputs
+
+
+def segment_resolution(opts, launch_time, inputs=None, hic_data=None):
+    """
+    Finds compartments and TADs at the resolution opts.reso, and stores the
+    job in the database.
+
+    :param None inputs: biases, BAM file and their IDs in the database, as
+       returned by _load_inputs
+    :param None hic_data: Hi-C data already loaded at this resolution (the
+       BAM is then not read)
+    """
+    param_hash = digest_parameters(opts, get_md5=True)
+    biases, mreads, inputs = inputs or _load_inputs(opts)
 
     reso   = opts.reso
 
     mkdir(path.join(opts.workdir, '06_segmentation'))
 
-    print('loading %s \n    at resolution %s' % (mreads, nice(reso)))
-    region = None
-    if opts.crms and len(opts.crms) == 1:
-        region = opts.crms[0]
-    hic_data = load_hic_data_from_bam(mreads, reso, ncpus=opts.cpus,
-                                      region=region,
-                                      biases=None if opts.all_bins else biases,
-                                      filter_exclude=opts.filter)
+    if hic_data is None:
+        print('loading %s \n    at resolution %s' % (mreads, nice(reso)))
+        region = None
+        if opts.crms and len(opts.crms) == 1:
+            region = opts.crms[0]
+        hic_data = load_hic_data_from_bam(mreads, reso, ncpus=opts.cpus,
+                                          region=region,
+                                          biases=None if opts.all_bins else biases,
+                                          filter_exclude=opts.filter)
 
     # compartments
     cmp_result = {}
@@ -84,7 +141,8 @@ def run(opts):
             print('  - Computing GC content to label compartments')
             rich_in_A = get_gc_content(parse_fasta(opts.fasta, chr_filter=opts.crms, save_cache=False), reso,
                                        chromosomes=opts.crms,
-                                       by_chrom=True, n_cpus=opts.cpus)
+                                       by_chrom=True, n_cpus=opts.cpus,
+                                       cache=opts.fasta + '_tracks')
         elif opts.rich_in_A:
             rich_in_A = opts.rich_in_A
         else:
@@ -450,7 +508,12 @@ def populate_args(parser):
 
     glopts.add_argument('-r', '--resolution', dest='reso', metavar="INT",
                         action='store', default=None, type=int, required=True,
-                        help='''resolution at which to output matrices''')
+                        nargs='+',
+                        help='''resolution at which to output matrices. With
+                        several resolutions (all multiples of the smallest
+                        one), the BAM is read once, and each resolution is
+                        segmented as a separate job (biases are loaded from
+                        the database)''')
 
     glopts.add_argument('--norm_matrix', dest='norm_matrix', metavar="PATH",
                         action='store', default=None, type=str,
@@ -564,6 +627,9 @@ def populate_args(parser):
 
 def check_options(opts):
 
+    # several resolutions are kept as a list
+    opts.reso = check_resolutions(opts.reso)
+
     # number of cpus
     if opts.cpus == 0:
         opts.cpus = cpu_count()
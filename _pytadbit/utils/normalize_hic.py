@@ -68,7 +68,8 @@ from __future__ import print_function
 from subprocess import Popen, PIPE
 from os import path
 
-from numpy import genfromtxt
+from numpy import genfromtxt, bincount, fromiter, ones, int64
+from scipy.sparse import coo_matrix, issparse
 
 from pytadbit.utils.file_handling import which
 
@@ -133,48 +134,50 @@ def oneD(tmp_dir='.', form='tot ~ s(map) + s(cg) + s(res)', p_fit=None,
     return biases_oneD
 
 
-def _update_S(W):
-    S = {}
-    meanS = 0.0
-    for bin1 in W:
-        S[bin1] = sum(W[bin1].values())
-        meanS += S[bin1]
-    meanS /= len(W)
+def _update_S(rows, data, present, size):
+    S = bincount(rows, weights=data, minlength=size)
+    meanS = S[present].sum() / present.sum()
     return S, meanS
 
 
-def _updateDB(S, meanS, B):
-    DB = {}
-    for bin1 in S:
-        DB[bin1] = float(S[bin1]) / meanS
-        B[bin1] *= DB[bin1]
+def _updateDB(S, meanS, B, present):
+    DB = S / meanS
+    B[present] *= DB[present]
     return DB
 
 
-def _update_W(W, DB):
-    for bin1 in W:
-        DBbin1 = DB[bin1]
-        W1 = W[bin1]
-        for bin2 in W1:
-            try:
-                W1[bin2] /= DBbin1 * DB[bin2]
-            except ZeroDivisionError: # whole row is empty
-                continue
+def _update_W(rows, cols, data, DB):
+    scale = DB[rows] * DB[cols]
+    # whole row is empty
+    nonzero = scale != 0
+    data[nonzero] /= scale[nonzero]
 
 
 def copy_matrix(hic_data, bads):
-    W = {}
-    N = len(hic_data)
-    for k, v in hic_data.items():
-        i, j = divmod(k, N)
-        if i in bads or j in bads:
-            continue
-        try:
-            W[i][j] = v
-        except KeyError:
-            W[i] = {}
-            W[i][j] = v
-    return W
+    """
+    :returns: rows, columns and values (as float, a copy that can be modified
+       in place) of the interactions, skipping bad columns
+    """
+    try:
+        matrix = hic_data.get_hic_data_as_csr()
+    except AttributeError:  # plain dictionary or already a sparse matrix
+        if issparse(hic_data):
+            matrix = hic_data
+        else:
+            N = len(hic_data)
+            keys = fromiter(hic_data.keys(), dtype=int64, count=len(hic_data))
+            values = fromiter(hic_data.values(), dtype=float,
+                              count=len(hic_data))
+            matrix = coo_matrix((values, (keys // N, keys % N)), shape=(N, N))
+    matrix = matrix.tocoo()
+    rows, cols = matrix.row, matrix.col
+    data = matrix.data.astype(float)
+    if bads:
+        good = ones(matrix.shape[0], dtype=bool)
+        good[fromiter(bads, dtype=int64)] = False
+        keep = good[rows] & good[cols]
+        rows, cols, data = rows[keep], cols[keep], data[keep]
+    return rows, cols, data
 
 
 def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
@@ -182,9 +185,12 @@ def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
     """
     Implementation of iterative correction Imakaev 2012
 
-    :param hic_data: dictionary containing the interaction data
+    Computed on the sparse representation of the matrix (arrays of rows,
+    columns and values).
+
+    :param hic_data: dictionary containing the interaction data, or a scipy
+       sparse matrix
     :param None bads: dictionary with column not to be considered
-    :param None remove: columns not to consider
     :param 0 iterations: number of iterations to do (99 if a fully smoothed
        matrix with no visibility differences between columns is desired)
     :param 0.00001 max_dev: maximum difference allowed between a row and the
@@ -193,42 +199,36 @@ def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
     """
     if verbose:
         print('iterative correction')
-    size = len(hic_data)
+    size = hic_data.shape[0] if issparse(hic_data) else len(hic_data)
     if not bads:
         bads = {}
-    remove = [i in bads for i in range(size)]
-    remove = remove or tuple([int(hic_data[i+i*size]==0) for i in range(size)])
 
     if verbose:
         print("  - copying matrix")
 
-    W = copy_matrix(hic_data, bads)
-    B = dict([(b, 1.) for b in W])
-    if len(B) == 0:
+    rows, cols, data = copy_matrix(hic_data, bads)
+    present = bincount(rows, minlength=size) > 0
+    B = ones(size)
+    if not present.any():
         raise ZeroDivisionError('ERROR: normalization failed, all bad columns')
     if verbose:
         print("  - computing biases")
     for it in range(iterations + 1):
-        S, meanS = _update_S(W)
-        DB = _updateDB(S, meanS, B)
+        S, meanS = _update_S(rows, data, present, size)
+        DB = _updateDB(S, meanS, B, present)
         if iterations == 0: # exit before, we do not need to update W
             break
-        _update_W(W, DB)
-        S = sorted(S.values())
-        dev = max(abs(S[0]  / meanS - 1), abs(S[-1] / meanS - 1))
+        _update_W(rows, cols, data, DB)
+        S = S[present]
+        dev = max(abs(S.min() / meanS - 1), abs(S.max() / meanS - 1))
         if verbose:
-            print('   %15.3f %15.3f %15.3f %4s %9.5f' % (S[0], meanS, S[-1], it, dev))
+            print('   %15.3f %15.3f %15.3f %4s %9.5f' % (S.min(), meanS, S.max(), it, dev))
         if dev < max_dev:
             break
-    for i in range(size):
-        try:
-            if B[i]:
-                B[i] *= meanS**.5
-            else:
-                B[i] = 1.
-        except KeyError:
-            B[i] = 1.
-    return B
+    B[present] *= meanS**.5
+    B[B == 0] = 1.
+    B[~present] = 1.
+    return dict(enumerate(B.tolist()))
 
 
 def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwargs):
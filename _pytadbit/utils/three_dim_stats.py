@@ -297,9 +297,10 @@ def angle_between_3_points(point1, point2, point3):
 def calc_consistency(models, nloci, zeros, dcutoff=200):
     combines = list(combinations(models, 2))
     parts = [0 for _ in range(nloci)]
-    for pm in consistency_wrapper([model['x'] for model in models],
-                                  [model['y'] for model in models],
-                                  [model['z'] for model in models],
+    # coordinates may be arrays, the wrapper only reads lists
+    for pm in consistency_wrapper([list(model['x']) for model in models],
+                                  [list(model['y']) for model in models],
+                                  [list(model['z']) for model in models],
                                   zeros,
                                   nloci, dcutoff, list(range(len(models))),
                                   len(models)):
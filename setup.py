@@ -123,6 +123,11 @@ def main():
                                     language = "c",
                                     sources=['src/tadbit_alone_py.c'],
                                     extra_compile_args=['-std=c99'])
+    # c module to read the fixed fields of BAM records
+    bam_records_module = Extension('pytadbit.bam_records',
+                                   language = "c",
+                                   sources=['src/bam_records_py.c'],
+                                   extra_compile_args=['-std=c99'])
     # c++ module to compute the distance matrix of single model
     squared_distance_matrix_module = Extension('pytadbit.squared_distance_matrix',
                                                language = "c++",
@@ -176,6 +181,7 @@ def main():
         author       = 'Davide Bau, Francois Serra, Guillaume Filion and Marc Marti-Renom',
         author_email = 'serra.francois@gmail.com',
         ext_modules  = [pytadbit_module, pytadbit_module_old,
+                        bam_records_module,
                         eqv_rmsd_module, centroid_module,
                         consistency_module, aligner3d_module,
                         squared_distance_matrix_module],
@@ -0,0 +1,98 @@
+#include "Python.h"
+#include <string.h>
+#include <stdint.h>
+
+#if PY_MAJOR_VERSION >= 3
+  #define BUFFER_FORMAT "y*n:core_fields"
+#else
+  #define BUFFER_FORMAT "s*n:core_fields"
+#endif
+
+/* size of the fixed part of a BAM record (block_size included) */
+#define CORE_SIZE 36
+
+static int32_t read_int32(const unsigned char *p){
+  return (int32_t)((uint32_t)p[0] | ((uint32_t)p[1] << 8) |
+                   ((uint32_t)p[2] << 16) | ((uint32_t)p[3] << 24));
+}
+
+/* The function doc string */
+PyDoc_STRVAR(core_fields__doc__,
+"From a buffer of decompressed BAM records and a position in it, returns \n\
+the concatenated fixed parts (36 first bytes) of the complete records \n\
+starting at this position, and the position after the last one.\n\
+   :param data: decompressed BAM data\n\
+   :param pos: position of the first record in data\n\
+   :returns: a tuple with the bytes of the fixed parts, and a position\n\
+");
+
+static PyObject *core_fields(PyObject *self, PyObject *args){
+  Py_buffer view;
+  Py_ssize_t pos, size, nxt, n = 0, cap = 0;
+  const unsigned char *data;
+  PyObject *cores, *ret;
+
+  if (!PyArg_ParseTuple(args, BUFFER_FORMAT, &view, &pos))
+    return NULL;
+  data = (const unsigned char *) view.buf;
+  size = view.len;
+
+  /* first pass to count the records */
+  nxt = pos;
+  while (nxt + CORE_SIZE <= size){
+    Py_ssize_t end = nxt + 4 + read_int32(data + nxt);
+    if (end > size || end < nxt + CORE_SIZE)
+      break;
+    cap++;
+    nxt = end;
+  }
+
+  cores = PyBytes_FromStringAndSize(NULL, cap * CORE_SIZE);
+  if (cores == NULL){
+    PyBuffer_Release(&view);
+    return NULL;
+  }
+  for (n = 0; n < cap; n++){
+    memcpy(PyBytes_AS_STRING(cores) + n * CORE_SIZE, data + pos, CORE_SIZE);
+    pos += 4 + read_int32(data + pos);
+  }
+  PyBuffer_Release(&view);
+
+  ret = Py_BuildValue("(Nn)", cores, pos);
+  return ret;
+}
+
+static PyMethodDef bam_recordsMethods[] =
+  {
+    {"core_fields", core_fields, METH_VARARGS, core_fields__doc__},
+    {NULL, NULL, 0, NULL}
+  };
+
+#if PY_MAJOR_VERSION >= 3
+  #define MOD_ERROR_VAL NULL
+  #define MOD_SUCCESS_VAL(val) val
+  #define MOD_INIT(name) PyMODINIT_FUNC PyInit_##name(void)
+  #define MOD_DEF(ob, name, doc, methods) \
+          static struct PyModuleDef moduledef = { \
+            PyModuleDef_HEAD_INIT, name, doc, -1, methods, }; \
+          ob = PyModule_Create(&moduledef);
+#else
+  #define MOD_ERROR_VAL
+  #define MOD_SUCCESS_VAL(val)
+  #define MOD_INIT(name) PyMODINIT_FUNC init##name(void)
+  #define MOD_DEF(ob, name, doc, methods) \
+          ob = Py_InitModule3(name, methods, doc);
+#endif
+
+MOD_INIT(bam_records) {
+
+  PyObject *m;
+
+  MOD_DEF(m, "bam_records", "Functions to read the records of BAM files.",
+          bam_recordsMethods)
+  if (m == NULL)
+    return MOD_ERROR_VAL;
+
+  return MOD_SUCCESS_VAL(m);
+
+}
@@ -12,6 +12,7 @@ matplotlib.use('Agg')
 
 import unittest
 from pytadbit                             import Chromosome, load_chromosome
+from pytadbit                             import HiC_data, SparseHiC_data
 from pytadbit                             import tadbit, batch_tadbit
 from pytadbit.tad_clustering.tad_cmo      import optimal_cmo
 from pytadbit.modelling.structuralmodels        import load_structuralmodels
@@ -30,6 +31,7 @@ from os                                   import system, path, chdir
 from re                                   import finditer
 from warnings                             import warn, catch_warnings, simplefilter
 from distutils.spawn                      import find_executable
+from numpy                                import load
 
 import sys
 
@@ -847,6 +849,333 @@ class TestTadbit(unittest.TestCase):
             self.assertEqual(True, True)
             print("20", time() - t0)
 
+    def test_21_sparse_hic_data(self):
+        """
+        test that Hi-C data stored in a sparse matrix gives the same results
+        as the dictionary
+        """
+        if ONLY and not "21" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + "/20Kb/chrT/chrT_A.tsv", resolution=20000)
+        crms = OrderedDict([("chrA", 60), ("chrB", 40)])
+        hic_dict = HiC_data(hic_data.items(), len(hic_data), chromosomes=crms,
+                            resolution=20000)
+        keys = sorted(hic_dict.keys())
+        size = len(hic_dict)
+        hic_csr = SparseHiC_data.from_coo([k // size for k in keys],
+                                          [k % size for k in keys],
+                                          [hic_dict[k] for k in keys], size,
+                                          chromosomes=crms, resolution=20000)
+        self.assertEqual(sorted(hic_csr.keys()), keys)
+        self.assertEqual(hic_csr.sum(), hic_dict.sum())
+        self.assertEqual(hic_csr[3, 7], hic_dict[3, 7])
+        self.assertEqual(hic_csr.get(1), hic_dict.get(1))
+        self.assertEqual(hic_csr.get_matrix(focus=("chrA", "chrB")),
+                         hic_dict.get_matrix(focus=("chrA", "chrB")))
+        self.assertEqual(round(hic_csr.cis_trans_ratio(), 6),
+                         round(hic_dict.cis_trans_ratio(), 6))
+        # normalization
+        hic_dict.filter_columns(silent=True)
+        hic_csr.filter_columns(silent=True)
+        self.assertEqual(sorted(hic_csr.bads), sorted(hic_dict.bads))
+        hic_dict.normalize_hic(silent=True)
+        hic_csr.normalize_hic(silent=True)
+        self.assertEqual([round(hic_csr.bias[k], 6) for k in sorted(hic_csr.bias)],
+                         [round(hic_dict.bias[k], 6) for k in sorted(hic_dict.bias)])
+        self.assertEqual([round(v, 6) for row in hic_csr.get_matrix(
+                              focus="chrB", normalized=True) for v in row],
+                         [round(v, 6) for row in hic_dict.get_matrix(
+                              focus="chrB", normalized=True) for v in row])
+        self.assertEqual(round(hic_csr.cis_trans_ratio(normalized=True), 6),
+                         round(hic_dict.cis_trans_ratio(normalized=True), 6))
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("21", time() - t0)
+
+    def test_22_filter_reads_single_pass(self):
+        """
+        test that the single pass over the reads, split in chunks, catches the
+        same reads as the individual filters
+        """
+        if ONLY and not "22" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.parsers.map_parser import parse_map
+        from pytadbit.mapping import get_intersection
+        if not path.exists("test_read1.map~"):
+            seed(1)
+            random()
+            genome = generate_random_ali("map")
+        else:
+            genome = parse_fasta("test.fa~", verbose=False, save_cache=False)
+        parse_map(["test_read1.map~"], ["test_read2.map~"], "./lala1-map~",
+                  "./lala2-map~", genome, re_name="DPNII", mapper="GEM")
+        get_intersection("lala1-map~", "lala2-map~", "lala-map~")
+        masked = filter_reads("lala-map~", output="lala-slow~", verbose=False,
+                              fast=False)
+        slow = dict((k, (masked[k]["reads"], masked[k]["fnam"]))
+                    for k in range(1, 11))
+        masked = filter_reads("lala-map~", output="lala-fast~", verbose=False,
+                              fast=True, ncpus=3, mask="lala-mask~.npy")
+        fast = dict((k, (masked[k]["reads"], masked[k]["fnam"]))
+                    for k in range(1, 11))
+        mask = load("lala-mask~.npy")
+        self.assertEqual(len(mask), 6000)
+        for k in range(1, 11):
+            self.assertEqual(fast[k][0], slow[k][0])
+            self.assertEqual(((mask & (1 << (k - 1))) > 0).sum(), slow[k][0])
+            with open(slow[k][1]) as f_slow:
+                with open(fast[k][1]) as f_fast:
+                    self.assertEqual(f_fast.read().split(),
+                                     f_slow.read().split())
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("22", time() - t0)
+
+    def test_23_models_coordinates(self):
+        """
+        test save/load and alignment of models with their coordinates stored
+        in a single array
+        """
+        if ONLY and not "23" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        if sys.version_info[0] < 3:
+            refmodels_path = PATH + "/models.pick"
+        else:
+            refmodels_path = PATH + "/models_py3.pick"
+        # reference file is saved with the coordinates in each model
+        models = load_structuralmodels(refmodels_path)
+        self.assertEqual(models._coords.shape, (len(models), 3, models.nloci))
+        models.save_models("lala-models~")
+        loaded = load_structuralmodels("lala-models~")
+        system("rm -f lala-models~")
+        self.assertEqual(loaded._coords.tolist(), models._coords.tolist())
+        for i in range(len(models)):
+            for c in "xyz":
+                self.assertEqual(loaded[i][c].tolist(), models[i][c].tolist())
+        self.assertEqual(round(loaded[2].distance(2, 3), 4),
+                         round(models[2].distance(2, 3), 4))
+        # alignment, in place alignment modifies the array of coordinates
+        aligned = loaded.align_models(models=[0, 1, 2])
+        loaded.align_models(models=[0, 1, 2], in_place=True)
+        for i in range(3):
+            for j, c in enumerate("xyz"):
+                self.assertEqual(loaded[i][c].tolist(), list(aligned[i][j]))
+                self.assertEqual(loaded._coords[i][j].tolist(), list(aligned[i][j]))
+        self.assertEqual(loaded._coords[3].tolist(), models._coords[3].tolist())
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("23", time() - t0)
+
+    def test_24_pipeline_mapping(self):
+        """
+        test that mapping all the windows at the same time, through named
+        pipes, gives the same result as mapping them one after the other
+        (mappers are replaced by scripts mapping one read out of two)
+        """
+        if ONLY and not "24" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.mapping.full_mapper import full_mapping
+        seed(2)
+        out = open("lala-reads.fastq~", "w")
+        for i in range(1000):
+            seq = "".join("ACGT"[int(random() * 4)] for _ in range(40))
+            if i % 3 == 0:  # DpnII ligation site
+                seq = seq[:16] + "GATCGATC" + seq[24:]
+            out.write("@read%d\n%s\n+\n%s\n" % (i, seq, "I" * 40))
+        out.close()
+        write_stub_mappers("lala-gem-mapper~", "lala-bowtie2~")
+        for mapper, binary in [("gem", "lala-gem-mapper~"),
+                               ("bowtie2", "lala-bowtie2~")]:
+            results = {}
+            for pipeline in (False, True):
+                outdir = "lala-out-%s-%s~" % (mapper, pipeline)
+                outfiles = full_mapping(
+                    "lala-index~", "lala-reads.fastq~", outdir, mapper=mapper,
+                    mapper_binary=path.abspath(binary), r_enz="DpnII",
+                    windows=[(1, 20), (1, 40)], frag_map=True, clean=True,
+                    pipeline=pipeline, get_nread=True, nthreads=1,
+                    temp_dir="lala-tmp-%s-%s~" % (mapper, pipeline))
+                results[pipeline] = [
+                    (path.basename(fnam), nread, open(fnam).read())
+                    for fnam, nread in outfiles]
+                self.assertFalse(path.exists("lala-tmp-%s-%s~" % (mapper, pipeline)))
+            self.assertEqual([nread for _, nread, _ in results[False]],
+                             [1000, 500, 250])
+            self.assertTrue(results[False][2][2])  # some fragments are mapped
+            self.assertEqual(results[True], results[False])
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("24", time() - t0)
+
+    def test_25_bam_matrix_chunks(self):
+        """
+        test that reads at the borders of the chunks of a BAM file are counted
+        only once (interaction matrices of BAM files are read by chunks)
+        """
+        if ONLY and not "25" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.parsers.hic_bam_parser import get_matrix
+        pairs, nvalid = write_random_hic_bam("lala-reads.bam~", 10000,
+                                             [("chrA", 100000), ("chrB", 60000)])
+        system("mkdir -p lala-tmp~")
+        matrices = []
+        for nchunks in (1, 3, 7):
+            matrices.append(get_matrix("lala-reads.bam~", 10000, ncpus=2,
+                                       nchunks=nchunks, tmpdir="lala-tmp~",
+                                       clean=True))
+            # each pair of reads is stored twice, once from each read-end
+            self.assertEqual(sum(matrices[-1].values()), 2 * nvalid)
+        self.assertEqual(matrices[1], matrices[0])
+        self.assertEqual(matrices[2], matrices[0])
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("25", time() - t0)
+
+    def test_26_bam_core_fields(self):
+        """
+        test that the fixed fields of BAM records read from the BGZF blocks
+        (with and without the C extension) are the ones fetched by pysam
+        """
+        if ONLY and not "26" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pysam import AlignmentFile
+        from pytadbit.parsers import bam_core_parser
+        write_random_hic_bam("lala-reads.bam~", 10000,
+                             [("chrA", 100000), ("chrB", 60000)], npairs=20000)
+        bamfile = AlignmentFile("lala-reads.bam~")
+        regions = [(0, 0, 100000), (0, 9999, 10001), (0, 32000, 70000),
+                   (0, 55000, 56000), (1, 0, 60000), (1, 49990, 50002)]
+        c_core_fields = bam_core_parser._c_core_fields
+        try:
+            for core_fields in set([c_core_fields, None]):
+                bam_core_parser._c_core_fields = core_fields
+                for tid, beg, end in regions:
+                    # reads before the region may be included
+                    records = [r for recs in bam_core_parser.iter_core_fields(
+                                   "lala-reads.bam~", tid, beg, end)
+                               for r in recs[["refid", "pos", "flag",
+                                              "next_refid", "next_pos"]].tolist()
+                               if beg <= r[1] < end]
+                    fetched = [(r.reference_id, r.reference_start, r.flag,
+                                r.next_reference_id, r.next_reference_start)
+                               for r in bamfile.fetch(
+                                   bamfile.get_reference_name(tid), beg, end)]
+                    self.assertEqual(records, fetched)
+        finally:
+            bam_core_parser._c_core_fields = c_core_fields
+        bamfile.close()
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("26", time() - t0)
+
+
+def write_random_hic_bam(fnam, resolution, crms, npairs=2000):
+    """
+    Writes a sorted and indexed BAM file of interacting reads, as TADbit does,
+    with reads starting close to the borders of the bins. One pair out of
+    four is filtered (as self-circle).
+
+    :returns: the list of pairs of reads written (read ID, flag, chromosome
+       and position of each read-end), and the number of valid pairs
+    """
+    import pysam
+    seed(3)
+    pairs = []
+    for i in range(npairs):
+        ends = []
+        for _ in range(2):
+            crm, size = crms[int(random() * len(crms))]
+            pos = (int(random() * (size // resolution - 1)) + 1) * resolution
+            ends.append((crm, pos + int(random() * 4) - 2))
+        pairs.append(("read%d" % i, 0 if i % 4 else 1) + ends[0] + ends[1])
+    header = {"HD": {"VN": "1.5"},
+              "SQ": [{"SN": crm, "LN": size} for crm, size in crms]}
+    tids = dict((crm, i) for i, (crm, _) in enumerate(crms))
+    out = pysam.AlignmentFile(fnam + ".unsorted", "wb", header=header)
+    # each pair of reads is written twice, starting with each read-end
+    for rid, flag, crm1, pos1, crm2, pos2 in pairs:
+        if crm1 != crm2:
+            flag += 1024  # trans-chromosomic
+        for (c1, p1), (c2, p2), copy in (((crm1, pos1), (crm2, pos2), 6),
+                                         ((crm2, pos2), (crm1, pos1), 7)):
+            read = pysam.AlignedSegment()
+            read.query_name = rid
+            read.flag = flag
+            read.reference_id = tids[c1]
+            read.reference_start = p1 - 1
+            read.cigartuples = [(copy, 1)]  # 1P or 1S
+            read.next_reference_id = tids[c2]
+            read.next_reference_start = p2 - 1
+            read.set_tag("TC", 1)
+            out.write(read)
+    out.close()
+    pysam.sort("-o", fnam, "-O", "bam", fnam + ".unsorted")
+    pysam.index(fnam)
+    return pairs, sum(1 for p in pairs if not p[1])
+
+
+def write_stub_mappers(gem_path, bowtie2_path):
+    """
+    Writes two scripts replacing GEM (version 2) and bowtie2, they map one read
+    out of two, in the order they are read
+    """
+    gem = """#!%s
+import sys
+args = sys.argv[1:]
+if '--version' in args:
+    print('v2')
+    sys.exit(0)
+inp = open(args[args.index('-i') + 1]) if '-i' in args else sys.stdin
+lines = inp.readlines()
+out = open(args[args.index('-o') + 1] + '.map', 'w')
+for i in range(0, len(lines), 4):
+    name, seq, qual = lines[i][1:-1], lines[i + 1].strip(), lines[i + 3].strip()
+    if (i // 4) %% 2:
+        out.write('%%s\\t%%s\\t%%s\\t1\\tchrT:+:%%d:%%d\\n' %% (
+            name, seq, qual, i + 1, len(seq)))
+    else:
+        out.write('%%s\\t%%s\\t%%s\\t0\\t-\\n' %% (name, seq, qual))
+out.close()
+""" % sys.executable
+    bowtie2 = """#!%s
+import sys
+args = sys.argv[1:]
+inp = args[args.index('-U') + 1]
+lines = (sys.stdin if inp == '-' else open(inp)).readlines()
+out = open(args[args.index('-S') + 1], 'w')
+out.write('@HD\\tVN:1.0\\tSO:unsorted\\n@SQ\\tSN:chrT\\tLN:100000\\n')
+for i in range(0, len(lines), 4):
+    name, seq, qual = lines[i][1:].split()[0], lines[i + 1].strip(), lines[i + 3].strip()
+    if (i // 4) %% 2:
+        out.write('%%s\\t0\\tchrT\\t%%d\\t42\\t%%dM\\t*\\t0\\t0\\t%%s\\t%%s\\n' %% (
+            name, i + 1, len(seq), seq, qual))
+    else:
+        out.write('%%s\\t4\\t*\\t0\\t0\\t*\\t*\\t0\\t0\\t%%s\\t%%s\\n' %% (
+            name, seq, qual))
+out.close()
+""" % sys.executable
+    for fnam, script in ((gem_path, gem), (bowtie2_path, bowtie2)):
+        out = open(fnam, "w")
+        out.write(script)
+        out.close()
+        system("chmod +x %s" % fnam)
+
 
 def generate_random_ali(ali="map"):
     # VARIABLES